@@ -5,6 +5,13 @@ import traceback
 import base64
 from io import BytesIO
 import time 
+import math
+import queue
+import threading
+import itertools
+import multiprocessing
+import hashlib
+from collections import OrderedDict
 
 
 # 1. Define LAMA_ROOT_DIR (one level above bin/)
@@ -14,12 +21,17 @@ LAMA_ROOT_DIR = os.path.abspath(os.path.join(LAMA_BIN_DIR, '..'))
 # 2. CRITICAL: Add the project root to sys.path for LaMa's internal imports (saicinpainting.*)
 sys.path.insert(0, LAMA_ROOT_DIR)
 
+# Threading: intra-op threads per inference (and per worker process) and inter-op threads.
+# Must be exported before torch/numpy are imported.
+INTRA_OP_THREADS = int(os.environ.get('LAMA_INTRA_OP_THREADS', 1))
+INTER_OP_THREADS = int(os.environ.get('LAMA_INTER_OP_THREADS', 1))
+
 # Suppress warnings and set environment variables
-os.environ['OMP_NUM_THREADS'] = '1'
-os.environ['OPENBLAS_NUM_THREADS'] = '1'
-os.environ['MKL_NUM_THREADS'] = '1'
-os.environ['VECLIB_MAXIMUM_THREADS'] = '1'
-os.environ['NUMEXPR_NUM_THREADS'] = '1'
+os.environ['OMP_NUM_THREADS'] = str(INTRA_OP_THREADS)
+os.environ['OPENBLAS_NUM_THREADS'] = str(INTRA_OP_THREADS)
+os.environ['MKL_NUM_THREADS'] = str(INTRA_OP_THREADS)
+os.environ['VECLIB_MAXIMUM_THREADS'] = str(INTRA_OP_THREADS)
+os.environ['NUMEXPR_NUM_THREADS'] = str(INTRA_OP_THREADS)
 
 import cv2
 import hydra
@@ -34,19 +46,84 @@ from flask_cors import CORS
 
 from saicinpainting.evaluation.utils import move_to_device
 from saicinpainting.evaluation.refinement import refine_predict
-from saicinpainting.training.trainers import load_checkpoint
+from saicinpainting.training.trainers import load_checkpoint, make_training_model
+from lama_export import create_runner
+from image_ingest import TensorIngest, pil_to_array
+from weights import load_into, load_state_dict_fast, resolve_weights
+from service_health import ServiceHealth, parse_shapes, register_health_routes, run_warmup_steps
+from blob_store import MissingBlobError, create_blob_store, missing_blob_response, register_blob_routes
+from admission import AdmissionRejected, admission_rejected_response, admitted, register_admission_routes
 
 LOGGER = logging.getLogger(__name__)
 
 app = Flask(__name__)
 CORS(app)
 
+# Images uploaded once via PUT /blobs/<sha256>, referenced later as "image_ref"
+BLOBS = create_blob_store()
+register_blob_routes(app, BLOBS)
+
+# /healthz and /readyz; ready once the model (or every pool worker) is loaded and warmed up
+HEALTH = ServiceHealth('lama')
+register_health_routes(app, HEALTH)
+# Each LaMa forward (one per batch or tile) is admitted as 'inpaint' (GET /admission)
+register_admission_routes(app)
+# Image sizes (WxH) inpainted once at startup
+LAMA_WARMUP_SHAPES = parse_shapes(os.environ.get('LAMA_WARMUP_SHAPES', '512x512'))
+
 # Global variables to store the loaded model and config
 LAMA_MODEL = None
 TRAIN_CONFIG = None
 PREDICT_CONFIG = None
 # Set device (CPU as a fallback, but CUDA is likely needed for speed)
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# Reused uint8 staging buffers; images are normalized on the device
+INGEST = TensorIngest(DEVICE)
+
+# Inference backend: "eager" (Lightning checkpoint), "torchscript" or "onnx" (see lama_export.py)
+BACKEND = os.environ.get('LAMA_BACKEND', 'eager')
+# Exported model path, relative to the checkpoint folder unless absolute
+EXPORT_PATH = os.environ.get('LAMA_EXPORT_PATH', '')
+# fp32 | bf16 (TorchScript autocast); int8 is selected by pointing ONNX at the quantized export
+PRECISION = os.environ.get('LAMA_PRECISION', 'fp32')
+if BACKEND != 'eager' and not EXPORT_PATH:
+    # An empty path would resolve to the checkpoint folder itself
+    raise ValueError(f"LAMA_BACKEND={BACKEND} requires LAMA_EXPORT_PATH (see lama_export.py)")
+
+# A batched or pool request fails after this long instead of waiting on a stuck batcher or worker forever
+JOB_TIMEOUT_S = float(os.environ.get('LAMA_JOB_TIMEOUT_S', 300))
+
+# Micro-batching of concurrent /inpaint requests (0 or 1 disables it)
+BATCH_MAX_SIZE = int(os.environ.get('LAMA_BATCH_MAX_SIZE', 4))
+BATCH_WAIT_MS = float(os.environ.get('LAMA_BATCH_WAIT_MS', 20))
+# Requests whose padded sizes round up to the same multiple of this share a bucket
+BATCH_BUCKET_SIZE = int(os.environ.get('LAMA_BATCH_BUCKET_SIZE', 64))
+BATCHER = None
+
+# Multi-process serving: number of model worker processes (0 serves in-process)
+NUM_WORKERS = int(os.environ.get('LAMA_WORKERS', 0))
+# Pin each worker to its own block of INTRA_OP_THREADS cores (Linux only)
+PIN_CPUS = os.environ.get('LAMA_PIN_CPUS', '0') == '1'
+WORKER_POOL = None
+
+# Result cache: LRU in memory, evicted entries spill to disk as PNG files
+CACHE_MEMORY_ITEMS = int(os.environ.get('LAMA_CACHE_MEMORY_ITEMS', 32))
+CACHE_DISK_ITEMS = int(os.environ.get('LAMA_CACHE_DISK_ITEMS', 512))
+CACHE_DIR = os.environ.get('LAMA_CACHE_DIR', os.path.join(LAMA_ROOT_DIR, 'lama_cache'))
+RESULT_CACHE = None
+
+# Mask-region crop mode: inpaint only the mask's bounding box plus a context margin.
+# Off by default because it changes the output; enable it with LAMA_CROP_MODE=1 or per request with "crop"
+CROP_MODE = os.environ.get('LAMA_CROP_MODE', '0') == '1'
+CROP_MARGIN = int(os.environ.get('LAMA_CROP_MARGIN', 128))
+# Crops covering more than this fraction of the frame run on the full image instead
+CROP_MAX_FRACTION = float(os.environ.get('LAMA_CROP_MAX_FRACTION', 0.6))
+
+# Pixel budget: larger inputs are inpainted at reduced scale (0 disables the limit)
+MAX_PIXELS = int(os.environ.get('LAMA_MAX_PIXELS', 2048 * 2048))
+FEATHER_PX = int(os.environ.get('LAMA_FEATHER_PX', 8))
+# Over budget, masks whose box exceeds one tile are inpainted in native-resolution tiles (0 disables)
+TILE_SIZE = int(os.environ.get('LAMA_TILE_SIZE', 0))
 
 # Define the debug/output directory
 DEBUG_OUTPUT_DIR = os.path.join(LAMA_ROOT_DIR, 'lama_debug_outputs')
@@ -94,13 +171,30 @@ def load_lama_model():
         TRAIN_CONFIG.training_model.predict_only = True
         TRAIN_CONFIG.visualizer.kind = 'noop'
 
+        if BACKEND != 'eager':
+            # Exported generators skip the Lightning checkpoint entirely
+            export_path = os.path.join(model_root_path, 'models', EXPORT_PATH)
+            if PREDICT_CONFIG.get('refine', False):
+                LOGGER.warning("Refinement needs the eager model; disabling it for the exported backend")
+                PREDICT_CONFIG.refine = False
+            LAMA_MODEL = create_runner(BACKEND, export_path, PREDICT_CONFIG.out_key, DEVICE,
+                                       precision=PRECISION, num_threads=INTRA_OP_THREADS)
+            LOGGER.info(f"LaMa {BACKEND} model loaded from {export_path}")
+            return
+
         # 4. Load the checkpoint file
         checkpoint_path = os.path.join(model_root_path, 
                                        'models', 
                                        PREDICT_CONFIG.model.checkpoint)
         
-        # 5. Load the model and move it to the device
-        model = load_checkpoint(TRAIN_CONFIG, checkpoint_path, strict=False, map_location=DEVICE)
+        # 5. Load the model and move it to the device; a converted .safetensors
+        #    checkpoint is memory-mapped and materialized directly on the device
+        weights_path = resolve_weights(checkpoint_path)
+        if weights_path.endswith('.safetensors'):
+            model = make_training_model(TRAIN_CONFIG)
+            load_into(model, load_state_dict_fast(weights_path, DEVICE), strict=False)
+        else:
+            model = load_checkpoint(TRAIN_CONFIG, checkpoint_path, strict=False, map_location=DEVICE)
         model.freeze()
         model.to(DEVICE)
         LAMA_MODEL = model
@@ -111,6 +205,19 @@ def load_lama_model():
         # Re-raise the error so the main block catches it and LAMA_MODEL remains None
         raise e
 
+def load_models():
+    """Loads the in-process model and starts the micro-batcher (at startup, or on demand by vm_host.py)."""
+    global BATCHER
+    with HEALTH.loading():
+        load_lama_model()
+    if BATCH_MAX_SIZE > 1 and BATCHER is None:
+        BATCHER = InpaintBatcher(BATCH_MAX_SIZE, BATCH_WAIT_MS, BATCH_BUCKET_SIZE)
+
+def release_models():
+    """Drops the model reference so its memory can be reclaimed; the batcher and result cache stay."""
+    global LAMA_MODEL
+    LAMA_MODEL = None
+
 def pad_batch(batch, pad_mod=8):
     """
     Pads a batch of images and masks so that their height and width are a multiple of pad_mod.
@@ -148,21 +255,19 @@ def preprocess_for_lama(image_pil, mask_pil, config):
     converting, normalizing, and most importantly, padding the image.
     """
 
-    # 1. Convert PIL to NumPy
-    image_np = np.array(image_pil.convert('RGB'))
-    mask_np = np.array(mask_pil.convert('L'))
+    # 1. uint8 views of the PIL images (no conversion when already RGB / L)
+    image_np = pil_to_array(image_pil, 'RGB')
+    mask_np = pil_to_array(mask_pil, 'L')
 
     # 2. Save original size for unpadding
     H, W = image_np.shape[:2]
 
-    # 3. Binarize mask (0 or 1 float)
-    # Note: Binarization should be before padding
-    mask_np = (mask_np > 127).astype(np.float32)
+    # 3. Upload as uint8 and normalize on the device; tensors are [1, C, H, W]
+    image_tensor = INGEST.to_device(image_np)
 
-    # 4. Normalization and Tensor Conversion
-    # Tensors must be: [1, C, H, W]
-    image_tensor = torch.from_numpy(image_np / 255.0).permute(2, 0, 1).unsqueeze(0).float()
-    mask_tensor = torch.from_numpy(mask_np).unsqueeze(0).unsqueeze(0).float()
+    # 4. Binarize mask (0 or 1 float)
+    # Note: Binarization should be before padding
+    mask_tensor = (INGEST.to_device(mask_np, normalize=False) > 127).float()
 
     batch = {
         'image': image_tensor,
@@ -173,78 +278,632 @@ def preprocess_for_lama(image_pil, mask_pil, config):
     batch = pad_batch(batch, config.dataset.res)
 
     return batch
-# --- Flask Endpoint ---
+# --- Mask-region Cropping ---
 
-@app.route('/inpaint', methods=['POST'])
-def inpaint_api():
-    # Return 503 if the model failed to load at startup
-    if LAMA_MODEL is None:
-        return jsonify({'error': 'LaMa model not loaded'}), 503
+def _expand_to_multiple(start, end, limit, pad_mod):
+    """Grows [start, end) to a multiple of pad_mod, staying inside [0, limit) where possible."""
+    size = end - start
+    target = min(((size + pad_mod - 1) // pad_mod) * pad_mod, limit)
+    extra = target - size
+    start = max(0, start - extra // 2)
+    end = start + target
+    if end > limit:
+        start, end = limit - target, limit
+    return start, end
 
-    data = request.json
 
-    # Generate a unique ID for this request for filenames
-    timestamp = int(time.time() * 1000)
-    request_id = f"req_{timestamp}"
+def mask_crop_box(mask_pil, margin, pad_mod):
+    """
+    Returns the (left, top, right, bottom) crop around the mask's bounding box
+    plus margin, rounded to pad_mod, or None if cropping would not help.
+    """
+    mask_np = np.array(mask_pil.convert('L')) > 127
+    rows = np.flatnonzero(mask_np.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(mask_np.any(axis=0))
+
+    H, W = mask_np.shape
+    top, bottom = max(0, rows[0] - margin), min(H, rows[-1] + 1 + margin)
+    left, right = max(0, cols[0] - margin), min(W, cols[-1] + 1 + margin)
+    top, bottom = _expand_to_multiple(top, bottom, H, pad_mod)
+    left, right = _expand_to_multiple(left, right, W, pad_mod)
+
+    if (bottom - top) * (right - left) > CROP_MAX_FRACTION * H * W:
+        return None
+    return int(left), int(top), int(right), int(bottom)
+
+
+def feather_composite(original_np, fill_np, mask_np, feather_px):
+    """Blends the fill over the original: masked pixels fully, with a soft edge outside the mask."""
+    alpha = mask_np.astype(np.float32)
+    if feather_px > 0:
+        alpha = np.maximum(alpha, cv2.GaussianBlur(alpha, (0, 0), feather_px / 2))
+    alpha = alpha[..., None]
+    return (fill_np * alpha + original_np * (1 - alpha)).round().astype(np.uint8)
+
+# --- Pixel Budget / Tiling ---
+
+def run_lama_pil(image_pil, mask_pil):
+    """Preprocesses, runs LaMa and returns the uint8 HxWx3 result."""
+    batch = preprocess_for_lama(image_pil, mask_pil, PREDICT_CONFIG)
+    return np.clip(run_lama(batch) * 255, 0, 255).astype('uint8')
+
+
+def _tile_starts(length, tile, stride):
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile + 1, stride))
+    if starts[-1] != length - tile:
+        starts.append(length - tile)
+    return starts
+
+
+def _tile_window(height, width, overlap):
+    """Blend weights that ramp up linearly over the overlap at each tile edge."""
+    ramp_y = np.minimum(np.arange(height) + 1, np.arange(height)[::-1] + 1)
+    ramp_x = np.minimum(np.arange(width) + 1, np.arange(width)[::-1] + 1)
+    ramp_y = np.minimum(ramp_y, overlap) / overlap
+    ramp_x = np.minimum(ramp_x, overlap) / overlap
+    return np.outer(ramp_y, ramp_x).astype(np.float32)
+
+
+def inpaint_tiled(image_pil, mask_pil, tile_size):
+    """Inpaints overlapping native-resolution tiles that contain masked pixels and blends them."""
+    image_np = np.array(image_pil.convert('RGB'))
+    mask_np = np.array(mask_pil.convert('L')) > 127
+    H, W = mask_np.shape
+    overlap = max(tile_size // 4, 1)
+    stride = tile_size - overlap
+
+    acc = np.zeros((H, W, 3), dtype=np.float32)
+    weight = np.zeros((H, W), dtype=np.float32)
+    for top in _tile_starts(H, tile_size, stride):
+        for left in _tile_starts(W, tile_size, stride):
+            tile = (slice(top, top + tile_size), slice(left, left + tile_size))
+            tile_mask = mask_np[tile]
+            if not tile_mask.any():
+                continue
+            fill = run_lama_pil(Image.fromarray(image_np[tile]),
+                                Image.fromarray(tile_mask.astype(np.uint8) * 255))
+            window = _tile_window(*tile_mask.shape, overlap)
+            acc[tile] += fill * window[..., None]
+            weight[tile] += window
+
+    result = image_np.astype(np.float32)
+    covered = weight > 0
+    result[covered] = acc[covered] / weight[covered][:, None]
+    return result.round().astype(np.uint8)
+
+
+def inpaint_within_budget(image_pil, mask_pil, max_pixels, tile_size):
+    """
+    Returns (fill, soft). Inputs above max_pixels are inpainted at reduced scale
+    (or in native tiles for large masks when tiling is on) and the fill is
+    upsampled; soft tells the caller to feather-composite it.
+    """
+    W, H = image_pil.size
+    if not max_pixels or W * H <= max_pixels:
+        return run_lama_pil(image_pil, mask_pil), False
+
+    if tile_size:
+        box = mask_pil.convert('L').point(lambda v: 255 if v > 127 else 0).getbbox()
+        if box and (box[2] - box[0]) * (box[3] - box[1]) > tile_size * tile_size:
+            return inpaint_tiled(image_pil, mask_pil, tile_size), True
+
+    scale = math.sqrt(max_pixels / (W * H))
+    small_size = (max(8, int(W * scale)), max(8, int(H * scale)))
+    small_image = image_pil.convert('RGB').resize(small_size, Image.LANCZOS)
+    # Any coverage keeps a pixel masked so the hole never shrinks when downscaling
+    small_mask = mask_pil.convert('L').point(lambda v: 255 if v > 127 else 0) \
+        .resize(small_size, Image.BILINEAR).point(lambda v: 255 if v > 0 else 0)
+    LOGGER.info(f"Input {W}x{H} over pixel budget, inpainting at {small_size[0]}x{small_size[1]}")
+
+    small_fill = run_lama_pil(small_image, small_mask)
+    return cv2.resize(small_fill, (W, H), interpolation=cv2.INTER_CUBIC), True
+
+# --- Micro-batching Scheduler ---
+
+def pad_to_shape(tensor, height, width, mode):
+    """Pads a [B, C, H, W] tensor on the right/bottom up to (height, width)."""
+    pad_h = height - tensor.shape[2]
+    pad_w = width - tensor.shape[3]
+    if pad_h == 0 and pad_w == 0:
+        return tensor
+    if mode == 'reflect' and (pad_h >= tensor.shape[2] or pad_w >= tensor.shape[3]):
+        mode = 'replicate'  # reflect cannot pad past the input size
+    if mode == 'constant':
+        return F.pad(tensor, (0, pad_w, 0, pad_h), mode, 0)
+    return F.pad(tensor, (0, pad_w, 0, pad_h), mode)
+
+
+class InpaintBatcher:
+    """
+    Groups concurrent inpaint requests into size buckets and runs one batched
+    forward per bucket. Callers block in submit() until their result is ready.
+    """
 
-    try:
-        original_image_pil = decode_image_from_base64(data['image'])
-        mask_image_pil = decode_image_from_base64(data['mask'])
+    def __init__(self, max_batch_size, wait_ms, bucket_size):
+        self.max_batch_size = max_batch_size
+        self.wait_s = wait_ms / 1000.0
+        self.bucket_size = bucket_size
+        self.queue = queue.Queue()
+        self.pending = []
+        self.worker = threading.Thread(target=self._run, name='lama-batcher', daemon=True)
+        self.worker.start()
+
+    def _bucket(self, image):
+        H, W = image.shape[2:]
+        b = self.bucket_size
+        return ((H + b - 1) // b * b, (W + b - 1) // b * b)
+
+    def submit(self, batch):
+        """Queues a preprocessed single-image batch and returns the unpadded HxWx3 float result."""
+        job = {
+            'image': batch['image'],
+            'mask': batch['mask'],
+            'unpad_to_size': batch['unpad_to_size'],
+            'bucket': self._bucket(batch['image']),
+            'done': threading.Event(),
+            'result': None,
+            'error': None,
+        }
+        self.queue.put(job)
+        if not job['done'].wait(JOB_TIMEOUT_S):
+            # Skipped if the batcher gets to it after all
+            job['cancelled'] = True
+            state = 'is not running' if not self.worker.is_alive() else f"did not answer within {JOB_TIMEOUT_S:.0f} s"
+            raise TimeoutError(f"LaMa batcher {state}")
+        if job['error'] is not None:
+            raise job['error']
+        return job['result']
+
+    def _collect(self):
+        """Waits up to the batching window for jobs that share the first job's bucket."""
+        if not self.pending:
+            self.pending.append(self.queue.get())
+        bucket = self.pending[0]['bucket']
+
+        deadline = time.monotonic() + self.wait_s
+        while sum(job['bucket'] == bucket for job in self.pending) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                self.pending.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        group = [job for job in self.pending if job['bucket'] == bucket][:self.max_batch_size]
+        taken = {id(job) for job in group}
+        self.pending = [job for job in self.pending if id(job) not in taken]
+        return [job for job in group if not job.get('cancelled')]
+
+    def _run(self):
+        while True:
+            group = self._collect()
+            if not group:
+                continue
+            try:
+                results = self._forward(group)
+                for job, result in zip(group, results):
+                    job['result'] = result
+            except Exception as e:
+                LOGGER.error(f"Batched LaMa forward failed: {e}", exc_info=True)
+                for job in group:
+                    job['error'] = e
+            finally:
+                for job in group:
+                    job['done'].set()
+
+    def _forward(self, group):
+        H, W = group[0]['bucket']
+        batch = {
+            'image': torch.cat([pad_to_shape(job['image'], H, W, 'reflect') for job in group]),
+            'mask': torch.cat([pad_to_shape(job['mask'], H, W, 'constant') for job in group]),
+        }
+        batch = move_to_device(batch, DEVICE)
+
+        with torch.no_grad(), admitted('inpaint'):
+            batch['mask'] = (batch['mask'] > 0) * 1
+            output = LAMA_MODEL(batch)[PREDICT_CONFIG.out_key]
+            output = output.permute(0, 2, 3, 1).detach().cpu().numpy()
+
+        # Each request is unpadded back to its own original size
+        results = []
+        for i, job in enumerate(group):
+            orig_height, orig_width = job['unpad_to_size']
+            results.append(output[i, :orig_height, :orig_width])
+        LOGGER.info(f"LaMa batch of {len(group)} at {H}x{W}")
+        return results
+
+
+def run_lama(batch):
+    """Runs LaMa on a preprocessed batch and returns the unpadded HxWx3 float result."""
+    if BATCHER is not None and not PREDICT_CONFIG.get('refine', False):
+        return BATCHER.submit(batch)
+
+    unpad_to_size = batch.pop('unpad_to_size') # Extract and remove the tuple of ints
+    batch = move_to_device(batch, DEVICE)     # Move only Tensors
+    batch['unpad_to_size'] = unpad_to_size    # Re-insert the tuplei
+
+    # Core LaMa Inference Logic (from predict.py)
+    with torch.no_grad(), admitted('inpaint'):
+        batch['mask'] = (batch['mask'] > 0) * 1
+
+        if PREDICT_CONFIG.get('refine', False):
+            # Refinement path (complex, uses unpad_to_size implicitly)
+            cur_res_tensor = refine_predict(batch, LAMA_MODEL, **PREDICT_CONFIG.refiner)
+            cur_res_tensor = cur_res_tensor[0].permute(1,2,0).detach().cpu().numpy()
+        else:
+            # Standard path
+            batch = LAMA_MODEL(batch)
+            cur_res_tensor = batch[PREDICT_CONFIG.out_key][0].permute(1, 2, 0).detach().cpu().numpy()
+
+        # Unpadding logic (copied from predict.py)
+        unpad_to_size = batch.get('unpad_to_size', None)
+        if unpad_to_size is not None:
+            orig_height, orig_width = unpad_to_size
+            cur_res_tensor = cur_res_tensor[:orig_height, :orig_width]
+
+    return cur_res_tensor
+
+# --- Result Cache ---
+
+def _b64_body(data_url):
+    return data_url.split('base64,', 1)[1] if 'base64,' in data_url else data_url
+
+
+def inpaint_cache_key(data):
+    """Key over the image and mask hashes plus every setting that changes the output."""
+    image_hash = hashlib.sha256(_b64_body(data['image']).encode('ascii')).hexdigest()
+    mask_hash = hashlib.sha256(_b64_body(data['mask']).encode('ascii')).hexdigest()
+    config = (
+        bool(PREDICT_CONFIG.get('refine', False)) if PREDICT_CONFIG is not None else None,
+        bool(data.get('crop', CROP_MODE)),
+        int(data.get('crop_margin', CROP_MARGIN)),
+        int(data.get('max_pixels', MAX_PIXELS)),
+        CROP_MAX_FRACTION,
+        TILE_SIZE,
+        FEATHER_PX,
+        # Exported / quantized models produce different fills than the eager one
+        BACKEND,
+        EXPORT_PATH if BACKEND != 'eager' else None,
+        PRECISION if BACKEND != 'eager' else None,
+    )
+    return hashlib.sha256(f"{image_hash}:{mask_hash}:{config}".encode('utf-8')).hexdigest()
+
+
+class InpaintResultCache:
+    """
+    Bounded LRU of inpainted PNG data URLs. Entries evicted from memory are
+    written to disk and promoted back on the next hit.
+    """
 
+    def __init__(self, memory_items, disk_items, cache_dir):
+        self.memory_items = memory_items
+        self.disk_items = disk_items
+        self.cache_dir = cache_dir
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        if disk_items > 0:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.png')
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+
+        if self.disk_items <= 0:
+            return None
         try:
-            input_image_path = os.path.join(DEBUG_OUTPUT_DIR, f'input_image_{request_id}.png')
-            input_mask_path = os.path.join(DEBUG_OUTPUT_DIR, f'input_mask_{request_id}.png')
-            original_image_pil.save(input_image_path)
-            mask_image_pil.save(input_mask_path)
-            LOGGER.info(f"Saved input image to {input_image_path}")
-        except Exception as file_save_error:
-            LOGGER.warning(f"Could not save input images: {file_save_error}")
+            with open(self._path(key), 'rb') as f:
+                png_bytes = f.read()
+        except FileNotFoundError:
+            return None
+        data_url = f"data:image/png;base64,{base64.b64encode(png_bytes).decode('utf-8')}"
+        self.put(key, data_url)
+        return data_url
+
+    def put(self, key, data_url):
+        with self.lock:
+            self.memory[key] = data_url
+            self.memory.move_to_end(key)
+            evicted = []
+            while len(self.memory) > self.memory_items:
+                evicted.append(self.memory.popitem(last=False))
+
+        if self.disk_items <= 0:
+            return
+        for evicted_key, evicted_url in evicted:
+            try:
+                with open(self._path(evicted_key), 'wb') as f:
+                    f.write(base64.b64decode(_b64_body(evicted_url)))
+            except OSError as e:
+                LOGGER.warning(f"Could not spill cache entry to disk: {e}")
+        if evicted:
+            self._trim_disk()
+
+    def _trim_disk(self):
+        entries = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith('.png')]
+        if len(entries) <= self.disk_items:
+            return
+        entries.sort(key=os.path.getmtime)
+        for path in entries[:len(entries) - self.disk_items]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+# --- Flask Endpoint ---
 
+def inpaint_payload(data, request_id):
+    """Runs the whole inpainting pipeline for one /inpaint payload and returns the uint8 RGB result."""
+    original_image_pil = decode_image_from_base64(data['image'])
+    mask_image_pil = decode_image_from_base64(data['mask'])
 
-        # 2. Preprocess
-        batch = preprocess_for_lama(original_image_pil, mask_image_pil, PREDICT_CONFIG)
+    try:
+        input_image_path = os.path.join(DEBUG_OUTPUT_DIR, f'input_image_{request_id}.png')
+        input_mask_path = os.path.join(DEBUG_OUTPUT_DIR, f'input_mask_{request_id}.png')
+        original_image_pil.save(input_image_path)
+        mask_image_pil.save(input_mask_path)
+        LOGGER.info(f"Saved input image to {input_image_path}")
+    except Exception as file_save_error:
+        LOGGER.warning(f"Could not save input images: {file_save_error}")
+
+
+    # 2. Preprocess (only the mask's neighbourhood in crop mode)
+    crop_box = None
+    if data.get('crop', CROP_MODE):
+        crop_box = mask_crop_box(mask_image_pil, int(data.get('crop_margin', CROP_MARGIN)),
+                                 PREDICT_CONFIG.dataset.res)
+
+    region_image = original_image_pil.crop(crop_box) if crop_box else original_image_pil
+    region_mask = mask_image_pil.crop(crop_box) if crop_box else mask_image_pil
+
+    # 3. Run LaMa (batched with concurrent requests, within the pixel budget)
+    fill_np, soft = inpaint_within_budget(region_image, region_mask,
+                                          int(data.get('max_pixels', MAX_PIXELS)), TILE_SIZE)
+
+    # 4. Composite the fill back into the original
+    if crop_box is None and not soft:
+        cur_res_np = fill_np
+    else:
+        region_np = feather_composite(np.array(region_image.convert('RGB')), fill_np,
+                                      np.array(region_mask.convert('L')) > 127,
+                                      FEATHER_PX if soft else 0)
+        if crop_box is None:
+            cur_res_np = region_np
+        else:
+            left, top, right, bottom = crop_box
+            cur_res_np = np.array(original_image_pil.convert('RGB'))
+            cur_res_np[top:bottom, left:right] = region_np
 
-        unpad_to_size = batch.pop('unpad_to_size') # Extract and remove the tuple of ints
-        batch = move_to_device(batch, DEVICE)     # Move only Tensors
-        batch['unpad_to_size'] = unpad_to_size    # Re-insert the tuplei
+    try:
+        output_image_path = os.path.join(DEBUG_OUTPUT_DIR, f'output_inpainted_{request_id}.png')
+        Image.fromarray(cur_res_np, 'RGB').save(output_image_path)
+        LOGGER.info(f"Saved output image to {output_image_path}")
+    except Exception as file_save_error:
+        LOGGER.warning(f"Could not save output image: {file_save_error}")
 
-        # 3. Core LaMa Inference Logic (from predict.py)
-        with torch.no_grad():
-            batch['mask'] = (batch['mask'] > 0) * 1
+    return cur_res_np
 
-            if PREDICT_CONFIG.get('refine', False):
-                # Refinement path (complex, uses unpad_to_size implicitly)
-                cur_res_tensor = refine_predict(batch, LAMA_MODEL, **PREDICT_CONFIG.refiner)
-                cur_res_tensor = cur_res_tensor[0].permute(1,2,0).detach().cpu().numpy()
-            else:
-                # Standard path
-                batch = LAMA_MODEL(batch)
-                cur_res_tensor = batch[PREDICT_CONFIG.out_key][0].permute(1, 2, 0).detach().cpu().numpy()
-
-            # Unpadding logic (copied from predict.py)
-            unpad_to_size = batch.get('unpad_to_size', None)
-            if unpad_to_size is not None:
-                orig_height, orig_width = unpad_to_size
-                cur_res_tensor = cur_res_tensor[:orig_height, :orig_width]
-
-        # 4. Convert float result (0-1) to uint8 (0-255)
-        cur_res_np = np.clip(cur_res_tensor * 255, 0, 255).astype('uint8')
+# --- Warm-up ---
+
+def warmup_steps():
+    """One inpaint of a centred rectangle per warm-up shape (through the batcher when enabled)."""
+    def run(width, height):
+        image_pil = Image.fromarray(np.random.randint(0, 256, (height, width, 3), dtype=np.uint8))
+        mask_np = np.zeros((height, width), dtype=np.uint8)
+        mask_np[height // 4: 3 * height // 4, width // 4: 3 * width // 4] = 255
+        run_lama_pil(image_pil, Image.fromarray(mask_np))
 
+    return [(f"{width}x{height}", lambda width=width, height=height: run(width, height))
+            for width, height in LAMA_WARMUP_SHAPES]
+
+# --- Multi-process Serving ---
+
+def _worker_main(worker_id, cpu_ids, job_queue, result_queue):
+    """Worker process: loads the model once, then serves jobs until it receives None."""
+    if cpu_ids and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpu_ids)
+    torch.set_num_threads(INTRA_OP_THREADS)
+    torch.set_num_interop_threads(INTER_OP_THREADS)
+
+    try:
+        load_lama_model()
+    except Exception as e:
+        result_queue.put(('failed', worker_id, None, f"model load failed: {e}"))
+        return
+    try:
+        warmup_ms = run_warmup_steps(f'lama-worker-{worker_id}', warmup_steps())
+    except RuntimeError as e:
+        result_queue.put(('failed', worker_id, None, str(e)))
+        return
+    LOGGER.info(f"LaMa worker {worker_id} ready (cpus={cpu_ids or 'any'})")
+    result_queue.put(('ready', worker_id, warmup_ms, None))
+
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        job_id, data, request_id = job
         try:
-            output_image_path = os.path.join(DEBUG_OUTPUT_DIR, f'output_inpainted_{request_id}.png')
-            Image.fromarray(cur_res_np, 'RGB').save(output_image_path)
-            LOGGER.info(f"Saved output image to {output_image_path}")
-        except Exception as file_save_error:
-            LOGGER.warning(f"Could not save output image: {file_save_error}")
+            cur_res_np = inpaint_payload(data, request_id)
+            result_queue.put((job_id, worker_id, encode_image_to_base64(cur_res_np), None))
+        except Exception as e:
+            LOGGER.error(f"LaMa worker {worker_id} failed: {e}", exc_info=True)
+            result_queue.put((job_id, worker_id, None, str(e)))
+
 
-        # 5. Encode and return
-        inpainted_b64_data_url = encode_image_to_base64(cur_res_np)
+class InpaintWorkerPool:
+    """
+    Front-process dispatcher for a pool of model worker processes.
+    Each job goes to the worker with the fewest in-flight requests.
+    """
+
+    def __init__(self, num_workers, pin_cpus):
+        ctx = multiprocessing.get_context('spawn')
+        self.result_queue = ctx.Queue()
+        self.job_queues = []
+        self.processes = []
+        self.in_flight = [0] * num_workers
+        # Per worker: starting | ready | failed (model load or warm-up) | dead (process exited)
+        self.state = ['starting'] * num_workers
+        self.errors = [None] * num_workers
+        self.waiting = {}
+        self.lock = threading.Lock()
+        self.job_ids = itertools.count()
+
+        cpu_count = os.cpu_count() or 1
+        for worker_id in range(num_workers):
+            cpu_ids = None
+            if pin_cpus:
+                first = (worker_id * INTRA_OP_THREADS) % cpu_count
+                cpu_ids = {(first + i) % cpu_count for i in range(INTRA_OP_THREADS)}
+            job_queue = ctx.Queue()
+            process = ctx.Process(target=_worker_main, args=(worker_id, cpu_ids, job_queue, self.result_queue),
+                                  name=f'lama-worker-{worker_id}', daemon=True)
+            process.start()
+            self.job_queues.append(job_queue)
+            self.processes.append(process)
+
+        self.collector = threading.Thread(target=self._collect_results, name='lama-pool-results', daemon=True)
+        self.collector.start()
+
+    def _update_health(self):
+        """The pool is ready while any worker is; it fails only once no worker is ready or starting. Call with lock held."""
+        if 'ready' in self.state:
+            HEALTH.mark_ready()
+        elif 'starting' not in self.state:
+            HEALTH.failed('; '.join(f"worker {i}: {error}" for i, error in enumerate(self.errors) if error))
+
+    def _fail_dead_workers(self):
+        """Marks workers that exited as dead and fails their in-flight jobs, so their callers stop waiting."""
+        failed = []
+        with self.lock:
+            for worker_id, process in enumerate(self.processes):
+                if self.state[worker_id] == 'dead' or process.is_alive():
+                    continue
+                LOGGER.error(f"LaMa worker {worker_id} exited with code {process.exitcode}")
+                self.state[worker_id] = 'dead'
+                self.errors[worker_id] = self.errors[worker_id] or f"exited with code {process.exitcode}"
+                self.in_flight[worker_id] = 0
+                for job_id, waiter in list(self.waiting.items()):
+                    if waiter['worker'] == worker_id:
+                        failed.append(self.waiting.pop(job_id))
+                self._update_health()
+        for waiter in failed:
+            waiter['error'] = 'LaMa worker process exited'
+            waiter['done'].set()
+
+    def _collect_results(self):
+        while True:
+            self._fail_dead_workers()
+            try:
+                job_id, worker_id, result, error = self.result_queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            with self.lock:
+                if job_id == 'ready':
+                    self.state[worker_id] = 'ready'
+                    for label, ms in result.items():
+                        HEALTH.record_warmup(f"worker{worker_id}:{label}", ms)
+                    self._update_health()
+                    continue
+                if job_id == 'failed':
+                    LOGGER.error(f"LaMa worker {worker_id} failed to start: {error}")
+                    self.state[worker_id] = 'failed'
+                    self.errors[worker_id] = error
+                    self._update_health()
+                    continue
+                if self.state[worker_id] != 'dead':
+                    self.in_flight[worker_id] -= 1
+                waiter = self.waiting.pop(job_id, None)
+            if waiter is not None:
+                waiter['result'], waiter['error'] = result, error
+                waiter['done'].set()
+
+    def submit(self, data, request_id):
+        """Runs one /inpaint payload on the least busy ready worker and returns the PNG data URL."""
+        # Catches a crashed worker now rather than on the collector's next pass
+        self._fail_dead_workers()
+        job_id = next(self.job_ids)
+        with self.lock:
+            candidates = [i for i, state in enumerate(self.state) if state == 'ready']
+            if not candidates:
+                raise RuntimeError('No LaMa worker is ready')
+            worker_id = min(candidates, key=lambda i: self.in_flight[i])
+            waiter = {'done': threading.Event(), 'result': None, 'error': None, 'worker': worker_id}
+            self.in_flight[worker_id] += 1
+            self.waiting[job_id] = waiter
+        self.job_queues[worker_id].put((job_id, data, request_id))
+
+        if not waiter['done'].wait(JOB_TIMEOUT_S):
+            with self.lock:
+                self.waiting.pop(job_id, None)
+            raise TimeoutError(f"LaMa worker {worker_id} did not answer within {JOB_TIMEOUT_S:.0f} s")
+        if waiter['error'] is not None:
+            raise RuntimeError(waiter['error'])
+        return waiter['result']
+
+# --- Flask Endpoint ---
+
+@app.route('/inpaint', methods=['POST'])
+def inpaint_api():
+    # Return 503 if the model failed to load at startup
+    if LAMA_MODEL is None and WORKER_POOL is None:
+        return jsonify({'error': 'LaMa model not loaded'}), 503
+
+    data = request.json
+
+    # Generate a unique ID for this request for filenames
+    timestamp = int(time.time() * 1000)
+    request_id = f"req_{timestamp}"
+
+    try:
+        # An "image_ref" stands in for the inline image; the mask always travels inline
+        if data.get('image_ref'):
+            image_bytes = BLOBS.resolve(data, 'image')
+            data['image'] = 'data:image/png;base64,' + base64.b64encode(image_bytes).decode('ascii')
+
+        # 1. Identical image + mask + settings return the stored PNG without decoding
+        cache_key = None
+        if RESULT_CACHE is not None:
+            cache_key = inpaint_cache_key(data)
+            cached = RESULT_CACHE.get(cache_key)
+            if cached is not None:
+                LOGGER.info(f"Inpaint cache hit for {request_id}")
+                return jsonify({
+                    'status': 'success',
+                    'inpainted_image': cached,
+                    'cached': True
+                })
+
+        if WORKER_POOL is not None:
+            inpainted_b64_data_url = WORKER_POOL.submit(data, request_id)
+        else:
+            cur_res_np = inpaint_payload(data, request_id)
+
+            # 5. Encode and return
+            inpainted_b64_data_url = encode_image_to_base64(cur_res_np)
+
+        if cache_key is not None:
+            RESULT_CACHE.put(cache_key, inpainted_b64_data_url)
 
         return jsonify({
             'status': 'success',
             'inpainted_image': inpainted_b64_data_url
         })
 
+    except MissingBlobError as e:
+        return missing_blob_response(e)
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
     except Exception as e:
         LOGGER.error(f"Inpainting API failed: {e}", exc_info=True)
         return jsonify({'error': f'Internal server error during inference: {str(e)}'}), 500
@@ -252,13 +911,24 @@ def inpaint_api():
 
 
 if __name__ == '__main__':
+    if CACHE_MEMORY_ITEMS > 0:
+        RESULT_CACHE = InpaintResultCache(CACHE_MEMORY_ITEMS, CACHE_DISK_ITEMS, CACHE_DIR)
+
     # 1. Load the model once at startup
     try:
-        load_lama_model()
+        if NUM_WORKERS > 0:
+            # Each worker process loads and warms up its own copy of the model
+            HEALTH.set_state('loading')
+            WORKER_POOL = InpaintWorkerPool(NUM_WORKERS, PIN_CPUS)
+        else:
+            torch.set_num_threads(INTRA_OP_THREADS)
+            torch.set_num_interop_threads(INTER_OP_THREADS)
+            load_models()
+            HEALTH.start_warm_up(warmup_steps())
     except Exception:
         # The model failed to load, LAMA_MODEL remains None. 
         # The /inpaint endpoint will correctly return 503.
         pass 
     
     # 2. Run Flask app on port 5002
-    app.run(host='0.0.0.0', port=5002, debug=False)
+    app.run(host='0.0.0.0', port=5002, debug=False, threaded=True)
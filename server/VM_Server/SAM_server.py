@@ -8,33 +8,329 @@ import torch
 import json
 from io import BytesIO
 import base64
+import hashlib
+import os
+import threading
+import uuid
 import requests
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from sam2.build_sam import build_sam2
 from sam2.sam2_image_predictor import SAM2ImagePredictor
+from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator
+from sam_onnx import OnnxSamPredictor, sam2_paths
+from image_ingest import decode_image
+from service_health import ServiceHealth, no_model_hold, parse_shapes, register_health_routes
+from blob_store import MissingBlobError, create_blob_store, missing_blob_response, register_blob_routes
+from admission import AdmissionRejected, admission_rejected_response, admitted, register_admission_routes
 from segment_anything import sam_model_registry
 
 # Initialize Flask app
 app = Flask(__name__)
 CORS(app)
 
+# Images uploaded once via PUT /blobs/<sha256>, referenced later as "image_ref"
+BLOBS = create_blob_store()
+register_blob_routes(app, BLOBS)
+# vm_host.py replaces this so background indexing keeps the model resident until it finishes
+HOLD_MODELS = no_model_hold
+
+# /healthz and /readyz; ready once the model is loaded and warmed up
+HEALTH = ServiceHealth('sam')
+register_health_routes(app, HEALTH)
+# Clicks are admitted ahead of inpainting, rerender and 3D work (GET /admission)
+register_admission_routes(app)
+
 
 # SAM Model Configuration
-sam2_checkpoint = "/home/ram227_njit_edu/SAM/sam2/checkpoints/sam2.1_hiera_large.pt"
-model_cfg = "configs/sam2.1/sam2.1_hiera_l.yaml"
+# SAM_BACKEND: "torch" (SAM2ImagePredictor) or "onnx" (ONNX Runtime, CPU)
+# SAM_MODEL_SIZE: tiny | small | base_plus | large
+SAM_BACKEND = os.environ.get('SAM_BACKEND', 'torch')
+SAM_MODEL_SIZE = os.environ.get('SAM_MODEL_SIZE', 'large')
+SAM_ONNX_DIR = os.environ.get('SAM_ONNX_DIR', f"onnx/sam2_{SAM_MODEL_SIZE}")
+SAM_ONNX_INT8_DECODER = os.environ.get('SAM_ONNX_INT8_DECODER', '1') == '1'
+SAM_NUM_THREADS = int(os.environ.get('SAM_NUM_THREADS', 0)) or None
+sam2_checkpoint, model_cfg = sam2_paths(SAM_MODEL_SIZE)
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
+if SAM_NUM_THREADS:
+    torch.set_num_threads(SAM_NUM_THREADS)
+
+
+# SAM model, loaded by load_models() at startup (or on demand by vm_host.py)
+sam2_model = None
+predictor = None
+
+
+def load_models():
+    """Loads the SAM predictor (and the torch model behind it) into the module globals."""
+    global sam2_model, predictor
+    with HEALTH.loading():
+        if SAM_BACKEND == 'onnx':
+            # The torch model is only needed for automatic mask generation (/index_image)
+            sam2_model = None
+            predictor = OnnxSamPredictor(SAM_ONNX_DIR, quantized_decoder=SAM_ONNX_INT8_DECODER,
+                                         num_threads=SAM_NUM_THREADS)
+        else:
+            sam2_model = build_sam2(model_cfg, sam2_checkpoint, device=device)
+            predictor = SAM2ImagePredictor(sam2_model)
+
+
+def release_models():
+    """Drops every reference to the SAM model so its memory can be reclaimed."""
+    global sam2_model, predictor, mask_generator, predictor_image_key
+    with PREDICTOR_LOCK:
+        predictor_image_key = None
+        predictor = None
+    sam2_model = None
+    mask_generator = None
+
+# Image sizes (WxH) to encode + decode once at startup
+SAM_WARMUP_SHAPES = parse_shapes(os.environ.get('SAM_WARMUP_SHAPES', '1024x1024'))
+
+
+MASK_FORMATS = ('rle', 'bitmask', 'png')
+
+# Automatic mask index (precomputed on new images, used for click-to-object lookup)
+MASK_INDEX_MAX_IMAGES = int(os.environ.get('SAM_MASK_INDEX_MAX_IMAGES', 32))
+MASK_INDEX = OrderedDict()  # image key -> {"shape", "crops", "boxes", "areas", "scores"}
+MASK_INDEX_PENDING = set()
+MASK_INDEX_LOCK = threading.Lock()
+# One worker so background indexing never runs more than one generation at a time
+INDEX_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+mask_generator = None
+
+# Predictor state: the image currently encoded and the best low-res logits per session
+MASK_LOGITS_MAX_ENTRIES = int(os.environ.get('SAM_MASK_LOGITS_MAX_ENTRIES', 256))
+MASK_LOGITS = OrderedDict()  # handle -> (image key, 1x256x256 float32 logits)
+PREDICTOR_LOCK = threading.Lock()
+predictor_image_key = None
+
+
+def encode_mask_rle(mask):
+    """Encodes a boolean HxW mask as uncompressed COCO-style RLE (column-major, starting with zeros)."""
+    height, width = mask.shape
+    flat = mask.ravel(order='F')
+    change_idx = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    boundaries = np.concatenate(([0], change_idx, [flat.size]))
+    counts = np.diff(boundaries).tolist()
+    if flat.size and flat[0]:
+        counts = [0] + counts
+    return {"size": [height, width], "counts": counts}
+
+
+def encode_mask_bitmask(mask):
+    """Encodes a boolean HxW mask as a row-major packed bitmask (1 bit per pixel, base64)."""
+    height, width = mask.shape
+    packed = np.packbits(mask.ravel())
+    return {"size": [height, width], "bits": base64.b64encode(packed.tobytes()).decode("utf-8")}
+
+
+def encode_mask_png(mask):
+    """Encodes a boolean HxW mask as a base64 grayscale PNG (legacy format)."""
+    mask_buffer = BytesIO()
+    Image.fromarray(mask.astype(np.uint8) * 255).save(mask_buffer, format="PNG")
+    return base64.b64encode(mask_buffer.getvalue()).decode("utf-8")
+
+
+def encode_mask(mask, mask_format):
+    if mask_format == 'rle':
+        return encode_mask_rle(mask)
+    if mask_format == 'bitmask':
+        return encode_mask_bitmask(mask)
+    return encode_mask_png(mask)
+
+
+def mask_bbox(mask, width, height):
+    """Returns the normalized bounding box of a boolean mask, or None if it is empty."""
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    return {
+        "minX": int(cols[0]) / width,
+        "minY": int(rows[0]) / height,
+        "maxX": int(cols[-1]) / width,
+        "maxY": int(rows[-1]) / height
+    }
+
+
+def render_visualization(img_array, mask, pixel_points):
+    """Builds the green overlay with click markers and returns it as a base64 PNG."""
+    color_mask = np.zeros_like(img_array)
+    color_mask[mask] = [0, 255, 0]  # Green mask
+    visualization = cv2.addWeighted(img_array, 0.5, color_mask, 0.5, 0)
+
+    # Highlight user clicks
+    for px, py in pixel_points:
+        cv2.circle(visualization, (px, py), 10, (255, 0, 0), -1)
+
+    vis_buffer = BytesIO()
+    Image.fromarray(visualization).save(vis_buffer, format="PNG")
+    return base64.b64encode(vis_buffer.getvalue()).decode("utf-8")
+
+
+def fetch_image_bytes(image_url):
+    """Returns the encoded image bytes from a data URL or a remote URL."""
+    if image_url.startswith("data:image"):
+        header, encoded = image_url.split(",", 1)
+        return base64.b64decode(encoded)
+    response = requests.get(image_url)
+    return response.content
+
+
+def request_image_bytes(data):
+    """Image bytes for a request: the stored blob for "image_ref", else fetched from "image_url"."""
+    if data.get('image_ref'):
+        return BLOBS.resolve(data, 'image_url')
+    return fetch_image_bytes(data.get('image_url'))
+
+
+def load_image_array(image_url, image_bytes=None):
+    """Loads an RGB image from a data URL or a remote URL into a HxWx3 uint8 array."""
+    if image_bytes is None:
+        image_bytes = fetch_image_bytes(image_url)
+    return decode_image(image_bytes, 'RGB')
+
+
+def to_pixel_points(input_points, width, height):
+    """Converts normalized [x, y] points to clamped pixel coordinates."""
+    pixel_points = []
+    for point in input_points:
+        x, y = point
+        px = min(max(int(x * width), 0), width - 1)
+        py = min(max(int(y * height), 0), height - 1)
+        pixel_points.append([px, py])
+    return pixel_points
 
-# Load SAM model
-try:
-    sam2_model = build_sam2(model_cfg, sam2_checkpoint, device=device)
-    predictor = SAM2ImagePredictor(sam2_model)
 
+def to_pixel_box(box, width, height):
+    """Converts a normalized [minX, minY, maxX, maxY] box to pixel coordinates."""
+    x0, y0, x1, y1 = box
+    return [x0 * width, y0 * height, x1 * width, y1 * height]
+
+
+def image_key(image_bytes):
+    return hashlib.sha1(image_bytes).hexdigest()
 
-except Exception as e:
-    raise
 
+def get_mask_generator():
+    global mask_generator
+    if mask_generator is None:
+        if sam2_model is None:
+            raise RuntimeError("Automatic mask generation requires the torch backend")
+        mask_generator = SAM2AutomaticMaskGenerator(sam2_model)
+    return mask_generator
 
 
+def build_mask_index(key, img_array, release_hold):
+    """Runs automatic mask generation and stores the masks with their boxes for fast lookup."""
+    try:
+        # Speculative work: yields to every interactive request
+        with admitted('background'):
+            records = get_mask_generator().generate(img_array)
+
+        # Masks are stored cropped to their boxes to keep the index small
+        boxes = np.zeros((len(records), 4), dtype=np.int32)
+        crops = []
+        for i, record in enumerate(records):
+            x, y, w, h = (int(v) for v in record['bbox'])
+            boxes[i] = [x, y, x + w, y + h]
+            crops.append(record['segmentation'][y:y + h + 1, x:x + w + 1].copy())
+
+        entry = {
+            "shape": img_array.shape[:2],
+            "crops": crops,
+            "boxes": boxes,
+            "areas": np.array([r['area'] for r in records], dtype=np.int64),
+            "scores": np.array([r['predicted_iou'] for r in records], dtype=np.float32)
+        }
+
+        with MASK_INDEX_LOCK:
+            MASK_INDEX[key] = entry
+            MASK_INDEX.move_to_end(key)
+            while len(MASK_INDEX) > MASK_INDEX_MAX_IMAGES:
+                MASK_INDEX.popitem(last=False)
+    finally:
+        with MASK_INDEX_LOCK:
+            MASK_INDEX_PENDING.discard(key)
+        release_hold()
+
+
+def lookup_indexed_mask(key, pixel_points, input_labels):
+    """
+    Returns (mask, score) for the best-scoring indexed mask that contains every
+    positive point and none of the negative points, or None on a miss.
+    """
+    with MASK_INDEX_LOCK:
+        entry = MASK_INDEX.get(key)
+        if entry is not None:
+            MASK_INDEX.move_to_end(key)
+    if entry is None or not pixel_points or len(entry['crops']) == 0:
+        return None
+
+    points = np.array(pixel_points)
+    labels = np.array(input_labels)
+    positives = points[labels == 1]
+    negatives = points[labels != 1]
+    if len(positives) == 0:
+        return None
+
+    # Box pre-filter: candidates must contain all positive points
+    boxes = entry['boxes']
+    candidates = np.ones(len(boxes), dtype=bool)
+    for px, py in positives:
+        candidates &= (boxes[:, 0] <= px) & (px <= boxes[:, 2]) & (boxes[:, 1] <= py) & (py <= boxes[:, 3])
+
+    def inside(idx, px, py):
+        x0, y0 = boxes[idx, :2]
+        crop = entry['crops'][idx]
+        cy, cx = py - y0, px - x0
+        return 0 <= cy < crop.shape[0] and 0 <= cx < crop.shape[1] and bool(crop[cy, cx])
+
+    best = None
+    for idx in np.flatnonzero(candidates):
+        if best is not None and entry['scores'][idx] <= entry['scores'][best]:
+            continue
+        if all(inside(idx, px, py) for px, py in positives) and \
+                not any(inside(idx, px, py) for px, py in negatives):
+            best = idx
+    if best is None:
+        return None
+
+    x0, y0 = boxes[best, :2]
+    crop = entry['crops'][best]
+    mask = np.zeros(entry['shape'], dtype=bool)
+    mask[y0:y0 + crop.shape[0], x0:x0 + crop.shape[1]] = crop
+    return mask, float(entry['scores'][best])
+
+
+def set_predictor_image(key, img_array):
+    """Encodes the image unless the predictor already holds it. Call with PREDICTOR_LOCK held."""
+    global predictor_image_key
+    if predictor_image_key != key:
+        predictor_image_key = None
+        predictor.set_image(img_array)
+        predictor_image_key = key
+
+
+def store_mask_logits(key, logits):
+    """Keeps the low-res logits of a mask and returns a handle for the next refinement click."""
+    handle = uuid.uuid4().hex
+    MASK_LOGITS[handle] = (key, logits.astype(np.float32, copy=False))
+    while len(MASK_LOGITS) > MASK_LOGITS_MAX_ENTRIES:
+        MASK_LOGITS.popitem(last=False)
+    return handle
+
+
+def load_mask_logits(handle, key):
+    """Returns the stored logits for a handle if it belongs to this image, otherwise None."""
+    stored = MASK_LOGITS.get(handle) if handle else None
+    if stored is None or stored[0] != key:
+        return None
+    MASK_LOGITS.move_to_end(handle)
+    return stored[1]
+
 
 @app.route('/segment', methods=['POST'])
 def segment_with_sam():
@@ -43,96 +339,222 @@ def segment_with_sam():
         image_url = data.get('image_url')
         input_points = data.get('input_points', [])
         input_labels = data.get('input_labels', [])
+        mask_format = data.get('mask_format', 'rle')
+        return_visualization = bool(data.get('return_visualization', False))
+        use_index = bool(data.get('use_index', True))
+        logits_handle = data.get('logits_handle')
 
-        # Download and prepare image
-        if image_url.startswith("data:image"):
-            header, encoded = image_url.split(",", 1)
-            img = Image.open(BytesIO(base64.b64decode(encoded))).convert("RGB")
-        else:
-            response = requests.get(image_url)
-            img = Image.open(BytesIO(response.content)).convert("RGB")
+        if mask_format not in MASK_FORMATS:
+            return jsonify({'error': f"Unsupported mask_format '{mask_format}'"}), 400
 
-        img_array = np.array(img)
+        # Download and prepare image
+        image_bytes = request_image_bytes(data)
+        img_array = load_image_array(image_url, image_bytes)
         height, width = img_array.shape[:2]
 
         # Convert normalized coordinates to pixel coordinates
-        pixel_points = []
-        for point in input_points:
-            x, y = point
-            px = min(max(int(x * width), 0), width - 1)
-            py = min(max(int(y * height), 0), height - 1)
-            pixel_points.append([px, py])
-
-        # Convert to numpy arrays for SAM
-        point_coords = np.array(pixel_points)
-        point_labels = np.array(input_labels)
-
-        # Predict masks
-        predictor.set_image(img_array)
-        masks, scores, _ = predictor.predict(
-            point_coords=point_coords,
-            point_labels=point_labels,
-            multimask_output=True
-        )
+        pixel_points = to_pixel_points(input_points, width, height)
+
+        key = image_key(image_bytes)
+        new_logits_handle = None
+
+        # Try the precomputed mask index first, fall back to a live predict
+        indexed = None
+        if use_index and not logits_handle:
+            indexed = lookup_indexed_mask(key, pixel_points, input_labels)
+
+        if indexed is not None:
+            source = "index"
+            masks = indexed[0][None]
+            scores = np.array([indexed[1]])
+        else:
+            # Convert to numpy arrays for SAM
+            point_coords = np.array(pixel_points)
+            point_labels = np.array(input_labels)
+
+            with admitted('segment'), PREDICTOR_LOCK:
+                # Refinement clicks start from the previous best mask's logits
+                mask_input = load_mask_logits(logits_handle, key)
+
+                # Predict masks (the image is only re-encoded when it changes)
+                set_predictor_image(key, img_array)
+                masks, scores, low_res_logits = predictor.predict(
+                    point_coords=point_coords,
+                    point_labels=point_labels,
+                    mask_input=mask_input,
+                    # With a prior mask a single refined output is enough
+                    multimask_output=mask_input is None
+                )
+
+                best = int(np.argmax(scores))
+                new_logits_handle = store_mask_logits(key, low_res_logits[best][None])
+
+            source = "refine" if mask_input is not None else "predict"
 
         # Process masks
         mask_data = []
         for i, (mask, score) in enumerate(zip(masks, scores)):
-            # Create visualization overlay
-            visualization = img_array.copy()
-            color_mask = np.zeros_like(visualization)
-            color_mask[mask == 1] = [0, 255, 0]  # Green mask
-            visualization = cv2.addWeighted(visualization, 0.5, color_mask, 0.5, 0)
+            mask = mask > 0
 
-            # Highlight user clicks
-            for px, py in pixel_points:
-                cv2.circle(visualization, (px, py), 10, (255, 0, 0), -1)
+            entry = {
+                "score": float(score),
+                "mask": encode_mask(mask, mask_format),
+                "mask_format": mask_format,
+                "bbox": mask_bbox(mask, width, height)
+            }
+
+            # Server-side overlays are opt-in; the client can draw the mask itself
+            if return_visualization:
+                entry["visualization"] = render_visualization(img_array, mask, pixel_points)
 
-            # Encode visualization as PNG
-            vis_buffer = BytesIO()
-            Image.fromarray(visualization).save(vis_buffer, format="PNG")
-            vis_base64 = base64.b64encode(vis_buffer.getvalue()).decode("utf-8")
+            mask_data.append(entry)
 
-            # Encode mask itself as PNG
-            mask_img = Image.fromarray((mask * 255).astype(np.uint8))
-            mask_buffer = BytesIO()
-            mask_img.save(mask_buffer, format="PNG")
-            mask_base64 = base64.b64encode(mask_buffer.getvalue()).decode("utf-8")
+        return jsonify({
+            "status": "success",
+            "masks": mask_data,
+            "source": source,
+            "logits_handle": new_logits_handle,
+            "debug": {
+                "input_points": input_points,
+                "pixel_points": pixel_points,
+                "image_size": [width, height]
+            }
+        })
 
+    except MissingBlobError as e:
+        return missing_blob_response(e)
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
+    except Exception as e:
+        return jsonify({
+            'error': str(e),
+            'type': type(e).__name__
+        }), 500
 
 
+@app.route('/index_image', methods=['POST'])
+def index_image():
+    """Queues automatic mask generation for an image so later clicks can hit the index."""
+    try:
+        data = request.json
+        image_bytes = request_image_bytes(data)
+        key = image_key(image_bytes)
+
+        with MASK_INDEX_LOCK:
+            if key in MASK_INDEX:
+                return jsonify({"status": "indexed", "image_key": key})
+            if key in MASK_INDEX_PENDING:
+                return jsonify({"status": "pending", "image_key": key})
+            MASK_INDEX_PENDING.add(key)
+
+        img_array = load_image_array(None, image_bytes)
+        release_hold = HOLD_MODELS()
+        try:
+            INDEX_EXECUTOR.submit(build_mask_index, key, img_array, release_hold)
+        except Exception:
+            release_hold()
+            raise
+        return jsonify({"status": "queued", "image_key": key}), 202
+
+    except MissingBlobError as e:
+        return missing_blob_response(e)
+    except Exception as e:
+        return jsonify({
+            'error': str(e),
+            'type': type(e).__name__
+        }), 500
 
 
+@app.route('/segment_batch', methods=['POST'])
+def segment_batch_with_sam():
+    """
+    Segments several objects in one image with a single image encode.
+    Each prompt may carry points (+labels), a box, or both; prompts of the same
+    kind are sent to the predictor together as one batched call.
+    """
+    try:
+        data = request.json
+        image_url = data.get('image_url')
+        prompts = data.get('prompts', [])
+        multimask_output = bool(data.get('multimask_output', False))
+        mask_format = data.get('mask_format', 'rle')
 
+        if mask_format not in MASK_FORMATS:
+            return jsonify({'error': f"Unsupported mask_format '{mask_format}'"}), 400
+        if not prompts:
+            return jsonify({'error': 'No prompts provided'}), 400
 
-            ys, xs = np.where(mask == 1)
-            if len(xs) > 0 and len(ys) > 0:
-                bbox = {
-                    "minX": int(xs.min())/ width,
-                    "minY": int(ys.min())/height,
-                    "maxX": int(xs.max())/width,
-                    "maxY": int(ys.max())/height
-                }
-            else:
-                bbox = None
+        image_bytes = request_image_bytes(data)
+        img_array = load_image_array(image_url, image_bytes)
+        height, width = img_array.shape[:2]
 
-            mask_data.append({
-                "score": float(score),
-                "mask": mask_base64,
-                "visualization": vis_base64,
-                "bbox": bbox  # NEW
-            })
+        # Group prompts by kind so each group is a single batched predict call
+        groups = {}
+        for index, prompt in enumerate(prompts):
+            points = prompt.get('points') or []
+            box = prompt.get('box')
+            if not points and box is None:
+                return jsonify({'error': f'Prompt {index} has neither points nor box'}), 400
+            groups.setdefault((bool(points), box is not None), []).append(index)
+
+        with admitted('segment'), PREDICTOR_LOCK:
+            set_predictor_image(image_key(image_bytes), img_array)
+
+            objects = [None] * len(prompts)
+            for (has_points, has_box), indices in groups.items():
+                point_coords = point_labels = boxes = None
+
+                if has_points:
+                    # Pad every point set to the same length; label -1 marks padding for SAM
+                    max_points = max(len(prompts[i]['points']) for i in indices)
+                    point_coords = np.zeros((len(indices), max_points, 2), dtype=np.float32)
+                    point_labels = np.full((len(indices), max_points), -1, dtype=np.int32)
+                    for row, i in enumerate(indices):
+                        pts = to_pixel_points(prompts[i]['points'], width, height)
+                        labels = prompts[i].get('labels') or [1] * len(pts)
+                        point_coords[row, :len(pts)] = pts
+                        point_labels[row, :len(pts)] = labels
+
+                if has_box:
+                    boxes = np.array([to_pixel_box(prompts[i]['box'], width, height) for i in indices],
+                                     dtype=np.float32)
+
+                masks, scores, _ = predictor.predict(
+                    point_coords=point_coords,
+                    point_labels=point_labels,
+                    box=boxes,
+                    multimask_output=multimask_output
+                )
+
+                # A single prompt comes back without the batch dimension
+                if masks.ndim == 3:
+                    masks, scores = masks[None], scores[None]
+
+                for row, i in enumerate(indices):
+                    best = int(np.argmax(scores[row]))
+                    mask = masks[row, best] > 0
+                    objects[i] = {
+                        "index": i,
+                        "score": float(scores[row, best]),
+                        "mask": encode_mask(mask, mask_format),
+                        "mask_format": mask_format,
+                        "bbox": mask_bbox(mask, width, height)
+                    }
 
         return jsonify({
             "status": "success",
-            "masks": mask_data,
+            "objects": objects,
             "debug": {
-                "input_points": input_points,
-                "pixel_points": pixel_points,
+                "num_prompts": len(prompts),
+                "num_batches": len(groups),
                 "image_size": [width, height]
             }
         })
 
+    except MissingBlobError as e:
+        return missing_blob_response(e)
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
     except Exception as e:
         return jsonify({
             'error': str(e),
@@ -140,7 +562,29 @@ def segment_with_sam():
         }), 500
 
 
+def warmup_steps():
+    """One image encode plus a single-point decode per warm-up shape."""
+    def run(width, height):
+        global predictor_image_key
+        img_array = np.random.randint(0, 256, (height, width, 3), dtype=np.uint8)
+        with PREDICTOR_LOCK:
+            predictor_image_key = None
+            predictor.set_image(img_array)
+            predictor.predict(
+                point_coords=np.array([[width // 2, height // 2]], dtype=np.float32),
+                point_labels=np.array([1], dtype=np.int32),
+                multimask_output=True
+            )
+            # Force the next real request to encode its own image
+            predictor_image_key = None
+
+    return [(f"{width}x{height}", lambda width=width, height=height: run(width, height))
+            for width, height in SAM_WARMUP_SHAPES]
+
+
 if __name__ == '__main__':
+    load_models()
+    HEALTH.start_warm_up(warmup_steps())
     app.run(host='0.0.0.0', port=5000, threaded=True)
 
 
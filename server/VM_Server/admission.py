@@ -0,0 +1,255 @@
+"""
+Priority-aware admission control for inference calls on the VM services.
+
+Every model call is admitted under a priority class, highest first:
+
+    segment     interactive SAM clicks
+    inpaint     LaMa
+    rerender    ControlNet
+    3d          LGM / MVDream
+    background  speculative work (SAM automatic mask index)
+
+At most ADMISSION_SLOTS calls run at once, and a free slot always goes to the
+oldest request of the highest waiting class. Each class has a bounded queue
+(ADMISSION_QUEUE_<CLASS>); a request arriving at a full queue is rejected with
+429 instead of piling up. Long jobs call slot.checkpoint() between inference
+calls (sampler steps, pipeline stages): while a higher class is waiting it
+gives up the slot there and resumes, first in its class, once it gets it back.
+
+The controller is per process, so everything served by vm_host.py shares one.
+Separate service processes share one by running
+
+    ADMISSION_ADDRESS=127.0.0.1:5099 python admission.py
+
+and starting each service with the same ADMISSION_ADDRESS (and ADMISSION_AUTHKEY).
+"""
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing.managers import BaseManager
+
+from flask import jsonify
+
+PRIORITY_CLASSES = ('segment', 'inpaint', 'rerender', '3d', 'background')
+DEFAULT_QUEUE_LIMITS = {'segment': 64, 'inpaint': 16, 'rerender': 8, '3d': 4, 'background': 4}
+
+ADMISSION_SLOTS = int(os.environ.get('ADMISSION_SLOTS', 1))
+# A running call not heard from (admitted or checkpointed) for this long is presumed
+# dead and its slot reclaimed; only matters for a shared controller whose client crashed
+ADMISSION_LEASE_S = float(os.environ.get('ADMISSION_LEASE_S', 900))
+ADMISSION_ADDRESS = os.environ.get('ADMISSION_ADDRESS')
+ADMISSION_AUTHKEY = os.environ.get('ADMISSION_AUTHKEY', 'vm-admission').encode('utf-8')
+
+
+class AdmissionRejected(RuntimeError):
+    """Raised when a priority class's queue is full."""
+
+    def __init__(self, priority_class, limit):
+        super().__init__(priority_class, limit)
+        self.priority_class = priority_class
+        self.limit = limit
+
+    def __str__(self):
+        return f"The '{self.priority_class}' queue is full ({self.limit} waiting); retry shortly"
+
+
+class AdmissionController:
+    """Hands out ADMISSION_SLOTS inference slots by priority class, with bounded per-class queues."""
+
+    def __init__(self, slots, queue_limits, lease_s):
+        self.slots = slots
+        self.queue_limits = queue_limits
+        self.lease_s = lease_s
+        self.cond = threading.Condition()
+        self.tickets = {}   # ticket -> priority class, from acquire() to release()
+        self.running = {}   # ticket -> last time the holder was heard from
+        self.waiting = {c: deque() for c in PRIORITY_CLASSES}
+        self.ticket_ids = itertools.count(1)
+        self.stats = {c: {'admitted': 0, 'rejected': 0, 'preempted': 0, 'wait_ms_total': 0.0, 'max_wait_ms': 0.0}
+                      for c in PRIORITY_CLASSES}
+
+    def _head(self):
+        for priority_class in PRIORITY_CLASSES:
+            if self.waiting[priority_class]:
+                return self.waiting[priority_class][0]
+        return None
+
+    def _outranked(self, priority_class):
+        """True when a higher class is waiting and no slot is free for it."""
+        higher = PRIORITY_CLASSES[:PRIORITY_CLASSES.index(priority_class)]
+        return len(self.running) >= self.slots and any(self.waiting[c] for c in higher)
+
+    def _expire_leases(self):
+        now = time.monotonic()
+        for ticket, last_seen in list(self.running.items()):
+            if now - last_seen > self.lease_s:
+                print(f"[WARN] admission: reclaiming slot of stale {self.tickets.get(ticket)} call {ticket}")
+                del self.running[ticket]
+
+    def _wait_turn(self, ticket):
+        """Blocks until ticket heads the queue and a slot is free, then runs it. Call with cond held."""
+        while not (len(self.running) < self.slots and self._head() == ticket):
+            self.cond.wait(1.0)
+            self._expire_leases()
+        self.waiting[self.tickets[ticket]].popleft()
+        self.running[ticket] = time.monotonic()
+        # With several slots the next ticket in line may be able to start too
+        self.cond.notify_all()
+
+    def acquire(self, priority_class):
+        """Queues a call under priority_class and returns its ticket once it holds a slot."""
+        if priority_class not in self.waiting:
+            raise ValueError(f"Unknown priority class '{priority_class}'")
+        start = time.perf_counter()
+        with self.cond:
+            limit = self.queue_limits[priority_class]
+            if len(self.waiting[priority_class]) >= limit:
+                self.stats[priority_class]['rejected'] += 1
+                raise AdmissionRejected(priority_class, limit)
+            ticket = next(self.ticket_ids)
+            self.tickets[ticket] = priority_class
+            self.waiting[priority_class].append(ticket)
+            self._wait_turn(ticket)
+
+            wait_ms = (time.perf_counter() - start) * 1000.0
+            stats = self.stats[priority_class]
+            stats['admitted'] += 1
+            stats['wait_ms_total'] += wait_ms
+            stats['max_wait_ms'] = max(stats['max_wait_ms'], wait_ms)
+            return ticket
+
+    def checkpoint(self, ticket):
+        """
+        Called between inference calls. Yields the slot while a higher class is
+        waiting and returns once it is held again; True if the call was preempted.
+        """
+        with self.cond:
+            priority_class = self.tickets[ticket]
+            if ticket in self.running:
+                self.running[ticket] = time.monotonic()
+                if not self._outranked(priority_class):
+                    return False
+                del self.running[ticket]
+                self.stats[priority_class]['preempted'] += 1
+                self.cond.notify_all()
+            # Back in line ahead of its class: it already waited its turn once
+            self.waiting[priority_class].appendleft(ticket)
+            self._wait_turn(ticket)
+            return True
+
+    def release(self, ticket):
+        with self.cond:
+            self.running.pop(ticket, None)
+            self.tickets.pop(ticket, None)
+            self.cond.notify_all()
+
+    def snapshot(self):
+        with self.cond:
+            running = {c: 0 for c in PRIORITY_CLASSES}
+            for ticket in self.running:
+                running[self.tickets[ticket]] += 1
+            return {
+                'slots': self.slots,
+                'classes': {
+                    c: {
+                        'priority': rank,
+                        'queue_limit': self.queue_limits[c],
+                        'waiting': len(self.waiting[c]),
+                        'running': running[c],
+                        **{k: round(v, 1) if isinstance(v, float) else v for k, v in self.stats[c].items()},
+                    }
+                    for rank, c in enumerate(PRIORITY_CLASSES)
+                },
+            }
+
+
+class AdmissionManager(BaseManager):
+    pass
+
+
+def _parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def create_controller():
+    return AdmissionController(
+        ADMISSION_SLOTS,
+        {c: int(os.environ.get(f'ADMISSION_QUEUE_{c.upper()}', limit)) for c, limit in DEFAULT_QUEUE_LIMITS.items()},
+        ADMISSION_LEASE_S,
+    )
+
+
+def connect_controller():
+    """The shared controller at ADMISSION_ADDRESS when set and reachable, otherwise one for this process."""
+    if ADMISSION_ADDRESS:
+        AdmissionManager.register('controller')
+        manager = AdmissionManager(address=_parse_address(ADMISSION_ADDRESS), authkey=ADMISSION_AUTHKEY)
+        try:
+            manager.connect()
+            return manager.controller()
+        except OSError as e:
+            print(f"[WARN] admission: cannot reach {ADMISSION_ADDRESS} ({e}); admitting per process")
+    return create_controller()
+
+
+# Not when this file runs as the shared controller itself
+ADMISSION = connect_controller() if __name__ != '__main__' else None
+
+
+class AdmissionSlot:
+    """An admitted call; checkpoint() between inference calls lets higher classes go first."""
+
+    def __init__(self, ticket):
+        self.ticket = ticket
+
+    def checkpoint(self, *args):
+        # *args so it can be passed directly as a sampler step callback
+        return ADMISSION.checkpoint(self.ticket)
+
+    def release(self):
+        ADMISSION.release(self.ticket)
+
+
+def admit(priority_class):
+    """
+    Waits for an inference slot of priority_class and returns it; the caller
+    releases it. For work handed to another thread (streamed responses), so a
+    rejection can still be answered with 429 before the response starts.
+    """
+    return AdmissionSlot(ADMISSION.acquire(priority_class))
+
+
+@contextmanager
+def admitted(priority_class):
+    """Holds an inference slot of priority_class for the duration of the block."""
+    slot = admit(priority_class)
+    try:
+        yield slot
+    finally:
+        slot.release()
+
+
+def admission_rejected_response(error):
+    return jsonify({'error': str(error), 'priority_class': error.priority_class}), 429
+
+
+def register_admission_routes(app):
+    """Adds GET /admission with per-class queue depth, admissions, rejections and waits."""
+    def admission_status():
+        return jsonify(ADMISSION.snapshot())
+
+    app.add_url_rule('/admission', 'admission', admission_status, methods=['GET'])
+
+
+if __name__ == '__main__':
+    # Shared controller for service processes started with the same ADMISSION_ADDRESS
+    controller = create_controller()
+    AdmissionManager.register('controller', callable=lambda: controller)
+    address = _parse_address(ADMISSION_ADDRESS or '127.0.0.1:5099')
+    server = AdmissionManager(address=address, authkey=ADMISSION_AUTHKEY).get_server()
+    print(f"[INFO] admission: serving {ADMISSION_SLOTS} slot(s) on {address[0]}:{address[1]}")
+    server.serve_forever()
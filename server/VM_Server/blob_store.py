@@ -0,0 +1,145 @@
+"""
+Content-addressed image blobs shared by the VM services.
+
+A client uploads an image once with PUT /blobs/<sha256> and from then on sends
+"image_ref": "<sha256>" instead of inline base64. A ref the service no longer
+holds gets a 404 carrying "missing_ref", so the caller uploads and retries.
+
+Blobs live in a byte-bounded in-memory LRU. When BLOB_STORE_DIR is set they are
+also written there, so services on the same host share a single upload.
+"""
+import base64
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from flask import jsonify, request
+
+BLOB_STORE_MAX_MB = int(os.environ.get('BLOB_STORE_MAX_MB', 256))
+BLOB_STORE_DIR = os.environ.get('BLOB_STORE_DIR')
+
+_DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+class MissingBlobError(KeyError):
+    """Raised when a request names an image_ref this service does not hold."""
+
+    def __init__(self, digest):
+        super().__init__(digest)
+        self.digest = digest
+
+
+def blob_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def decode_inline_image(value):
+    """Returns raw bytes from a data URL or a bare base64 string."""
+    if value.startswith('data:') and ',' in value:
+        value = value.split(',', 1)[1]
+    return base64.b64decode(value)
+
+
+class BlobStore:
+    """Thread-safe byte-bounded LRU of blobs keyed by SHA-256, with optional disk backing."""
+
+    def __init__(self, max_bytes, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def _remember(self, digest, data):
+        with self.lock:
+            if digest in self.entries:
+                self.entries.move_to_end(digest)
+                return
+            self.entries[digest] = data
+            self.size += len(data)
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def put(self, data, expected_digest=None):
+        digest = blob_digest(data)
+        if expected_digest is not None and digest != expected_digest:
+            raise ValueError(f"Content hash {digest} does not match {expected_digest}")
+        self._remember(digest, data)
+        if self.directory and not os.path.exists(self._path(digest)):
+            # Write then rename so readers in other processes never see a partial file
+            tmp_path = f"{self._path(digest)}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(digest))
+        return digest
+
+    def get(self, digest):
+        if not _DIGEST_RE.match(digest or ''):
+            return None
+        with self.lock:
+            data = self.entries.get(digest)
+            if data is not None:
+                self.entries.move_to_end(digest)
+                return data
+        if self.directory and os.path.exists(self._path(digest)):
+            with open(self._path(digest), 'rb') as f:
+                data = f.read()
+            self._remember(digest, data)
+            return data
+        return None
+
+    def has(self, digest):
+        return self.get(digest) is not None
+
+    def resolve(self, data, inline_key):
+        """
+        Returns the image bytes for a request payload: the blob named by
+        "image_ref" when present, otherwise the inline base64 under inline_key
+        (None when neither is given).
+        """
+        ref = data.get('image_ref')
+        if ref:
+            blob = self.get(ref)
+            if blob is None:
+                raise MissingBlobError(ref)
+            return blob
+        value = data.get(inline_key)
+        return decode_inline_image(value) if value else None
+
+
+def missing_blob_response(error):
+    return jsonify({'error': f"Unknown image_ref '{error.digest}'", 'missing_ref': error.digest}), 404
+
+
+def register_blob_routes(app, store):
+    """Adds PUT /blobs/<sha256> (raw body) and GET/HEAD /blobs/<sha256> (existence check)."""
+
+    def put_blob(digest):
+        if not _DIGEST_RE.match(digest):
+            return jsonify({'error': 'Blob id must be a lowercase hex SHA-256'}), 400
+        try:
+            store.put(request.get_data(), expected_digest=digest)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify({'status': 'stored', 'image_ref': digest})
+
+    def get_blob(digest):
+        data = store.get(digest)
+        if data is None:
+            return jsonify({'error': 'Unknown blob', 'missing_ref': digest}), 404
+        return jsonify({'image_ref': digest, 'size': len(data)})
+
+    app.add_url_rule('/blobs/<digest>', 'put_blob', put_blob, methods=['PUT'])
+    app.add_url_rule('/blobs/<digest>', 'get_blob', get_blob, methods=['GET'])
+
+
+def create_blob_store():
+    return BlobStore(BLOB_STORE_MAX_MB * 1024 * 1024, BLOB_STORE_DIR)
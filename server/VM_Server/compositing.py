@@ -0,0 +1,24 @@
+"""
+RGBA compositing for the rerender services. Kept free of torch and the
+ControlNet stack so it can be imported (and tested) on its own.
+"""
+import numpy as np
+from PIL import Image
+
+
+def composite_rgba(generated_rgb_list, original_mask):
+    """
+    Re-applies the original alpha to generated samples in one vectorized pass.
+    Background pixels (alpha 0) end up fully transparent, so they are zeroed
+    rather than healed; partial-alpha edge pixels keep the generated colour.
+    """
+    generated = np.stack(generated_rgb_list)
+    height, width = generated.shape[1:3]
+    if original_mask.shape[0] != height or original_mask.shape[1] != width:
+        mask_pil = Image.fromarray(original_mask)
+        original_mask = np.array(mask_pil.resize((width, height), Image.LANCZOS))
+
+    alpha = np.broadcast_to(original_mask[None, :, :, None], generated.shape[:3] + (1,))
+    final_rgba = np.concatenate((generated, alpha), axis=3)
+    final_rgba[:, original_mask == 0] = 0
+    return [final_rgba[i] for i in range(final_rgba.shape[0])]
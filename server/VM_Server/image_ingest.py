@@ -0,0 +1,113 @@
+"""
+Shared image decode and tensor ingestion for the VM services.
+
+Images are decoded straight into uint8 NumPy arrays with OpenCV (falling back
+to PIL for formats it cannot read). They are moved to the device as uint8 and
+converted to float there. On CUDA the host staging and device uint8 buffers are
+allocated once per shape and reused, so a request costs one float tensor on the
+device and no float64 or intermediate host copies.
+"""
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+_CV2_FLAGS = {
+    'RGB': cv2.IMREAD_COLOR,
+    'RGBA': cv2.IMREAD_UNCHANGED,
+    'L': cv2.IMREAD_GRAYSCALE,
+}
+
+
+def _decode_with_pil(data, mode):
+    return pil_to_array(Image.open(BytesIO(data)), mode)
+
+
+def decode_image(data, mode='RGB'):
+    """Decodes encoded image bytes into an HxWx3 (RGB), HxWx4 (RGBA) or HxW (L) uint8 array."""
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), _CV2_FLAGS[mode])
+    if image is None or image.dtype != np.uint8:
+        # GIFs, 16-bit PNGs and the like
+        return _decode_with_pil(data, mode)
+
+    if mode == 'RGB':
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    if mode == 'RGBA':
+        if image.ndim == 2:
+            return cv2.cvtColor(image, cv2.COLOR_GRAY2RGBA)
+        if image.shape[2] == 3:
+            return cv2.cvtColor(image, cv2.COLOR_BGR2RGBA)
+        return cv2.cvtColor(image, cv2.COLOR_BGRA2RGBA)
+    return image
+
+
+def pil_to_array(image, mode='RGB'):
+    """Writable uint8 array of a PIL image, converting only when its mode differs."""
+    if image.mode != mode:
+        image = image.convert(mode)
+    # np.asarray would give a read-only view that torch.from_numpy warns about
+    return np.array(image)
+
+
+class TensorIngest:
+    """
+    Moves uint8 HxWxC / HxW arrays to the device as [1, C, H, W] tensors,
+    normalizing on the device. Per-shape staging buffers are reused (LRU).
+    """
+
+    def __init__(self, device, max_shapes=8):
+        self.device = torch.device(device)
+        self.max_shapes = max_shapes
+        self.buffers = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _buffers_for(self, shape):
+        buffers = self.buffers.get(shape)
+        if buffers is None:
+            host = torch.empty(shape, dtype=torch.uint8, pin_memory=True)
+            device = torch.empty(shape, dtype=torch.uint8, device=self.device)
+            buffers = {'host': host, 'device': device, 'event': None}
+            self.buffers[shape] = buffers
+            while len(self.buffers) > self.max_shapes:
+                self.buffers.popitem(last=False)
+        self.buffers.move_to_end(shape)
+        return buffers
+
+    def to_device(self, array, normalize=True):
+        """
+        Returns a [1, C, H, W] tensor on the device: float in [0, 1] when
+        normalize is set, otherwise a uint8 copy the caller owns.
+        """
+        array = np.ascontiguousarray(array)
+        if self.device.type != 'cuda':
+            # CPU: wrap the array without copying; the conversion below is the only allocation
+            tensor = torch.from_numpy(array)
+        else:
+            with self.lock:
+                buffers = self._buffers_for(array.shape)
+                if buffers['event'] is not None:
+                    # The previous upload from this host buffer must finish before it is overwritten
+                    buffers['event'].synchronize()
+                buffers['host'].numpy()[...] = array
+                buffers['device'].copy_(buffers['host'], non_blocking=True)
+                tensor = self._convert(buffers['device'], normalize)
+                buffers['event'] = torch.cuda.Event()
+                buffers['event'].record()
+            return tensor
+
+        return self._convert(tensor, normalize)
+
+    @staticmethod
+    def _convert(tensor, normalize):
+        """HWC/HW uint8 -> contiguous [1, C, H, W], float in [0, 1] or a uint8 copy."""
+        if tensor.dim() == 2:
+            tensor = tensor.unsqueeze(0).unsqueeze(0)
+        else:
+            tensor = tensor.permute(2, 0, 1).unsqueeze(0)
+        if normalize:
+            return tensor.to(dtype=torch.float32, memory_format=torch.contiguous_format).div_(255.0)
+        return tensor.clone(memory_format=torch.contiguous_format)
@@ -1,4 +1,5 @@
 import os
+import shlex
 import tyro
 import glob
 import imageio
@@ -8,7 +9,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision.transforms.functional as TF
-from safetensors.torch import load_file
 import rembg
 
 import requests
@@ -26,71 +26,99 @@ from mvdream.pipeline_mvdream import MVDreamPipeline
 
 from flask import Flask, request, jsonify, send_file
 import tempfile
+from blob_store import MissingBlobError, create_blob_store, missing_blob_response, register_blob_routes
+from service_health import ServiceHealth, register_health_routes
+from admission import AdmissionRejected, admission_rejected_response, admitted, register_admission_routes
+from weights import load_into, load_state_dict_fast, resolve_weights
 
 app = Flask(__name__)
 
+# Images uploaded once via PUT /blobs/<sha256>, referenced later as "image_ref"
+BLOBS = create_blob_store()
+register_blob_routes(app, BLOBS)
+
 IMAGENET_DEFAULT_MEAN = (0.485, 0.456, 0.406)
 IMAGENET_DEFAULT_STD = (0.229, 0.224, 0.225)
 
-opt = tyro.cli(AllConfigs)
-
-# model
-model = LGM(opt)
+# LGM_ARGS replaces the command line (vm_host.py owns it when serving LGM in-process)
+LGM_ARGS = os.environ.get('LGM_ARGS')
+opt = tyro.cli(AllConfigs, args=shlex.split(LGM_ARGS) if LGM_ARGS is not None else None)
 
-# resume pretrained checkpoint
-if opt.resume is not None:
-    if opt.resume.endswith('safetensors'):
-        ckpt = load_file(opt.resume, device='cpu')
-    else:
-        ckpt = torch.load(opt.resume, map_location='cpu')
-    model.load_state_dict(ckpt, strict=False)
-    print(f'[INFO] Loaded checkpoint from {opt.resume}')
-else:
-    print(f'[WARN] model randomly initialized, are you sure?')
+# /healthz and /readyz; ready once every model is loaded and warmed up
+HEALTH = ServiceHealth('lgm')
+register_health_routes(app, HEALTH)
+# Generations are admitted as '3d', the lowest interactive class, and yield between stages
+register_admission_routes(app)
 
 # device
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-model = model.half().to(device)
-model.eval()
 
-rays_embeddings = model.prepare_default_rays(device)
 
-tan_half_fov = np.tan(0.5 * np.deg2rad(opt.fovy))
-proj_matrix = torch.zeros(4, 4, dtype=torch.float32, device=device)
-proj_matrix[0, 0] = 1 / tan_half_fov
-proj_matrix[1, 1] = 1 / tan_half_fov
-proj_matrix[2, 2] = (opt.zfar + opt.znear) / (opt.zfar - opt.znear)
-proj_matrix[3, 2] = - (opt.zfar * opt.znear) / (opt.zfar - opt.znear)
-proj_matrix[2, 3] = 1
+def lgm_autocast():
+    """fp16 autocast for the LGM forward on CUDA; a no-op context on a CPU VM."""
+    return torch.autocast(device_type=device.type, dtype=torch.float16, enabled=device.type == 'cuda')
+
+# LGM, MVDream and rembg; set by load_models() at startup (or on demand by vm_host.py)
+model = rays_embeddings = proj_matrix = pipe = bg_remover = None
+
+
+def load_models():
+    """Loads LGM, the ImageDream pipeline and the rembg session into the module globals."""
+    global model, rays_embeddings, proj_matrix, pipe, bg_remover
+    with HEALTH.loading():
+        # model
+        model = LGM(opt)
+
+        # resume pretrained checkpoint (safetensors is memory-mapped straight onto the device)
+        if opt.resume is not None:
+            weights_path = resolve_weights(opt.resume)
+            load_into(model, load_state_dict_fast(weights_path, device), strict=False)
+            print(f'[INFO] Loaded checkpoint from {weights_path}')
+        else:
+            print(f'[WARN] model randomly initialized, are you sure?')
+
+        model = model.half().to(device)
+        model.eval()
+
+        rays_embeddings = model.prepare_default_rays(device)
+
+        tan_half_fov = np.tan(0.5 * np.deg2rad(opt.fovy))
+        proj_matrix = torch.zeros(4, 4, dtype=torch.float32, device=device)
+        proj_matrix[0, 0] = 1 / tan_half_fov
+        proj_matrix[1, 1] = 1 / tan_half_fov
+        proj_matrix[2, 2] = (opt.zfar + opt.znear) / (opt.zfar - opt.znear)
+        proj_matrix[3, 2] = - (opt.zfar * opt.znear) / (opt.zfar - opt.znear)
+        proj_matrix[2, 3] = 1
+
 
+        # load image dream
+        pipe = MVDreamPipeline.from_pretrained(
+            "ashawkey/imagedream-ipmv-diffusers", # remote weights
+            torch_dtype=torch.float16,
+            trust_remote_code=True,
+            # local_files_only=True,
+        )
+        pipe = pipe.to(device)
 
-# load image dream
-pipe = MVDreamPipeline.from_pretrained(
-    "ashawkey/imagedream-ipmv-diffusers", # remote weights
-    torch_dtype=torch.float16,
-    trust_remote_code=True,
-    # local_files_only=True,
-)
-pipe = pipe.to(device)
+        # load rembg
+        bg_remover = rembg.new_session()
+
+
+def release_models():
+    """Drops every model reference so their memory can be reclaimed."""
+    global model, rays_embeddings, proj_matrix, pipe, bg_remover
+    model = rays_embeddings = proj_matrix = pipe = bg_remover = None
 
-# load rembg
-bg_remover = rembg.new_session()
 
 @app.route('/process', methods=['POST'])
 def process_image():
     try:
         data = request.get_json()
-        if not data or 'image' not in data:
+        if not data or ('image' not in data and 'image_ref' not in data):
             return jsonify({'error': 'No image data provided'}), 400
 
-        # Extract base64 image data
-        image_data = data['image']
-        if image_data.startswith('data:image'):
-            # Remove data URL prefix if present
-            image_data = image_data.split(',')[1]
-
-        # Decode base64 image
-        image_bytes = base64.b64decode(image_data)
+        # Inline base64 (with or without data URL prefix) or a previously uploaded blob
+        image_bytes = BLOBS.resolve(data, 'image')
         image = Image.open(BytesIO(image_bytes)).convert('RGB')
 
         # Create temporary workspace
@@ -100,7 +128,8 @@ def process_image():
             image.save(image_path)
 
             # Process the image
-            ply_path = process(opt, image_path, tmpdir)
+            with admitted('3d') as slot:
+                ply_path = process(opt, image_path, tmpdir, checkpoint=slot.checkpoint)
             torch.cuda.empty_cache()
             torch.cuda.ipc_collect()
 
@@ -120,13 +149,20 @@ def process_image():
                 'filename': 'output.ply'
             })
 
+    except MissingBlobError as e:
+        return missing_blob_response(e)
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
     except Exception as e:
         torch.cuda.empty_cache()
         torch.cuda.ipc_collect()
         return jsonify({'error': str(e)}), 500
 
 # process function
-def process(opt: Options, path, output_dir=None):
+def process(opt: Options, path, output_dir=None, checkpoint=None):
+    # checkpoint() runs between the rembg, MVDream and LGM calls so queued
+    # higher-priority work can take the device in between
+    checkpoint = checkpoint or (lambda: None)
     # Fix: Initialize output_dir properly
     if output_dir is None:
         output_dir = opt.workspace
@@ -152,10 +188,13 @@ def process(opt: Options, path, output_dir=None):
     if image.shape[-1] == 4:
         image = image[..., :3] * image[..., 3:4] + (1 - image[..., 3:4])
 
+    checkpoint()
     mv_images = []
     mv_images = pipe('', image, guidance_scale=5.0, num_inference_steps=30)
     mv_image = np.stack([mv_images[1], mv_images[2], mv_images[3], mv_images[0]], axis=0)
 
+    checkpoint()
+
     # generate gaussians
     input_image = torch.from_numpy(mv_image).permute(0, 3, 1, 2).float().to(device) # [4, 3, 256, 256]
     input_image = F.interpolate(input_image, size=(opt.input_size, opt.input_size), mode='bilinear', align_corners=False)
@@ -164,7 +203,7 @@ def process(opt: Options, path, output_dir=None):
     input_image = torch.cat([input_image, rays_embeddings], dim=1).unsqueeze(0) # [1, 4, 9, H, W]
 
     with torch.no_grad():
-        with torch.autocast(device_type='cuda', dtype=torch.float16):
+        with lgm_autocast():
             # generate gaussians
             gaussians = model.forward_gaussians(input_image)
 
@@ -213,8 +252,34 @@ def process(opt: Options, path, output_dir=None):
 
     return ply_path
 
+# MVDream steps for the warm-up pass (real requests use 30)
+WARMUP_MV_STEPS = int(os.environ.get('LGM_WARMUP_MV_STEPS', 2))
+
+def warmup_steps():
+    """Background removal, a short MVDream pass and one LGM forward at the serving shapes."""
+    image = np.random.randint(0, 256, (256, 256, 3), dtype=np.uint8)
+    mv_image = np.zeros((4, 256, 256, 3), dtype=np.float32)
+
+    def run_rembg():
+        rembg.remove(image, session=bg_remover)
+
+    def run_mvdream():
+        pipe('', image.astype(np.float32) / 255.0, guidance_scale=5.0, num_inference_steps=WARMUP_MV_STEPS)
+
+    def run_lgm():
+        input_image = torch.from_numpy(mv_image).permute(0, 3, 1, 2).float().to(device)
+        input_image = F.interpolate(input_image, size=(opt.input_size, opt.input_size), mode='bilinear', align_corners=False)
+        input_image = TF.normalize(input_image, IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD)
+        input_image = torch.cat([input_image, rays_embeddings], dim=1).unsqueeze(0)
+        with torch.no_grad(), lgm_autocast():
+            model.forward_gaussians(input_image)
+
+    return [('rembg', run_rembg), ('mvdream', run_mvdream), ('lgm', run_lgm)]
+
 # Remove the duplicate code at the bottom and fix the main execution
 if __name__ == '__main__':
+    load_models()
+
     # Only run the file processing if test_path is provided (for command line usage)
     if opt.test_path is not None:
         if os.path.isdir(opt.test_path):
@@ -225,4 +290,5 @@ if __name__ == '__main__':
             process(opt, path)
 
     # Run Flask app
+    HEALTH.start_warm_up(warmup_steps())
     app.run(host='0.0.0.0', port=5001)
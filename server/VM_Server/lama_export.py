@@ -0,0 +1,177 @@
+"""
+TorchScript / ONNX export and runtimes for the Big-LaMa generator (CPU serving).
+
+Usage:
+    python lama_export.py export --format torchscript --out big-lama/models/lama.ts
+    python lama_export.py export --format onnx --out big-lama/models/lama.onnx [--int8]
+    python lama_export.py parity --format onnx --path big-lama/models/lama.onnx
+
+The exported graph takes (image, mask) in [B, 3, H, W] / [B, 1, H, W] with H and W
+multiples of 8 and returns the composited inpainting, like the Lightning module's
+forward does for batch['inpainted']. `parity` compares it with the eager model.
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+import torch
+
+try:
+    import onnxruntime as ort
+except ImportError:  # only needed for the ONNX backend
+    ort = None
+
+
+class LamaInpaintWrapper(torch.nn.Module):
+    """Generator plus the mask compositing done in DefaultInpaintingTrainingModule.forward."""
+
+    def __init__(self, lama_model):
+        super().__init__()
+        self.generator = lama_model.generator
+        self.concat_mask = lama_model.concat_mask
+
+    def forward(self, image, mask):
+        masked_img = image * (1 - mask)
+        if self.concat_mask:
+            masked_img = torch.cat([masked_img, mask], dim=1)
+        predicted = self.generator(masked_img)
+        return mask * predicted + (1 - mask) * image
+
+
+class TorchScriptLamaRunner:
+    """Serves a TorchScript export with the same batch-in/batch-out call as the eager model."""
+
+    def __init__(self, path, out_key, device, bf16=False):
+        self.module = torch.jit.load(path, map_location=device)
+        self.module.eval()
+        self.out_key = out_key
+        self.device = device
+        self.bf16 = bf16
+
+    def __call__(self, batch):
+        mask = batch['mask'].float()
+        with torch.no_grad(), torch.autocast(device_type=self.device.type, dtype=torch.bfloat16,
+                                             enabled=self.bf16):
+            batch[self.out_key] = self.module(batch['image'], mask).float()
+        return batch
+
+
+class OnnxLamaRunner:
+    """Serves an ONNX export on ONNX Runtime with the same batch-in/batch-out call as the eager model."""
+
+    def __init__(self, path, out_key, num_threads=None):
+        if ort is None:
+            raise ImportError("onnxruntime is required for the ONNX LaMa backend")
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.out_key = out_key
+
+    def __call__(self, batch):
+        image = batch['image']
+        inpainted, = self.session.run(None, {
+            'image': image.detach().cpu().numpy().astype(np.float32),
+            'mask': batch['mask'].detach().cpu().numpy().astype(np.float32),
+        })
+        batch[self.out_key] = torch.from_numpy(inpainted).to(image.device)
+        return batch
+
+
+def create_runner(backend, path, out_key, device, precision='fp32', num_threads=None):
+    if backend == 'torchscript':
+        return TorchScriptLamaRunner(path, out_key, device, bf16=precision == 'bf16')
+    if backend == 'onnx':
+        return OnnxLamaRunner(path, out_key, num_threads=num_threads)
+    raise ValueError(f"Unknown LaMa backend '{backend}'")
+
+
+def _load_eager_model():
+    # Reuse the server's config/checkpoint resolution. The reference is always the
+    # eager model, whatever LAMA_BACKEND the environment sets for serving
+    os.environ['LAMA_BACKEND'] = 'eager'
+    import LaMa_server
+    LaMa_server.BACKEND = 'eager'
+    LaMa_server.DEVICE = torch.device('cpu')
+    LaMa_server.load_lama_model()
+    return LaMa_server.LAMA_MODEL, LaMa_server.PREDICT_CONFIG
+
+
+def export(fmt, out_path, size=512, int8=False, opset=17):
+    lama_model, _ = _load_eager_model()
+    wrapper = LamaInpaintWrapper(lama_model).eval()
+
+    image = torch.rand(1, 3, size, size)
+    mask = (torch.rand(1, 1, size, size) > 0.8).float()
+
+    with torch.no_grad():
+        if fmt == 'torchscript':
+            traced = torch.jit.trace(wrapper, (image, mask))
+            traced = torch.jit.freeze(traced)
+            traced.save(out_path)
+        else:
+            torch.onnx.export(
+                wrapper, (image, mask), out_path,
+                input_names=['image', 'mask'],
+                output_names=['inpainted'],
+                dynamic_axes={
+                    'image': {0: 'batch', 2: 'height', 3: 'width'},
+                    'mask': {0: 'batch', 2: 'height', 3: 'width'},
+                    'inpainted': {0: 'batch', 2: 'height', 3: 'width'},
+                },
+                opset_version=opset,
+            )
+            if int8:
+                from onnxruntime.quantization import QuantType, quantize_dynamic
+                quantized_path = out_path.replace('.onnx', '.int8.onnx')
+                quantize_dynamic(out_path, quantized_path, weight_type=QuantType.QInt8)
+                print(f"[INFO] Wrote int8 model to {quantized_path}")
+    print(f"[INFO] Exported LaMa ({fmt}) to {out_path}")
+
+
+def parity(fmt, path, size=512, precision='fp32', max_abs_tol=0.05):
+    """Compares the exported model with the eager model on a random image; returns False past tolerance."""
+    lama_model, predict_config = _load_eager_model()
+    runner = create_runner(fmt, path, predict_config.out_key, torch.device('cpu'), precision)
+
+    torch.manual_seed(0)
+    image = torch.rand(1, 3, size, size)
+    mask = torch.zeros(1, 1, size, size)
+    mask[:, :, size // 4: size // 2, size // 4: 3 * size // 4] = 1
+
+    with torch.no_grad():
+        reference = lama_model({'image': image, 'mask': mask})[predict_config.out_key]
+        candidate = runner({'image': image, 'mask': mask})[predict_config.out_key]
+
+    diff = (reference - candidate).abs()
+    mse = float((diff ** 2).mean())
+    psnr = float('inf') if mse == 0 else 10 * np.log10(1.0 / mse)
+    print(f"[INFO] max_abs={float(diff.max()):.5f} mean_abs={float(diff.mean()):.6f} psnr={psnr:.2f}dB")
+    return float(diff.max()) <= max_abs_tol
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = sub.add_parser('export')
+    export_parser.add_argument('--format', choices=['torchscript', 'onnx'], required=True)
+    export_parser.add_argument('--out', required=True)
+    export_parser.add_argument('--size', type=int, default=512)
+    export_parser.add_argument('--int8', action='store_true', help='also write a dynamically quantized ONNX model')
+    export_parser.add_argument('--opset', type=int, default=17)
+
+    parity_parser = sub.add_parser('parity')
+    parity_parser.add_argument('--format', choices=['torchscript', 'onnx'], required=True)
+    parity_parser.add_argument('--path', required=True)
+    parity_parser.add_argument('--size', type=int, default=512)
+    parity_parser.add_argument('--precision', choices=['fp32', 'bf16'], default='fp32')
+    parity_parser.add_argument('--max-abs-tol', type=float, default=0.05)
+
+    args = parser.parse_args()
+    if args.command == 'export':
+        export(args.format, args.out, args.size, args.int8, args.opset)
+    else:
+        sys.exit(0 if parity(args.format, args.path, args.size, args.precision, args.max_abs_tol) else 1)
@@ -1,40 +1,66 @@
 from share import *
 import config
+import os
 import base64
 import io
 import cv2
-import einops
 import gradio as gr
 import numpy as np
 import torch
-import random
+import time
 
 
 from PIL import Image
-from flask import request,jsonify, Flask
-from pytorch_lightning import seed_everything
-from annotator.util import resize_image, HWC3
-from annotator.canny import CannyDetector
-from cldm.model import create_model, load_state_dict
-from cldm.ddim_hacked import DDIMSampler
+from flask import request, jsonify, Flask, Response
+from rerender_utils import CannyPipeline, StageTimer, stream_events, canny_warmup_steps
+from service_health import ServiceHealth, no_model_hold, register_health_routes
+from image_ingest import decode_image
+from blob_store import MissingBlobError, create_blob_store, missing_blob_response, register_blob_routes
+from admission import AdmissionRejected, admission_rejected_response, admit, admitted, register_admission_routes
 
 
-print("Loading Canny ControlNet model...")
-apply_canny = CannyDetector()
+# Model load and warm-up state behind /healthz and /readyz
+HEALTH = ServiceHealth('rerender')
+# Sampling steps per preset for the startup warm-up pass
+WARMUP_STEPS = int(os.environ.get("RERENDER_WARMUP_STEPS", "2"))
 
-model = create_model('./models/cldm_v15.yaml').cpu()
-model.load_state_dict(load_state_dict('./models/control_sd15_canny.pth', location='cuda'))
-model = model.cuda()
-ddim_sampler = DDIMSampler(model)
-print("Canny model loaded.")
+A_PROMPT = 'best quality, extremely detailed'
+N_PROMPT = 'longbody, lowres, bad anatomy, bad hands, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality'
+
+# Named speed/quality presets; "balanced" matches the original fixed settings
+RERENDER_PRESETS = {
+    'fast': {'sampler': 'dpmpp_2m', 'ddim_steps': 10, 'image_resolution': 230, 'num_samples': 1},
+    'balanced': {'sampler': 'ddim', 'ddim_steps': 20, 'image_resolution': 230, 'num_samples': 1},
+    'quality': {'sampler': 'ddim', 'ddim_steps': 40, 'image_resolution': 384, 'num_samples': 1},
+}
+DEFAULT_PRESET = os.environ.get("RERENDER_DEFAULT_PRESET", "balanced")
+
+# The ControlNet model, samplers and caches; loaded by load_models() at startup
+# (or on demand by vm_host.py)
+PIPELINE = CannyPipeline('./models/cldm_v15.yaml', './models/control_sd15_canny.pth', N_PROMPT)
+TWEAK_STRENGTH = float(os.environ.get("RERENDER_TWEAK_STRENGTH", "0.6"))
+
+
+def load_models():
+    """Loads the ControlNet model, its samplers and the caches built on it."""
+    print("Loading Canny ControlNet model...")
+    with HEALTH.loading():
+        PIPELINE.load()
+    print("Canny model loaded.")
+
+
+def release_models():
+    """Drops the model and every cache holding device tensors so their memory can be reclaimed."""
+    PIPELINE.release()
 
 
 def base64_to_numpy(base64_string):
     if "," in base64_string:
         base64_string = base64_string.split(',')[1]
-    image_data = base64.b64decode(base64_string)
-    image = Image.open(io.BytesIO(image_data))
-    return np.array(image.convert('RGB'))
+    return bytes_to_numpy(base64.b64decode(base64_string))
+
+def bytes_to_numpy(image_data):
+    return decode_image(image_data, 'RGB')
 
 def numpy_to_base64(np_array):
     img = Image.fromarray(np_array.astype('uint8'), 'RGB')
@@ -44,81 +70,117 @@ def numpy_to_base64(np_array):
 
 
 
-def process_canny(input_image, prompt, a_prompt, n_prompt, num_samples, image_resolution, ddim_steps, guess_mode, strength, scale, seed, eta, low_threshold, high_threshold):
-    with torch.no_grad():
-        img = resize_image(HWC3(input_image), image_resolution)
-        H, W, C = img.shape
-
-        detected_map = apply_canny(img, low_threshold, high_threshold)
-        detected_map = HWC3(detected_map)
-
-        control = torch.from_numpy(detected_map.copy()).float().cuda() / 255.0
-        control = torch.stack([control for _ in range(num_samples)], dim=0)
-        control = einops.rearrange(control, 'b h w c -> b c h w').clone()
-
-        if seed == -1:
-            seed = random.randint(0, 65535)
-        seed_everything(seed)
+def process_canny(*args, **kwargs):
+    """Runs the shared Canny pipeline and returns its samples. Arguments as CannyPipeline.process."""
+    return PIPELINE.process(*args, **kwargs)[0]
 
-        cond = {"c_concat": [control], "c_crossattn": [model.get_learned_conditioning([prompt + ', ' + a_prompt] * num_samples)]}
-        un_cond = {"c_concat": None if guess_mode else [control], "c_crossattn": [model.get_learned_conditioning([n_prompt] * num_samples)]}
-        shape = (4, H // 8, W // 8)
-
-        model.control_scales = [strength * (0.825 ** float(12 - i)) for i in range(13)] if guess_mode else ([strength] * 13)
-        samples, intermediates = ddim_sampler.sample(ddim_steps, num_samples,
-                                                     shape, cond, verbose=False, eta=eta,
-                                                     unconditional_guidance_scale=scale,
-                                                     unconditional_conditioning=un_cond)
-
-        x_samples = model.decode_first_stage(samples)
-        x_samples = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5).cpu().numpy().clip(0, 255).astype(np.uint8)
-
-        results = [x_samples[i] for i in range(num_samples)]
-        return results
 
 app = Flask(__name__)
 
+# Images uploaded once via PUT /blobs/<sha256>, referenced later as "image_ref"
+BLOBS = create_blob_store()
+# vm_host.py replaces this so a streamed rerender keeps the model resident until sampling ends
+HOLD_MODELS = no_model_hold
+register_blob_routes(app, BLOBS)
+register_health_routes(app, HEALTH)
+# Sampling is admitted as 'rerender' and yields to clicks and inpainting between steps
+register_admission_routes(app)
+
 @app.route('/rerender_with_canny', methods=['POST'])
 def rerender_with_canny():
     try:
         # 1. Get the JSON data from the frontend
         data = request.json
-        image_base64 = data.get('image_base64')
+        # Inline base64, or "image_ref" naming a blob uploaded earlier via PUT /blobs/<sha256>
+        image_bytes = BLOBS.resolve(data, 'image_base64')
         prompt = data.get('prompt', "a high-quality, detailed photo")
         
-        if not image_base64:
+        if not image_bytes:
             return jsonify({'error': 'No image data provided'}), 400
 
+        preset_name = data.get('preset', DEFAULT_PRESET)
+        if preset_name not in RERENDER_PRESETS:
+            return jsonify({'error': f"Unknown preset '{preset_name}'",
+                            'presets': list(RERENDER_PRESETS)}), 400
+        preset = RERENDER_PRESETS[preset_name]
+        timer = StageTimer()
+        run_info = {}
+        request_start = time.perf_counter()
+
         # 2. Convert Base64 string to a NumPy image
-        input_image = base64_to_numpy(image_base64)
+        with timer.stage('decode_input'):
+            input_image = bytes_to_numpy(image_bytes)
         print(prompt)
-        # 3. Process the image with the Canny model
-        results = process_canny(
+        canny_args = dict(
             input_image=input_image,
             prompt=prompt,
-            a_prompt='best quality, extremely detailed',
-            n_prompt='longbody, lowres, bad anatomy, bad hands, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality',
-            num_samples=1,
-            image_resolution=230,
-            ddim_steps=20,
+            a_prompt=A_PROMPT,
+            n_prompt=N_PROMPT,
+            num_samples=preset['num_samples'],
+            image_resolution=preset['image_resolution'],
+            ddim_steps=preset['ddim_steps'],
             guess_mode=False,
             strength=1.0,
             scale=9.0,
-            seed=-1,
+            seed=int(data.get('seed', -1)),
             eta=0.0,
             low_threshold=50,
-            high_threshold=200
+            high_threshold=200,
+            sampler=preset['sampler'],
+            timer=timer,
+            # Prompt tweak: pass the previous response's seed with reuse_latents
+            tweak_strength=float(data.get('tweak_strength', TWEAK_STRENGTH)) if data.get('reuse_latents') else None,
+            info=run_info
         )
+
+        def timings():
+            return {**timer.timings, 'total': round((time.perf_counter() - request_start) * 1000.0, 1)}
+
+        # Optional: stream NDJSON progress events instead of a single JSON body
+        if data.get('stream', False):
+            release_hold = HOLD_MODELS()
+            # Admitted before the stream starts so a full queue is a 429, not an error event
+            try:
+                slot = admit('rerender')
+            except BaseException:
+                release_hold()
+                raise
+
+            def work(emit):
+                def on_preview(step, previews):
+                    emit('preview', step=step, total_steps=canny_args['ddim_steps'],
+                         previews=[numpy_to_base64(p) for p in previews])
+
+                try:
+                    results = process_canny(**canny_args, preview_every=int(data.get('preview_every', 5)),
+                                            on_preview=on_preview, on_step=slot.checkpoint)
+                finally:
+                    slot.release()
+                    release_hold()
+                with timer.stage('encode_output'):
+                    output_image_base64 = numpy_to_base64(results[0])
+                emit('done', new_image_url=output_image_base64, preset=preset_name, timings_ms=timings(), **run_info)
+
+            return Response(stream_events(work), mimetype='application/x-ndjson')
+
+        # 3. Process the image with the Canny model
+        with admitted('rerender') as slot:
+            results = process_canny(**canny_args, on_step=slot.checkpoint)
         
         if not results:
             return jsonify({'error': 'Failed to generate image'}), 500
 
         # 4. Convert the new image (NumPy) back to a Base64 string
-        output_image_base64 = numpy_to_base64(results[0])
+        with timer.stage('encode_output'):
+            output_image_base64 = numpy_to_base64(results[0])
 
         # 5. Send the new image back to the React app
-        return jsonify({'new_image_url': output_image_base64})
+        return jsonify({'new_image_url': output_image_base64, 'preset': preset_name, 'timings_ms': timings(), **run_info})
 
+    except MissingBlobError as e:
+        return missing_blob_response(e)
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
     except Exception as e:
         print(f"Error in /rerender_with_canny: {e}")
         return jsonify({'error': str(e)}), 500
@@ -126,4 +188,6 @@ def rerender_with_canny():
 
 
 if __name__ == "__main__":
+    load_models()
+    HEALTH.start_warm_up(canny_warmup_steps(process_canny, RERENDER_PRESETS, A_PROMPT, N_PROMPT, WARMUP_STEPS))
     app.run(host='0.0.0.0', port=5003, debug=True)
@@ -0,0 +1,506 @@
+"""
+Shared helpers for the Canny ControlNet rerender services (rerender.py, test1_rerender.py).
+"""
+import hashlib
+import json
+import os
+import queue
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import einops
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+from pytorch_lightning import seed_everything
+
+from annotator.canny import CannyDetector
+from annotator.util import resize_image, HWC3
+from cldm.ddim_hacked import DDIMSampler
+from cldm.model import create_model
+from image_ingest import TensorIngest
+from ldm.util import instantiate_from_config
+from weights import build_empty, load_into, load_state_dict_fast, meta_tensors, resolve_weights
+
+# Execution profile. RERENDER_DEVICE=auto picks CUDA when present, otherwise CPU.
+_device_name = os.environ.get("RERENDER_DEVICE", "auto")
+DEVICE = torch.device(("cuda" if torch.cuda.is_available() else "cpu") if _device_name == "auto" else _device_name)
+# CPU-only knobs: bf16 autocast for sampling/decoding, thread counts, int8 dynamic quantization of CLIP
+CPU_BF16 = os.environ.get("RERENDER_CPU_BF16", "1") == "1"
+NUM_THREADS = int(os.environ.get("RERENDER_NUM_THREADS", "0"))
+INTEROP_THREADS = int(os.environ.get("RERENDER_INTEROP_THREADS", "0"))
+QUANTIZE_TEXT_ENCODER = os.environ.get("RERENDER_QUANTIZE_TEXT_ENCODER", "0") == "1"
+CHANNELS_LAST = os.environ.get("RERENDER_CHANNELS_LAST", "1" if DEVICE.type == "cpu" else "0") == "1"
+
+
+def prepare_model(model):
+    """Moves the ControlNet model to DEVICE and applies the execution profile."""
+    if NUM_THREADS > 0:
+        torch.set_num_threads(NUM_THREADS)
+    if INTEROP_THREADS > 0:
+        torch.set_num_interop_threads(INTEROP_THREADS)
+
+    model = model.to(DEVICE).eval()
+    # FrozenCLIPEmbedder moves its tokens to this plain attribute, which defaults to "cuda"
+    model.cond_stage_model.device = DEVICE
+    if CHANNELS_LAST:
+        model = model.to(memory_format=torch.channels_last)
+    if QUANTIZE_TEXT_ENCODER:
+        if DEVICE.type != "cpu":
+            print("[WARN] RERENDER_QUANTIZE_TEXT_ENCODER only applies on CPU; ignoring")
+        else:
+            model.cond_stage_model = torch.ao.quantization.quantize_dynamic(
+                model.cond_stage_model, {torch.nn.Linear}, dtype=torch.qint8)
+            model.cond_stage_model.device = DEVICE
+    print(f"[INFO] Rerender profile: device={DEVICE} bf16={autocast_enabled()} channels_last={CHANNELS_LAST} "
+          f"threads={torch.get_num_threads()} quantized_text_encoder={QUANTIZE_TEXT_ENCODER and DEVICE.type == 'cpu'}")
+    return model
+
+
+def autocast_enabled():
+    return DEVICE.type == "cpu" and CPU_BF16
+
+
+def autocast():
+    """bf16 autocast on CPU when enabled; a no-op context on GPU."""
+    return torch.autocast(device_type=DEVICE.type, dtype=torch.bfloat16, enabled=autocast_enabled())
+
+
+class DeviceDDIMSampler(DDIMSampler):
+    """ddim_hacked.DDIMSampler, but schedule buffers follow the model's device instead of always CUDA."""
+
+    def register_buffer(self, name, attr):
+        if isinstance(attr, torch.Tensor):
+            attr = attr.to(self.model.device)
+        setattr(self, name, attr)
+
+
+class LRUCache:
+    """Small thread-safe LRU cache; values are built outside the lock on a miss."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_or_create(self, key, build):
+        value = self.get(key)
+        if value is None:
+            value = build()
+            self.put(key, value)
+        return value
+
+
+class TextConditioningCache:
+    """
+    LRU cache of CLIP text embeddings keyed by prompt string.
+    Each prompt is encoded once; batches reuse the single embedding.
+    """
+
+    def __init__(self, model, max_entries=64):
+        self.model = model
+        self.cache = LRUCache(max_entries)
+
+    def _encode(self, prompt):
+        with torch.no_grad():
+            return self.model.get_learned_conditioning([prompt])
+
+    def get(self, prompt):
+        """Returns the [1, tokens, dim] embedding for one prompt."""
+        return self.cache.get_or_create(prompt, lambda: self._encode(prompt))
+
+    def batch(self, prompt, num_samples):
+        """Returns the embedding broadcast to [num_samples, tokens, dim] without re-encoding."""
+        return self.get(prompt).expand(num_samples, -1, -1)
+
+    def rows(self, prompts, repeats=1):
+        """Stacks per-prompt embeddings into [len(prompts) * repeats, tokens, dim], prompt-major."""
+        if len(prompts) == 1:
+            return self.batch(prompts[0], repeats)
+        return torch.cat([self.batch(prompt, repeats) for prompt in prompts], dim=0)
+
+
+def image_key(input_image):
+    """Content hash of an image array (pixels and shape)."""
+    return hashlib.sha1(input_image.tobytes() + str(input_image.shape).encode()).hexdigest()
+
+
+class ControlMapCache:
+    """
+    LRU cache of Canny control maps keyed by (image hash, resolution, thresholds).
+    Holds the detected map and its [1, 3, H, W] tensor already on the device,
+    so repeat rerenders of the same object skip resize, HWC3, Canny and upload.
+    """
+
+    def __init__(self, apply_canny, device, max_entries=16):
+        self.apply_canny = apply_canny
+        self.device = device
+        self.ingest = TensorIngest(device)
+        self.cache = LRUCache(max_entries)
+
+    def _build(self, input_image, image_resolution, low_threshold, high_threshold):
+        img = resize_image(HWC3(input_image), image_resolution)
+        detected_map = HWC3(self.apply_canny(img, low_threshold, high_threshold))
+        control = self.ingest.to_device(detected_map)
+        if CHANNELS_LAST:
+            control = control.contiguous(memory_format=torch.channels_last)
+        return detected_map, control
+
+    def get(self, input_image, image_resolution, low_threshold, high_threshold, image_hash=None):
+        """Returns (detected_map, control) where control is [1, 3, H, W] on the device."""
+        key = (image_hash or image_key(input_image), image_resolution, low_threshold, high_threshold)
+        return self.cache.get_or_create(
+            key, lambda: self._build(input_image, image_resolution, low_threshold, high_threshold))
+
+
+# Linear latent -> RGB approximation for SD 1.x latents (cheap stand-in for the VAE decoder)
+LATENT_RGB_FACTORS = torch.tensor([
+    [0.298, 0.207, 0.208],
+    [0.187, 0.286, 0.173],
+    [-0.158, 0.189, 0.264],
+    [-0.184, -0.271, -0.473],
+])
+
+
+def latents_to_preview(latents):
+    """Maps [B, 4, h, w] latents to a list of low-resolution uint8 RGB previews."""
+    factors = LATENT_RGB_FACTORS.to(device=latents.device, dtype=torch.float32)
+    rgb = torch.einsum('bchw,cr->bhwr', latents.float(), factors)
+    rgb = ((rgb + 1.0) * 127.5).clamp(0, 255).to(torch.uint8).cpu().numpy()
+    return [rgb[i] for i in range(rgb.shape[0])]
+
+
+def stream_events(work):
+    """
+    Starts work(emit) on a background thread and returns a generator of what it
+    emits as NDJSON lines. emit(event, **payload) may be called any number of
+    times; an exception becomes a final "error" event. The work runs to the end
+    even if the client goes away before reading it.
+    """
+    events = queue.Queue()
+
+    def emit(event, **payload):
+        events.put(json.dumps({"event": event, **payload}) + "\n")
+
+    def run():
+        try:
+            work(emit)
+        except Exception as e:
+            print(f"Error in streamed rerender: {e}")
+            emit("error", error=str(e))
+        finally:
+            events.put(None)
+
+    def lines():
+        while True:
+            line = events.get()
+            if line is None:
+                break
+            yield line
+
+    threading.Thread(target=run, daemon=True).start()
+    return lines()
+
+
+class StageTimer:
+    """
+    Collects wall-clock milliseconds per named stage (device work is synchronized
+    first). A stage entered more than once, e.g. per streamed sample, is summed.
+    """
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            elapsed_ms = (time.perf_counter() - start) * 1000.0
+            self.timings[name] = round(self.timings.get(name, 0.0) + elapsed_ms, 1)
+
+
+class DPMSolverMultistepSampler:
+    """
+    DPM-Solver++(2M) for eps-prediction latent diffusion models, with the same
+    sample() signature as cldm.ddim_hacked.DDIMSampler. Classifier-free guidance
+    calls apply_model separately for cond and uncond, like ddim_hacked, so the
+    ControlNet dict conditioning works unchanged. Reaches DDIM quality in
+    roughly half the steps.
+    """
+
+    def __init__(self, model):
+        self.model = model
+
+    def _timesteps(self, steps):
+        num_train = self.model.num_timesteps
+        stride = num_train // steps
+        # Same uniform spacing as make_ddim_timesteps, highest noise first
+        return list(reversed(range(1, num_train, stride)))[:steps]
+
+    def _eps(self, x, t, cond, unconditional_guidance_scale, unconditional_conditioning):
+        ts = torch.full((x.shape[0],), t, device=x.device, dtype=torch.long)
+        model_t = self.model.apply_model(x, ts, cond)
+        if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
+            return model_t
+        model_uncond = self.model.apply_model(x, ts, unconditional_conditioning)
+        return model_uncond + unconditional_guidance_scale * (model_t - model_uncond)
+
+    @torch.no_grad()
+    def sample(self, S, batch_size, shape, conditioning, verbose=False, eta=0.,
+               unconditional_guidance_scale=1., unconditional_conditioning=None,
+               img_callback=None, x_T=None, timesteps=None, **kwargs):
+        device = self.model.betas.device
+        x = torch.randn((batch_size, *shape), device=device) if x_T is None else x_T
+        alphas_cumprod = self.model.alphas_cumprod.to(device=device, dtype=torch.float32)
+        timesteps = self._timesteps(S) if timesteps is None else timesteps
+
+        def coefficients(t):
+            alpha = alphas_cumprod[t].sqrt()
+            sigma = (1 - alphas_cumprod[t]).sqrt()
+            return alpha, sigma, torch.log(alpha / sigma)
+
+        x0_prev, h_prev = None, None
+        for i, t in enumerate(timesteps):
+            alpha_s, sigma_s, lambda_s = coefficients(t)
+            eps = self._eps(x, t, conditioning, unconditional_guidance_scale, unconditional_conditioning)
+            x0 = (x.float() - sigma_s * eps.float()) / alpha_s
+            if img_callback:
+                img_callback(x0, i)
+
+            if i == len(timesteps) - 1:
+                # Final step denoises straight to the clean latent
+                x = x0
+                break
+
+            alpha_t, sigma_t, lambda_t = coefficients(timesteps[i + 1])
+            h = lambda_t - lambda_s
+            if x0_prev is None or i == len(timesteps) - 2:
+                # First-order update to start, and on the last transition for stability
+                denoised = x0
+            else:
+                r = h_prev / h
+                denoised = (1 + 1 / (2 * r)) * x0 - (1 / (2 * r)) * x0_prev
+            x = (sigma_t / sigma_s) * x.float() - alpha_t * torch.expm1(-h) * denoised
+            x0_prev, h_prev = x0, h
+
+        return x.to(dtype=eps.dtype), None
+
+    @torch.no_grad()
+    def refine(self, S, x0, strength, conditioning, unconditional_guidance_scale=1.,
+               unconditional_conditioning=None, img_callback=None):
+        """
+        Img2img-style resampling of clean latents x0: noises them to the point
+        `strength` of the way up an S-step schedule and runs only the remaining
+        steps. Callback indices stay on the full S-step schedule.
+        """
+        timesteps = self._timesteps(S)
+        skipped = S - max(1, min(S, int(round(S * strength))))
+        timesteps = timesteps[skipped:]
+        acp = self.model.alphas_cumprod[timesteps[0]].to(device=x0.device, dtype=torch.float32)
+        x_T = acp.sqrt() * x0.float() + (1 - acp).sqrt() * torch.randn_like(x0, dtype=torch.float32)
+
+        def callback(pred_x0, i):
+            img_callback(pred_x0, i + skipped)
+
+        samples, _ = self.sample(len(timesteps), x0.shape[0], x0.shape[1:], conditioning,
+                                 unconditional_guidance_scale=unconditional_guidance_scale,
+                                 unconditional_conditioning=unconditional_conditioning,
+                                 img_callback=callback if img_callback else None, x_T=x_T.to(dtype=x0.dtype), timesteps=timesteps)
+        return samples
+
+
+class CannyPipeline:
+    """
+    The Canny ControlNet model with its samplers and caches, shared by
+    rerender.py and test1_rerender.py. The services keep their own presets,
+    prompts and post-processing (test1_rerender.py composites the samples
+    back onto the input's alpha) and call process() for the sampling.
+    """
+
+    def __init__(self, config_path, weights_path, n_prompt):
+        self.config_path = config_path
+        self.weights_path = weights_path
+        self.n_prompt = n_prompt
+        self.apply_canny = self.model = None
+        self.samplers = {}
+        # Text embeddings are cached per prompt
+        self.text_cache = None
+        # Canny maps (and their device copies) are cached per input image and settings
+        self.control_cache = None
+        # Final latents of recent full rerenders, keyed by (image hash, seed, batch, size),
+        # so a prompt tweak on the same object can resume from them instead of pure noise
+        self.latent_cache = LRUCache(int(os.environ.get("RERENDER_LATENT_CACHE_SIZE", "16")))
+
+    def load(self):
+        """Loads the ControlNet model, its samplers and the caches built on it."""
+        self.apply_canny = CannyDetector()
+
+        # Uses the .safetensors next to the checkpoint (mmap, straight to the device) when converted
+        state_dict = load_state_dict_fast(resolve_weights(self.weights_path), DEVICE)
+        self.model = prepare_model(self._build_model(state_dict))
+        self.samplers = {'ddim': DeviceDDIMSampler(self.model), 'dpmpp_2m': DPMSolverMultistepSampler(self.model)}
+
+        # The fixed negative prompt is encoded once up front
+        self.text_cache = TextConditioningCache(self.model)
+        self.text_cache.get(self.n_prompt)
+        self.control_cache = ControlMapCache(self.apply_canny, self.model.device)
+
+    def _build_model(self, state_dict):
+        """
+        Builds the model on the meta device and assigns the loaded weights, so
+        each weight is created once, already on the device. Falls back to a CPU
+        build when that fails or the checkpoint leaves tensors unset.
+        """
+        try:
+            # create_model() would call .cpu(), which a meta model cannot do
+            model = build_empty(lambda: instantiate_from_config(OmegaConf.load(self.config_path).model))
+            load_into(model, state_dict)
+            missing = meta_tensors(model)
+            if not missing:
+                return model
+            print(f"[WARN] Checkpoint does not set {', '.join(missing[:3])}...; building the model on CPU")
+        except Exception as e:
+            print(f"[WARN] Meta-device build failed ({e}); building the model on CPU")
+        model = create_model(self.config_path).cpu()
+        load_into(model, state_dict)
+        return model
+
+    def release(self):
+        """Drops the model and every cache holding device tensors so their memory can be reclaimed."""
+        self.apply_canny = self.model = self.text_cache = self.control_cache = None
+        self.samplers = {}
+        self.latent_cache.clear()
+
+    @staticmethod
+    def _step_callback(ddim_steps, preview_every, on_preview, on_step):
+        """The sampler's img_callback: previews every preview_every steps, then on_step(i); None when unused."""
+        previews = on_preview is not None and preview_every > 0
+        if not previews and on_step is None:
+            return None
+
+        def img_callback(pred_x0, i):
+            if previews and (i + 1) % preview_every == 0 and i + 1 < ddim_steps:
+                on_preview(i + 1, latents_to_preview(pred_x0))
+            if on_step is not None:
+                on_step(i)
+
+        return img_callback
+
+    def process(self, input_image, prompt, a_prompt, n_prompt, num_samples, image_resolution, ddim_steps, guess_mode,
+                strength, scale, seed, eta, low_threshold, high_threshold, preview_every=0, on_preview=None,
+                on_sample=None, sampler='ddim', timer=None, tweak_strength=None, info=None, on_step=None):
+        """
+        Runs Canny ControlNet sampling and returns (samples, detected_map). When
+        on_preview is given it receives (step, previews) every preview_every
+        steps, decoded cheaply from the predicted latents; on_sample receives
+        (index, image) as soon as each final sample is decoded. on_step(i) runs
+        after every sampling step (the admission checkpoint). sampler names an
+        entry of self.samplers; per-stage times are recorded on timer when given.
+
+        prompt may be a list of prompt variants: num_samples rows are then drawn
+        for each one in a single sampling pass sharing the control map, and the
+        results come back prompt-major.
+
+        With tweak_strength set and latents cached for (image, seed), sampling
+        resumes from those latents with partial noise and runs only that fraction
+        of the steps. The seed used and whether latents were reused go into info.
+        """
+        timer = timer or StageTimer()
+        info = {} if info is None else info
+        with torch.no_grad(), timer.stage('control'):
+            image_hash = image_key(input_image)
+            detected_map, control = self.control_cache.get(input_image, image_resolution, low_threshold,
+                                                           high_threshold, image_hash=image_hash)
+            H, W, C = detected_map.shape
+
+            prompts = [prompt] if isinstance(prompt, str) else list(prompt)
+            samples_per_prompt = num_samples
+            num_samples = len(prompts) * samples_per_prompt
+
+            # One control map on the device, shared by every sample and prompt
+            control = control.expand(num_samples, -1, -1, -1)
+
+            if seed == -1:
+                seed = random.randint(0, 65535)
+            seed_everything(seed)
+            info['seed'] = seed
+
+        with torch.no_grad(), timer.stage('conditioning'):
+            prompt_rows = self.text_cache.rows([p + ', ' + a_prompt for p in prompts], samples_per_prompt)
+            cond = {"c_concat": [control], "c_crossattn": [prompt_rows]}
+            un_cond = {"c_concat": None if guess_mode else [control],
+                       "c_crossattn": [self.text_cache.batch(n_prompt, num_samples)]}
+            shape = (4, H // 8, W // 8)
+            img_callback = self._step_callback(ddim_steps, preview_every, on_preview, on_step)
+
+        with torch.no_grad(), timer.stage('sampling'), autocast():
+            self.model.control_scales = ([strength * (0.825 ** float(12 - i)) for i in range(13)] if guess_mode
+                                         else ([strength] * 13))
+            latent_key = (image_hash, seed, len(prompts), samples_per_prompt, H, W)
+            cached_latents = self.latent_cache.get(latent_key) if tweak_strength else None
+            info['reused_latents'] = cached_latents is not None
+            if cached_latents is not None:
+                samples = self.samplers['dpmpp_2m'].refine(ddim_steps, cached_latents, tweak_strength, cond,
+                                                           unconditional_guidance_scale=scale,
+                                                           unconditional_conditioning=un_cond,
+                                                           img_callback=img_callback)
+            else:
+                samples, intermediates = self.samplers[sampler].sample(ddim_steps, num_samples,
+                                                                       shape, cond, verbose=False, eta=eta,
+                                                                       unconditional_guidance_scale=scale,
+                                                                       unconditional_conditioning=un_cond,
+                                                                       img_callback=img_callback)
+                self.latent_cache.put(latent_key, samples)
+
+        with torch.no_grad(), timer.stage('decode'), autocast():
+            if on_sample is None:
+                x_samples = self.model.decode_first_stage(samples)
+                x_samples = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5).float().cpu().numpy().clip(0, 255).astype(np.uint8)
+                results = [x_samples[i] for i in range(num_samples)]
+            else:
+                # Decode one sample at a time so each can be sent as soon as it is ready
+                results = []
+                for i in range(num_samples):
+                    x_sample = self.model.decode_first_stage(samples[i:i + 1])
+                    x_sample = (einops.rearrange(x_sample, 'b c h w -> b h w c') * 127.5 + 127.5).float().cpu().numpy().clip(0, 255).astype(np.uint8)[0]
+                    on_sample(i, x_sample)
+                    results.append(x_sample)
+        return results, detected_map
+
+
+def canny_warmup_steps(process_canny, presets, a_prompt, n_prompt, max_steps):
+    """One short process_canny run per preset, covering its resolution, batch size and sampler."""
+    image = np.full((512, 512, 3), 128, dtype=np.uint8)
+    image[128:384, 160:352] = 255
+
+    def run(preset):
+        process_canny(image, 'warm-up', a_prompt, n_prompt, preset['num_samples'], preset['image_resolution'],
+                      min(max_steps, preset['ddim_steps']), False, 1.0, 9.0, 0, 0.0, 50, 100,
+                      sampler=preset['sampler'])
+
+    return [(name, lambda preset=preset: run(preset)) for name, preset in presets.items()]
@@ -0,0 +1,324 @@
+"""
+ONNX Runtime backend for SAM2 (CPU serving).
+
+Usage:
+    python sam_onnx.py export --model-size small --out-dir onnx/sam2_small
+    python sam_onnx.py parity --model-size small --onnx-dir onnx/sam2_small --image test.png
+
+`export` writes the image encoder, the mask decoder and an int8 dynamically
+quantized copy of the decoder. `parity` runs both backends on the same clicks
+and reports the mask IoU.
+"""
+import argparse
+import os
+import sys
+
+import cv2
+import numpy as np
+
+try:
+    import onnxruntime as ort
+except ImportError:  # only needed when serving or exporting with the ONNX backend
+    ort = None
+
+# Checkpoint and config per SAM2.1 variant
+SAM2_CHECKPOINT_DIR = os.environ.get('SAM2_CHECKPOINT_DIR', "/home/ram227_njit_edu/SAM/sam2/checkpoints")
+SAM2_VARIANTS = {
+    "tiny": ("sam2.1_hiera_tiny.pt", "configs/sam2.1/sam2.1_hiera_t.yaml"),
+    "small": ("sam2.1_hiera_small.pt", "configs/sam2.1/sam2.1_hiera_s.yaml"),
+    "base_plus": ("sam2.1_hiera_base_plus.pt", "configs/sam2.1/sam2.1_hiera_b+.yaml"),
+    "large": ("sam2.1_hiera_large.pt", "configs/sam2.1/sam2.1_hiera_l.yaml"),
+}
+
+ENCODER_FILE = "sam2_encoder.onnx"
+DECODER_FILE = "sam2_decoder.onnx"
+DECODER_INT8_FILE = "sam2_decoder.int8.onnx"
+
+IMAGE_SIZE = 1024
+PIXEL_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+PIXEL_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+
+def sam2_paths(model_size):
+    checkpoint, config = SAM2_VARIANTS[model_size]
+    return os.path.join(SAM2_CHECKPOINT_DIR, checkpoint), config
+
+
+class OnnxSamPredictor:
+    """
+    Drop-in replacement for SAM2ImagePredictor's single-image API
+    (set_image / predict) running on ONNX Runtime.
+    """
+
+    def __init__(self, onnx_dir, quantized_decoder=True, num_threads=None):
+        if ort is None:
+            raise ImportError("onnxruntime is required for the ONNX SAM backend")
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        providers = ['CPUExecutionProvider']
+
+        decoder_file = DECODER_INT8_FILE if quantized_decoder else DECODER_FILE
+        self.encoder = ort.InferenceSession(os.path.join(onnx_dir, ENCODER_FILE), options, providers=providers)
+        self.decoder = ort.InferenceSession(os.path.join(onnx_dir, decoder_file), options, providers=providers)
+        self._features = None
+        self._orig_hw = None
+
+    def set_image(self, image):
+        """Encodes a HxWx3 uint8 RGB image and caches its features."""
+        self._orig_hw = image.shape[:2]
+        resized = cv2.resize(image, (IMAGE_SIZE, IMAGE_SIZE), interpolation=cv2.INTER_LINEAR)
+        x = (resized.astype(np.float32) / 255.0 - PIXEL_MEAN) / PIXEL_STD
+        x = x.transpose(2, 0, 1)[None]
+        high_res_0, high_res_1, image_embed = self.encoder.run(None, {"image": x})
+        self._features = {
+            "image_embed": image_embed,
+            "high_res_feats_0": high_res_0,
+            "high_res_feats_1": high_res_1,
+        }
+
+    def _decode(self, coords, labels, mask_input, multimask_output):
+        has_mask = np.array([0.0 if mask_input is None else 1.0], dtype=np.float32)
+        if mask_input is None:
+            mask_input = np.zeros((1, 1, IMAGE_SIZE // 4, IMAGE_SIZE // 4), dtype=np.float32)
+        low_res, scores = self.decoder.run(None, {
+            **self._features,
+            "point_coords": coords[None].astype(np.float32),
+            "point_labels": labels[None].astype(np.float32),
+            "mask_input": mask_input.reshape(1, 1, IMAGE_SIZE // 4, IMAGE_SIZE // 4).astype(np.float32),
+            "has_mask_input": has_mask,
+        })
+        low_res, scores = low_res[0], scores[0]
+        if not multimask_output:
+            # Decoder emits [single, multi...]; keep the single-mask output
+            low_res, scores = low_res[:1], scores[:1]
+        else:
+            low_res, scores = low_res[1:], scores[1:]
+        return low_res, scores
+
+    def predict(self, point_coords=None, point_labels=None, box=None, mask_input=None,
+                multimask_output=True, return_logits=False):
+        """Mirrors SAM2ImagePredictor.predict for a single prompt (optionally batched over prompts)."""
+        if self._features is None:
+            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+
+        if (point_coords is not None and np.asarray(point_coords).ndim == 3) or \
+                (box is not None and np.asarray(box).ndim == 2 and len(box) > 1):
+            return self._predict_batch(point_coords, point_labels, box, mask_input, multimask_output, return_logits)
+
+        height, width = self._orig_hw
+        scale = np.array([IMAGE_SIZE / width, IMAGE_SIZE / height], dtype=np.float32)
+
+        coords = np.zeros((0, 2), dtype=np.float32)
+        labels = np.zeros((0,), dtype=np.float32)
+        if point_coords is not None:
+            coords = np.asarray(point_coords, dtype=np.float32).reshape(-1, 2) * scale
+            labels = np.asarray(point_labels, dtype=np.float32).reshape(-1)
+        if box is not None:
+            # Boxes are encoded as two corner points with labels 2 and 3
+            corners = np.asarray(box, dtype=np.float32).reshape(2, 2) * scale
+            coords = np.concatenate([corners, coords])
+            labels = np.concatenate([np.array([2, 3], dtype=np.float32), labels])
+
+        low_res, scores = self._decode(coords, labels, mask_input, multimask_output)
+
+        masks = np.stack([
+            cv2.resize(m, (width, height), interpolation=cv2.INTER_LINEAR) for m in low_res
+        ])
+        if not return_logits:
+            masks = (masks > 0).astype(np.float32)
+        return masks, scores, low_res
+
+    def _predict_batch(self, point_coords, point_labels, box, mask_input, multimask_output, return_logits):
+        count = len(point_coords) if point_coords is not None else len(box)
+        results = [
+            self.predict(
+                point_coords=None if point_coords is None else point_coords[i],
+                point_labels=None if point_labels is None else point_labels[i],
+                box=None if box is None else box[i],
+                mask_input=None if mask_input is None else mask_input[i],
+                multimask_output=multimask_output,
+                return_logits=return_logits,
+            )
+            for i in range(count)
+        ]
+        # Like SAM2ImagePredictor, a batch of one comes back without the batch dimension
+        if count == 1:
+            return results[0]
+        return tuple(np.stack(parts) for parts in zip(*results))
+
+
+# --- Export ---
+
+def export(model_size, out_dir, opset=17):
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from sam2.build_sam import build_sam2
+
+    class SAM2ImageEncoder(torch.nn.Module):
+        def __init__(self, sam_model):
+            super().__init__()
+            self.model = sam_model
+
+        def forward(self, x):
+            backbone_out = self.model.image_encoder(x)
+            backbone_out["backbone_fpn"][0] = self.model.sam_mask_decoder.conv_s0(backbone_out["backbone_fpn"][0])
+            backbone_out["backbone_fpn"][1] = self.model.sam_mask_decoder.conv_s1(backbone_out["backbone_fpn"][1])
+
+            feature_maps = backbone_out["backbone_fpn"][-self.model.num_feature_levels:]
+            vision_pos_embeds = backbone_out["vision_pos_enc"][-self.model.num_feature_levels:]
+            feat_sizes = [(p.shape[-2], p.shape[-1]) for p in vision_pos_embeds]
+
+            vision_feats = [f.flatten(2).permute(2, 0, 1) for f in feature_maps]
+            vision_feats[-1] = vision_feats[-1] + self.model.no_mem_embed
+
+            feats = [
+                feat.permute(1, 2, 0).reshape(1, -1, *size)
+                for feat, size in zip(vision_feats[::-1], feat_sizes[::-1])
+            ][::-1]
+            return feats[0], feats[1], feats[2]
+
+    class SAM2ImageDecoder(torch.nn.Module):
+        def __init__(self, sam_model):
+            super().__init__()
+            self.model = sam_model
+            self.prompt_encoder = sam_model.sam_prompt_encoder
+            self.mask_decoder = sam_model.sam_mask_decoder
+
+        def forward(self, image_embed, high_res_feats_0, high_res_feats_1,
+                    point_coords, point_labels, mask_input, has_mask_input):
+            sparse = self._embed_points(point_coords, point_labels)
+            dense = has_mask_input * self.prompt_encoder.mask_downscaling(mask_input)
+            dense = dense + (1 - has_mask_input) * self.prompt_encoder.no_mask_embed.weight.reshape(1, -1, 1, 1)
+
+            masks, iou_predictions, _, _ = self.mask_decoder.predict_masks(
+                image_embeddings=image_embed,
+                image_pe=self.prompt_encoder.get_dense_pe(),
+                sparse_prompt_embeddings=sparse,
+                dense_prompt_embeddings=dense,
+                repeat_image=False,
+                high_res_features=[high_res_feats_0, high_res_feats_1],
+            )
+            return torch.clamp(masks, -32.0, 32.0), iou_predictions
+
+        def _embed_points(self, point_coords, point_labels):
+            point_coords = point_coords + 0.5
+            padding_point = torch.zeros((point_coords.shape[0], 1, 2))
+            padding_label = -torch.ones((point_labels.shape[0], 1))
+            point_coords = torch.cat([point_coords, padding_point], dim=1) / self.model.image_size
+            point_labels = torch.cat([point_labels, padding_label], dim=1)
+
+            embedding = self.prompt_encoder.pe_layer._pe_encoding(point_coords)
+            point_labels = point_labels.unsqueeze(-1).expand_as(embedding)
+            embedding = embedding * (point_labels != -1)
+            embedding = embedding + self.prompt_encoder.not_a_point_embed.weight * (point_labels == -1)
+            for i in range(self.prompt_encoder.num_point_embeddings):
+                embedding = embedding + self.prompt_encoder.point_embeddings[i].weight * (point_labels == i)
+            return embedding
+
+    os.makedirs(out_dir, exist_ok=True)
+    checkpoint, config = sam2_paths(model_size)
+    sam2_model = build_sam2(config, checkpoint, device="cpu")
+    sam2_model.eval()
+
+    encoder = SAM2ImageEncoder(sam2_model)
+    decoder = SAM2ImageDecoder(sam2_model)
+
+    with torch.no_grad():
+        dummy_image = torch.randn(1, 3, IMAGE_SIZE, IMAGE_SIZE)
+        high_res_0, high_res_1, image_embed = encoder(dummy_image)
+
+        torch.onnx.export(
+            encoder, dummy_image, os.path.join(out_dir, ENCODER_FILE),
+            input_names=["image"],
+            output_names=["high_res_feats_0", "high_res_feats_1", "image_embed"],
+            opset_version=opset,
+        )
+
+        decoder_inputs = (
+            image_embed, high_res_0, high_res_1,
+            torch.randint(0, IMAGE_SIZE, (1, 2, 2), dtype=torch.float),
+            torch.ones((1, 2), dtype=torch.float),
+            torch.zeros((1, 1, IMAGE_SIZE // 4, IMAGE_SIZE // 4), dtype=torch.float),
+            torch.zeros(1, dtype=torch.float),
+        )
+        torch.onnx.export(
+            decoder, decoder_inputs, os.path.join(out_dir, DECODER_FILE),
+            input_names=["image_embed", "high_res_feats_0", "high_res_feats_1",
+                         "point_coords", "point_labels", "mask_input", "has_mask_input"],
+            output_names=["masks", "iou_predictions"],
+            dynamic_axes={"point_coords": {1: "num_points"}, "point_labels": {1: "num_points"}},
+            opset_version=opset,
+        )
+
+    quantize_dynamic(
+        os.path.join(out_dir, DECODER_FILE),
+        os.path.join(out_dir, DECODER_INT8_FILE),
+        weight_type=QuantType.QInt8,
+    )
+    print(f"[INFO] Exported SAM2 ({model_size}) to {out_dir}")
+
+
+# --- Parity check ---
+
+def mask_iou(a, b):
+    union = np.logical_or(a, b).sum()
+    return 1.0 if union == 0 else float(np.logical_and(a, b).sum() / union)
+
+
+def parity(model_size, onnx_dir, image_path, quantized_decoder=True, points=None, min_iou=0.9):
+    """Runs the PyTorch and ONNX backends on the same clicks; returns False if any IoU is below min_iou."""
+    from PIL import Image
+    from sam2.build_sam import build_sam2
+    from sam2.sam2_image_predictor import SAM2ImagePredictor
+
+    image = np.array(Image.open(image_path).convert("RGB"))
+    height, width = image.shape[:2]
+    points = points or [[0.5, 0.5], [0.25, 0.25], [0.75, 0.6]]
+
+    checkpoint, config = sam2_paths(model_size)
+    torch_predictor = SAM2ImagePredictor(build_sam2(config, checkpoint, device="cpu"))
+    onnx_predictor = OnnxSamPredictor(onnx_dir, quantized_decoder=quantized_decoder)
+
+    torch_predictor.set_image(image)
+    onnx_predictor.set_image(image)
+
+    ok = True
+    for x, y in points:
+        coords = np.array([[int(x * width), int(y * height)]])
+        labels = np.array([1])
+        ref_masks, ref_scores, _ = torch_predictor.predict(point_coords=coords, point_labels=labels)
+        masks, scores, _ = onnx_predictor.predict(point_coords=coords, point_labels=labels)
+
+        ref_best = ref_masks[int(np.argmax(ref_scores))] > 0
+        best = masks[int(np.argmax(scores))] > 0
+        iou = mask_iou(ref_best, best)
+        ok = ok and iou >= min_iou
+        print(f"[INFO] point=({x:.2f}, {y:.2f}) IoU={iou:.4f}")
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = sub.add_parser("export")
+    export_parser.add_argument("--model-size", choices=sorted(SAM2_VARIANTS), default="small")
+    export_parser.add_argument("--out-dir", required=True)
+    export_parser.add_argument("--opset", type=int, default=17)
+
+    parity_parser = sub.add_parser("parity")
+    parity_parser.add_argument("--model-size", choices=sorted(SAM2_VARIANTS), default="small")
+    parity_parser.add_argument("--onnx-dir", required=True)
+    parity_parser.add_argument("--image", required=True)
+    parity_parser.add_argument("--fp32-decoder", action="store_true")
+    parity_parser.add_argument("--min-iou", type=float, default=0.9)
+
+    args = parser.parse_args()
+    if args.command == "export":
+        export(args.model_size, args.out_dir, args.opset)
+    else:
+        passed = parity(args.model_size, args.onnx_dir, args.image,
+                        quantized_decoder=not args.fp32_decoder, min_iou=args.min_iou)
+        sys.exit(0 if passed else 1)
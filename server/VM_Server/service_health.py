@@ -0,0 +1,146 @@
+"""
+Startup warm-up and health/readiness endpoints shared by the VM services.
+
+GET /healthz  200 while the process is up, with model load state and warm-up timings.
+GET /readyz   200 once the model is loaded and warm-up has finished, 503 before that
+              (or after a failure). The gateway only sends work to ready services.
+
+Warm-up runs a few representative inferences in the background so the first real
+request does not pay for kernel selection and allocator growth. Set VM_WARMUP=0
+to skip it.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import jsonify
+
+WARMUP_ENABLED = os.environ.get('VM_WARMUP', '1') == '1'
+
+
+def parse_shapes(value):
+    """'1024x1024,768x512' -> [(1024, 1024), (768, 512)] as (width, height)."""
+    shapes = []
+    for item in value.split(','):
+        item = item.strip()
+        if item:
+            width, height = item.lower().split('x')
+            shapes.append((int(width), int(height)))
+    return shapes
+
+
+def run_warmup_steps(service, steps):
+    """Runs (label, fn) steps and returns {label: ms}; raises RuntimeError naming the failed step. No-op when VM_WARMUP=0."""
+    timings = {}
+    if not WARMUP_ENABLED:
+        return timings
+    for label, fn in steps:
+        start = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            print(f"[ERROR] {service} warm-up '{label}' failed: {e}")
+            raise RuntimeError(f"warm-up '{label}' failed: {e}") from e
+        timings[label] = round((time.perf_counter() - start) * 1000.0, 1)
+        print(f"[INFO] {service} warm-up '{label}' took {timings[label]} ms")
+    return timings
+
+
+class ServiceHealth:
+    """Tracks one service's model load and warm-up: starting -> loading -> warming -> ready | failed."""
+
+    def __init__(self, service):
+        self.service = service
+        self.state = 'starting'
+        self.error = None
+        self.load_ms = None
+        self.warmup_ms = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def loading(self):
+        """Wraps model loading; records its duration, or the failure before re-raising."""
+        self.set_state('loading')
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.failed(e)
+            raise
+        self.load_ms = round((time.perf_counter() - start) * 1000.0, 1)
+        self.set_state('loaded')
+
+    def failed(self, error):
+        with self.lock:
+            self.state = 'failed'
+            self.error = str(error)
+
+    def set_state(self, state):
+        with self.lock:
+            if self.state != 'failed':
+                self.state = state
+
+    def record_warmup(self, label, ms):
+        with self.lock:
+            self.warmup_ms[label] = ms
+
+    def mark_ready(self):
+        self.set_state('ready')
+
+    def warm_up(self, steps):
+        """Runs (label, fn) warm-up steps in order, timing each, then marks the service ready."""
+        if self.state == 'failed':
+            return
+        self.set_state('warming')
+        try:
+            timings = run_warmup_steps(self.service, steps)
+        except RuntimeError as e:
+            self.failed(e)
+            return
+        for label, ms in timings.items():
+            self.record_warmup(label, ms)
+        self.mark_ready()
+
+    def start_warm_up(self, steps):
+        """Runs warm_up on a background thread so /healthz answers meanwhile."""
+        thread = threading.Thread(target=self.warm_up, args=(steps,), name=f'{self.service}-warmup', daemon=True)
+        thread.start()
+        return thread
+
+    @property
+    def ready(self):
+        return self.state == 'ready'
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'service': self.service,
+                'state': self.state,
+                'ready': self.state == 'ready',
+                'model_loaded': self.state in ('loaded', 'warming', 'ready'),
+                'load_ms': self.load_ms,
+                'warmup_ms': dict(self.warmup_ms),
+                'error': self.error,
+            }
+
+
+def no_model_hold():
+    """
+    Default HOLD_MODELS hook of a service module: marks its models in use for
+    work that outlives the request and returns the callback ending that. A
+    standalone service never unloads its models, so there is nothing to hold.
+    """
+    return lambda: None
+
+
+def register_health_routes(app, health):
+    def healthz():
+        return jsonify(health.snapshot())
+
+    def readyz():
+        snapshot = health.snapshot()
+        return jsonify(snapshot), 200 if snapshot['ready'] else 503
+
+    app.add_url_rule('/healthz', 'healthz', healthz, methods=['GET'])
+    app.add_url_rule('/readyz', 'readyz', readyz, methods=['GET'])
@@ -1,40 +1,71 @@
 from share import *
 import config
+import os
 import base64
 import io
 import cv2
-import einops
 import gradio as gr
 import numpy as np
 import torch
-import random
+import time
 
 from PIL import Image
-from flask import request, jsonify, Flask
-from pytorch_lightning import seed_everything
-from annotator.util import resize_image, HWC3
-from annotator.canny import CannyDetector
-from cldm.model import create_model, load_state_dict
-from cldm.ddim_hacked import DDIMSampler
-
-
-print("Loading Canny ControlNet model...")
-apply_canny = CannyDetector()
-
-model = create_model('./models/cldm_v15.yaml').cpu()
-model.load_state_dict(load_state_dict('./models/control_sd15_canny.pth', location='cuda'))
-model = model.cuda()
-ddim_sampler = DDIMSampler(model)
-print("Canny model loaded.")
+from flask import request, jsonify, Flask, Response
+from rerender_utils import CannyPipeline, StageTimer, stream_events, canny_warmup_steps
+from service_health import ServiceHealth, no_model_hold, register_health_routes
+from image_ingest import decode_image
+from compositing import composite_rgba
+from blob_store import MissingBlobError, create_blob_store, missing_blob_response, register_blob_routes
+from admission import AdmissionRejected, admission_rejected_response, admit, admitted, register_admission_routes
+
+
+# Model load and warm-up state behind /healthz and /readyz
+HEALTH = ServiceHealth('rerender')
+# Sampling steps per preset for the startup warm-up pass
+WARMUP_STEPS = int(os.environ.get("RERENDER_WARMUP_STEPS", "2"))
+
+A_PROMPT = 'best quality, extremely detailed, 8k, isolated object'
+N_PROMPT = 'longbody, lowres, bad anatomy, bad hands, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality, noisy, blurry, landscape, scene, complex background, background'
+
+# Named speed/quality presets; "quality" matches the original fixed settings
+RERENDER_PRESETS = {
+    'fast': {'sampler': 'dpmpp_2m', 'ddim_steps': 12, 'image_resolution': 384, 'num_samples': 2},
+    'balanced': {'sampler': 'dpmpp_2m', 'ddim_steps': 20, 'image_resolution': 512, 'num_samples': 3},
+    'quality': {'sampler': 'ddim', 'ddim_steps': 40, 'image_resolution': 512, 'num_samples': 3},
+}
+DEFAULT_PRESET = os.environ.get("RERENDER_DEFAULT_PRESET", "quality")
+MAX_PROMPT_VARIANTS = int(os.environ.get("RERENDER_MAX_PROMPT_VARIANTS", "4"))
+MAX_SAMPLES_PER_PROMPT = int(os.environ.get("RERENDER_MAX_SAMPLES_PER_PROMPT", "4"))
+# Upper bound on prompt variants x samples per prompt sampled in one batch
+MAX_BATCH_SAMPLES = int(os.environ.get("RERENDER_MAX_BATCH_SAMPLES", "8"))
+
+# The ControlNet model, samplers and caches; loaded by load_models() at startup
+# (or on demand by vm_host.py)
+PIPELINE = CannyPipeline('./models/cldm_v15.yaml', './models/control_sd15_canny.pth', N_PROMPT)
+TWEAK_STRENGTH = float(os.environ.get("RERENDER_TWEAK_STRENGTH", "0.6"))
+
+
+def load_models():
+    """Loads the ControlNet model, its samplers and the caches built on it."""
+    print("Loading Canny ControlNet model...")
+    with HEALTH.loading():
+        PIPELINE.load()
+    print("Canny model loaded.")
+
+
+def release_models():
+    """Drops the model and every cache holding device tensors so their memory can be reclaimed."""
+    PIPELINE.release()
 
 
 def base64_to_numpy(base64_string):
     if "," in base64_string:
         base64_string = base64_string.split(',')[1]
-    image_data = base64.b64decode(base64_string)
-    image = Image.open(io.BytesIO(image_data))
-    # Convert to RGBA to keep the alpha channel
-    return np.array(image.convert('RGBA'))
+    return bytes_to_numpy(base64.b64decode(base64_string))
+
+def bytes_to_numpy(image_data):
+    # RGBA keeps the alpha channel
+    return decode_image(image_data, 'RGBA')
 
 def numpy_to_base64(np_array):
     if np_array.shape[2] == 4:
@@ -51,124 +82,171 @@ def numpy_to_base64(np_array):
     return "data:image/png;base64," + base64.b64encode(buffered.getvalue()).decode('utf-8')
 
 
-def process_canny(input_image, prompt, a_prompt, n_prompt, num_samples, image_resolution, ddim_steps, guess_mode, strength, scale, seed, eta, low_threshold, high_threshold):
-    with torch.no_grad():
-        img = resize_image(HWC3(input_image), image_resolution)
-        H, W, C = img.shape
-
-        detected_map = apply_canny(img, low_threshold, high_threshold)
-        detected_map = HWC3(detected_map)
-
-        control = torch.from_numpy(detected_map.copy()).float().cuda() / 255.0
-        control = torch.stack([control for _ in range(num_samples)], dim=0)
-        control = einops.rearrange(control, 'b h w c -> b c h w').clone()
-
-        if seed == -1:
-            seed = random.randint(0, 65535)
-        seed_everything(seed)
+def process_canny(*args, **kwargs):
+    """Runs the shared Canny pipeline and returns (samples, detected Canny map). Arguments as CannyPipeline.process."""
+    return PIPELINE.process(*args, **kwargs)
 
-        cond = {"c_concat": [control], "c_crossattn": [model.get_learned_conditioning([prompt + ', ' + a_prompt] * num_samples)]}
-        un_cond = {"c_concat": None if guess_mode else [control], "c_crossattn": [model.get_learned_conditioning([n_prompt] * num_samples)]}
-        shape = (4, H // 8, W // 8)
 
-        model.control_scales = [strength * (0.825 ** float(12 - i)) for i in range(13)] if guess_mode else ([strength] * 13)
-        samples, intermediates = ddim_sampler.sample(ddim_steps, num_samples,
-                                                     shape, cond, verbose=False, eta=eta,
-                                                     unconditional_guidance_scale=scale,
-                                                     unconditional_conditioning=un_cond)
+app = Flask(__name__)
 
-        x_samples = model.decode_first_stage(samples)
-        x_samples = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5).cpu().numpy().clip(0, 255).astype(np.uint8)
+# Images uploaded once via PUT /blobs/<sha256>, referenced later as "image_ref"
+BLOBS = create_blob_store()
+# vm_host.py replaces this so a streamed rerender keeps the model resident until sampling ends
+HOLD_MODELS = no_model_hold
+register_blob_routes(app, BLOBS)
+register_health_routes(app, HEALTH)
+# Sampling is admitted as 'rerender' and yields to clicks and inpainting between steps
+register_admission_routes(app)
 
-        results = [x_samples[i] for i in range(num_samples)]
-        
-        # Return both the generated images and the debug Canny map
-        return results, detected_map
-app = Flask(__name__)
 
 @app.route('/rerender_with_canny', methods=['POST'])
 def rerender_with_canny():
     try:
         data = request.json
-        image_base64 = data.get('image_base64')
+        # Inline base64, or "image_ref" naming a blob uploaded earlier via PUT /blobs/<sha256>
+        image_bytes = BLOBS.resolve(data, 'image_base64')
         prompt = data.get('prompt', "a high-quality, detailed photo")
+        # Optional: several prompt variants rendered together in one batch
+        prompts = data.get('prompts')
+        if prompts is not None:
+            if not isinstance(prompts, list) or not prompts or not all(isinstance(p, str) for p in prompts):
+                return jsonify({'error': "'prompts' must be a non-empty list of strings"}), 400
+            if len(prompts) > MAX_PROMPT_VARIANTS:
+                return jsonify({'error': f"At most {MAX_PROMPT_VARIANTS} prompt variants per request"}), 400
+            try:
+                samples_per_prompt = int(data.get('samples_per_prompt', 1))
+            except (TypeError, ValueError):
+                return jsonify({'error': "'samples_per_prompt' must be an integer"}), 400
+            if not 1 <= samples_per_prompt <= MAX_SAMPLES_PER_PROMPT:
+                return jsonify({'error': f"'samples_per_prompt' must be between 1 and {MAX_SAMPLES_PER_PROMPT}"}), 400
+            if len(prompts) * samples_per_prompt > MAX_BATCH_SAMPLES:
+                return jsonify({'error': f"At most {MAX_BATCH_SAMPLES} samples per request "
+                                         f"(prompt variants x samples_per_prompt)"}), 400
+        # Optional: stream NDJSON progress events instead of a single JSON body
+        stream = bool(data.get('stream', False))
+        preview_every = int(data.get('preview_every', 5))
         
-        if not image_base64:
+        if not image_bytes:
             return jsonify({'error': 'No image data provided'}), 400
 
-        # 1. Get RGBA image and original alpha mask
-        input_image_rgba = base64_to_numpy(image_base64)
-        original_mask = input_image_rgba[:, :, 3]
-
-        # 2. Create a neutral gray background for Canny
-        pil_rgba = Image.fromarray(input_image_rgba, 'RGBA')
-        pil_rgb_on_gray = Image.new("RGB", pil_rgba.size, (128, 128, 128))
-        pil_rgb_on_gray.paste(pil_rgba, mask=pil_rgba.split()[3]) 
-        input_image_rgb_for_canny = np.array(pil_rgb_on_gray)
-
-        results_rgb_list, detected_map_array = process_canny(
+        preset_name = data.get('preset', DEFAULT_PRESET)
+        if preset_name not in RERENDER_PRESETS:
+            return jsonify({'error': f"Unknown preset '{preset_name}'",
+                            'presets': list(RERENDER_PRESETS)}), 400
+        preset = RERENDER_PRESETS[preset_name]
+        timer = StageTimer()
+        run_info = {}
+        request_start = time.perf_counter()
+
+        with timer.stage('decode_input'):
+            # 1. Get RGBA image and original alpha mask
+            input_image_rgba = bytes_to_numpy(image_bytes)
+            original_mask = input_image_rgba[:, :, 3]
+
+            # 2. Create a neutral gray background for Canny
+            pil_rgba = Image.fromarray(input_image_rgba, 'RGBA')
+            pil_rgb_on_gray = Image.new("RGB", pil_rgba.size, (128, 128, 128))
+            pil_rgb_on_gray.paste(pil_rgba, mask=pil_rgba.split()[3]) 
+            input_image_rgb_for_canny = np.array(pil_rgb_on_gray)
+
+        canny_args = dict(
             input_image=input_image_rgb_for_canny,
-            prompt=prompt,
-            a_prompt='best quality, extremely detailed, 8k, isolated object',
-            n_prompt='longbody, lowres, bad anatomy, bad hands, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality, noisy, blurry, landscape, scene, complex background, background',
-            num_samples=3,
-            image_resolution=512,
-            ddim_steps=40,
+            prompt=prompts if prompts is not None else prompt,
+            a_prompt=A_PROMPT,
+            n_prompt=N_PROMPT,
+            num_samples=samples_per_prompt if prompts is not None else preset['num_samples'],
+            image_resolution=preset['image_resolution'],
+            ddim_steps=preset['ddim_steps'],
             guess_mode=False,
             strength=1.0,
             scale=9.0,
-            seed=-1,
+            seed=int(data.get('seed', -1)),
             eta=0.0,
             low_threshold=50,
-            high_threshold=100
+            high_threshold=100,
+            sampler=preset['sampler'],
+            timer=timer,
+            # Prompt tweak: pass the previous response's seed with reuse_latents
+            tweak_strength=float(data.get('tweak_strength', TWEAK_STRENGTH)) if data.get('reuse_latents') else None,
+            info=run_info
         )
+
+        def timings():
+            return {**timer.timings, 'total': round((time.perf_counter() - request_start) * 1000.0, 1)}
+
+        if prompts is not None:
+            run_info['option_prompts'] = [p for p in prompts for _ in range(canny_args['num_samples'])]
+
+        if stream:
+            release_hold = HOLD_MODELS()
+            # Admitted before the stream starts so a full queue is a 429, not an error event
+            try:
+                slot = admit('rerender')
+            except BaseException:
+                release_hold()
+                raise
+
+            def work(emit):
+                final_image_options = []
+
+                def on_preview(step, previews):
+                    emit('preview', step=step, total_steps=canny_args['ddim_steps'],
+                         previews=[numpy_to_base64(p) for p in previews])
+
+                def on_sample(index, generated_rgb):
+                    # Runs inside the decode stage, so decode includes these per-sample stages
+                    with timer.stage('composite'):
+                        final_rgba = composite_rgba([generated_rgb], original_mask)[0]
+                    with timer.stage('encode_output'):
+                        final_image_options.append(numpy_to_base64(final_rgba))
+                    emit('sample', index=index, image=final_image_options[-1])
+
+                try:
+                    _, detected_map_array = process_canny(
+                        **canny_args, preview_every=preview_every, on_preview=on_preview, on_sample=on_sample,
+                        on_step=slot.checkpoint)
+                finally:
+                    slot.release()
+                    release_hold()
+                with timer.stage('encode_output'):
+                    debug_canny_base64 = numpy_to_base64(detected_map_array)
+                emit('done', image_options=final_image_options,
+                     debug_canny_url=debug_canny_base64,
+                     preset=preset_name, timings_ms=timings(), **run_info)
+
+            return Response(stream_events(work), mimetype='application/x-ndjson')
+
+        with admitted('rerender') as slot:
+            results_rgb_list, detected_map_array = process_canny(**canny_args, on_step=slot.checkpoint)
         if not results_rgb_list or len(results_rgb_list) == 0:
             return jsonify({'error': 'Failed to generate images'}), 500 
 
-        final_image_options = []
-        original_mask_resized = None 
-
-        for generated_rgb in results_rgb_list:
-            
-            # 5. Get generated image and resize original mask
-            if original_mask_resized is None:
-                if generated_rgb.shape[0] != original_mask.shape[0] or generated_rgb.shape[1] != original_mask.shape[1]:
-                    mask_pil = Image.fromarray(original_mask)
-                    mask_pil_resized = mask_pil.resize((generated_rgb.shape[1], generated_rgb.shape[0]), Image.LANCZOS)
-                    original_mask_resized = np.array(mask_pil_resized)
-                else:
-                    original_mask_resized = original_mask
-            
-            
-            # Create a binary mask of the *background* (anywhere alpha is 0)
-            inpaint_mask = (original_mask_resized == 0).astype(np.uint8)
-
-            # Use cv2.inpaint to fill the background
-            generated_rgb_healed = cv2.inpaint(
-                generated_rgb, 
-                inpaint_mask, 
-                3,  
-                cv2.INPAINT_TELEA
-            )
-
-            final_rgba = np.dstack((generated_rgb_healed, original_mask_resized))
-            final_rgba[original_mask_resized == 0] = [0, 0, 0, 0]
-
-            # 7. Convert to base64 and add to list
-            output_image_base64 = numpy_to_base64(final_rgba)
-            final_image_options.append(output_image_base64)
-
-        # 8. Convert debug map to base64
-        debug_canny_base64 = numpy_to_base64(detected_map_array) 
+        # 3. Composite each sample back onto the original alpha and convert to base64
+        with timer.stage('composite'):
+            final_rgba_list = composite_rgba(results_rgb_list, original_mask)
+        with timer.stage('encode_output'):
+            final_image_options = [numpy_to_base64(final_rgba) for final_rgba in final_rgba_list]
+
+            # 4. Convert debug map to base64
+            debug_canny_base64 = numpy_to_base64(detected_map_array) 
 
         return jsonify({
             'image_options': final_image_options, 
-            'debug_canny_url': debug_canny_base64
+            'debug_canny_url': debug_canny_base64,
+            'preset': preset_name,
+            'timings_ms': timings(),
+            **run_info
         })
 
+    except MissingBlobError as e:
+        return missing_blob_response(e)
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
     except Exception as e:
         print(f"Error in /rerender_with_canny: {e}")
         return jsonify({'error': str(e)}), 500
 
 if __name__ == "__main__":
+    load_models()
+    HEALTH.start_warm_up(canny_warmup_steps(process_canny, RERENDER_PRESETS, A_PROMPT, N_PROMPT, WARMUP_STEPS))
     app.run(host='0.0.0.0', port=5003, debug=True) 
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The VM services are flat modules run from server/VM_Server
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
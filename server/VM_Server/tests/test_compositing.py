@@ -0,0 +1,63 @@
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+from compositing import composite_rgba
+
+
+def legacy_composite_rgba(generated_rgb, original_mask):
+    """The compositing test1_rerender.py used before: heal the background with cv2.inpaint, then zero it."""
+    if generated_rgb.shape[0] != original_mask.shape[0] or generated_rgb.shape[1] != original_mask.shape[1]:
+        mask_pil = Image.fromarray(original_mask)
+        mask_pil_resized = mask_pil.resize((generated_rgb.shape[1], generated_rgb.shape[0]), Image.LANCZOS)
+        original_mask = np.array(mask_pil_resized)
+
+    inpaint_mask = (original_mask == 0).astype(np.uint8)
+    generated_rgb_healed = cv2.inpaint(generated_rgb, inpaint_mask, 3, cv2.INPAINT_TELEA)
+
+    final_rgba = np.dstack((generated_rgb_healed, original_mask))
+    final_rgba[original_mask == 0] = [0, 0, 0, 0]
+    return final_rgba
+
+
+def sample_mask(height, width, rng):
+    """Opaque ellipse on a transparent background with a partial-alpha edge."""
+    yy, xx = np.mgrid[:height, :width]
+    distance = ((yy - height / 2) / (height / 3)) ** 2 + ((xx - width / 2) / (width / 3)) ** 2
+    mask = np.clip((1.2 - distance) * 255 / 0.4, 0, 255).astype(np.uint8)
+    # A few isolated transparent holes inside the object
+    holes = rng.integers(0, [height, width], size=(8, 2))
+    mask[holes[:, 0], holes[:, 1]] = 0
+    return mask
+
+
+@pytest.mark.parametrize('mask_shape', [(64, 48), (50, 70)], ids=['same-size', 'resized-mask'])
+def test_matches_inpaint_path(mask_shape):
+    rng = np.random.default_rng(0)
+    generated = [rng.integers(0, 256, size=(64, 48, 3), dtype=np.uint8) for _ in range(3)]
+    mask = sample_mask(*mask_shape, rng)
+
+    results = composite_rgba(generated, mask)
+
+    assert len(results) == len(generated)
+    for generated_rgb, result in zip(generated, results):
+        expected = legacy_composite_rgba(generated_rgb, mask)
+        assert result.shape == expected.shape
+        assert result.dtype == np.uint8
+        np.testing.assert_array_equal(result[:, :, 3], expected[:, :, 3])
+        visible = expected[:, :, 3] > 0
+        assert visible.any() and not visible.all()
+        np.testing.assert_array_equal(result[visible], expected[visible])
+        np.testing.assert_array_equal(result, expected)
+
+
+@pytest.mark.parametrize('fill', [0, 255], ids=['transparent', 'opaque'])
+def test_uniform_mask(fill):
+    rng = np.random.default_rng(1)
+    generated = [rng.integers(0, 256, size=(32, 32, 3), dtype=np.uint8)]
+    mask = np.full((32, 32), fill, dtype=np.uint8)
+
+    result = composite_rgba(generated, mask)[0]
+
+    np.testing.assert_array_equal(result, legacy_composite_rgba(generated[0], mask))
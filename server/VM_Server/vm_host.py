@@ -0,0 +1,294 @@
+"""
+Optional combined host: serves the SAM, LaMa, ControlNet rerender and LGM/MVDream
+endpoints from one process, so the stack shares a single torch runtime, CUDA
+context and blob store instead of four.
+
+Models are loaded by the first request that needs them. When loading one would
+push the resident models over VM_HOST_MEMORY_BUDGET_MB, the least recently used
+idle models are released first; a model serving a request is never released.
+GET /metrics reports what is resident and the load/evict counts and times;
+GET /admission shows the shared priority queues (see admission.py).
+
+    VM_HOST_MEMORY_BUDGET_MB=12000 VM_HOST_PRELOAD=sam python vm_host.py
+
+Every service's dependencies (sam2, saicinpainting, cldm, LGM's core/mvdream)
+must be importable from the working directory, and LGM reads its options from
+LGM_ARGS (e.g. "big --resume pretrained/model_fp16.safetensors"). Point the
+gateway at this process with VM_HOST_URL.
+"""
+import gc
+import importlib
+import os
+import threading
+import time
+
+import torch
+from flask import Flask, jsonify
+from flask_cors import CORS
+
+from admission import register_admission_routes
+from blob_store import create_blob_store, register_blob_routes
+from service_health import ServiceHealth, register_health_routes
+
+MB = 1024 * 1024
+
+VM_HOST_PORT = int(os.environ.get('VM_HOST_PORT', 5000))
+# Services to serve from this process
+VM_HOST_SERVICES = [s.strip() for s in os.environ.get('VM_HOST_SERVICES', 'sam,lama,rerender,lgm').split(',') if s.strip()]
+# Services loaded at startup instead of on the first request
+VM_HOST_PRELOAD = [s.strip() for s in os.environ.get('VM_HOST_PRELOAD', '').split(',') if s.strip()]
+# Upper bound on the summed model footprint (0 keeps every model once loaded)
+VM_HOST_MEMORY_BUDGET_MB = int(os.environ.get('VM_HOST_MEMORY_BUDGET_MB', 0))
+# How long a request waits for busy models to free enough of the budget
+VM_HOST_LOAD_TIMEOUT_S = float(os.environ.get('VM_HOST_LOAD_TIMEOUT_S', 300))
+# rerender.py or test1_rerender.py (both serve /rerender_with_canny)
+VM_HOST_RERENDER_MODULE = os.environ.get('VM_HOST_RERENDER_MODULE', 'rerender')
+
+# service -> (module, model endpoints, footprint estimate in MB). On CUDA the
+# estimate is replaced by the allocation measured across the first load;
+# VM_HOST_MODEL_MB_<SERVICE> overrides it.
+SERVICES = {
+    'sam': ('SAM_server', ('/segment', '/index_image', '/segment_batch'), 1500),
+    'lama': ('LaMa_server', ('/inpaint',), 800),
+    'rerender': (VM_HOST_RERENDER_MODULE, ('/rerender_with_canny',), 6000),
+    'lgm': ('infer_3sides', ('/process',), 4000),
+}
+
+
+class ModelBudgetError(RuntimeError):
+    """Raised when a model cannot fit in the budget before VM_HOST_LOAD_TIMEOUT_S."""
+
+
+class ResidentModel:
+    """One service module's models: residency state, footprint and counters."""
+
+    def __init__(self, name, module, estimate_bytes):
+        self.name = name
+        self.module = module
+        self.estimate_bytes = estimate_bytes
+        self.measured_bytes = None
+        self.state = 'unloaded'  # unloaded | loading | resident
+        self.active = 0
+        self.last_used = 0.0
+        self.requests = 0
+        self.loads = 0
+        self.load_failures = 0
+        self.evictions = 0
+        self.last_load_ms = None
+        self.total_load_ms = 0.0
+
+    @property
+    def footprint(self):
+        return self.measured_bytes if self.measured_bytes is not None else self.estimate_bytes
+
+    def snapshot(self):
+        return {
+            'state': self.state,
+            'footprint_mb': round(self.footprint / MB, 1),
+            'measured': self.measured_bytes is not None,
+            'active_requests': self.active,
+            'requests': self.requests,
+            'loads': self.loads,
+            'load_failures': self.load_failures,
+            'evictions': self.evictions,
+            'last_load_ms': self.last_load_ms,
+            'total_load_ms': round(self.total_load_ms, 1),
+        }
+
+
+class ModelResidency:
+    """
+    Keeps service models resident within a memory budget. acquire() loads a
+    model on demand, releasing least recently used idle models when it would
+    not fit; release() ends the request that acquired it.
+    """
+
+    def __init__(self, budget_bytes, load_timeout_s):
+        self.budget_bytes = budget_bytes
+        self.load_timeout_s = load_timeout_s
+        self.models = {}
+        self.cond = threading.Condition()
+        # Loads run one at a time so the measured CUDA allocation belongs to a single model
+        self.load_lock = threading.Lock()
+
+    def register(self, name, module, estimate_bytes):
+        self.models[name] = ResidentModel(name, module, estimate_bytes)
+
+    def _used_bytes(self):
+        return sum(m.footprint for m in self.models.values() if m.state != 'unloaded')
+
+    def _make_room(self, entry):
+        """Evicts LRU idle models until entry fits; False while busy models hold the budget. Call with cond held."""
+        if not self.budget_bytes:
+            return True
+        while self._used_bytes() + entry.footprint > self.budget_bytes:
+            idle = [m for m in self.models.values() if m.state == 'resident' and m.active == 0]
+            if not idle:
+                # A model larger than the whole budget still loads once it has the device to itself
+                return self._used_bytes() == 0
+            self._evict(min(idle, key=lambda m: m.last_used))
+        return True
+
+    def _evict(self, entry):
+        print(f"[INFO] vm_host: evicting {entry.name} ({entry.footprint / MB:.0f} MB)")
+        entry.module.release_models()
+        entry.state = 'unloaded'
+        entry.evictions += 1
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def acquire(self, name):
+        """Blocks until the named service's models are resident and marks them in use."""
+        entry = self.models[name]
+        deadline = time.monotonic() + self.load_timeout_s
+        with self.cond:
+            while True:
+                if entry.state == 'resident':
+                    entry.active += 1
+                    entry.requests += 1
+                    entry.last_used = time.monotonic()
+                    return
+                if entry.state == 'unloaded' and self._make_room(entry):
+                    entry.state = 'loading'
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ModelBudgetError(f"No room to load '{name}' within {VM_HOST_MEMORY_BUDGET_MB} MB; "
+                                           f"other models are busy")
+                self.cond.wait(remaining)
+        self._load(entry)
+
+    def _load(self, entry):
+        measured = 0
+        try:
+            with self.load_lock:
+                allocated_before = torch.cuda.memory_allocated() if torch.cuda.is_available() else None
+                start = time.perf_counter()
+                entry.module.load_models()
+                load_ms = round((time.perf_counter() - start) * 1000.0, 1)
+                if allocated_before is not None:
+                    measured = torch.cuda.memory_allocated() - allocated_before
+        except Exception:
+            # Drop whatever was loaded before the failure
+            entry.module.release_models()
+            with self.cond:
+                entry.state = 'unloaded'
+                entry.load_failures += 1
+                self.cond.notify_all()
+            raise
+
+        print(f"[INFO] vm_host: loaded {entry.name} in {load_ms} ms")
+        with self.cond:
+            if measured > 0:
+                entry.measured_bytes = measured
+            entry.state = 'resident'
+            entry.loads += 1
+            entry.last_load_ms = load_ms
+            entry.total_load_ms += load_ms
+            entry.active += 1
+            entry.requests += 1
+            entry.last_used = time.monotonic()
+            self.cond.notify_all()
+
+    def hold(self, name):
+        """
+        Marks a resident model in use for work that outlives the request that
+        acquired it (background jobs, streamed sampling); returns the release.
+        """
+        entry = self.models[name]
+        with self.cond:
+            entry.active += 1
+        return lambda: self.release(name)
+
+    def release(self, name):
+        entry = self.models[name]
+        with self.cond:
+            entry.active -= 1
+            entry.last_used = time.monotonic()
+            self.cond.notify_all()
+
+    def snapshot(self):
+        with self.cond:
+            models = {name: m.snapshot() for name, m in self.models.items()}
+            return {
+                'budget_mb': VM_HOST_MEMORY_BUDGET_MB or None,
+                'used_mb': round(self._used_bytes() / MB, 1),
+                'loads': sum(m['loads'] for m in models.values()),
+                'evictions': sum(m['evictions'] for m in models.values()),
+                'models': models,
+            }
+
+
+app = Flask(__name__)
+CORS(app)
+
+# One blob store for every mounted service, so an image is uploaded once per host
+BLOBS = create_blob_store()
+register_blob_routes(app, BLOBS)
+
+# Ready once every service module is imported; models load on demand after that
+HEALTH = ServiceHealth('vm_host')
+register_health_routes(app, HEALTH)
+# Every mounted service admits its inference calls through this process's one controller
+register_admission_routes(app)
+
+RESIDENCY = ModelResidency(VM_HOST_MEMORY_BUDGET_MB * MB, VM_HOST_LOAD_TIMEOUT_S)
+
+
+def hosted_view(name, view):
+    """Wraps a service view so its models are resident (and pinned) while it runs."""
+    def run(*args, **kwargs):
+        try:
+            RESIDENCY.acquire(name)
+        except ModelBudgetError as e:
+            return jsonify({'error': str(e), 'service': name}), 503
+        except Exception as e:
+            return jsonify({'error': f"Failed to load '{name}': {e}", 'service': name}), 503
+
+        # Work that continues after the view returns (index jobs, streamed sampling)
+        # takes its own hold through the module's HOLD_MODELS
+        try:
+            return view(*args, **kwargs)
+        finally:
+            RESIDENCY.release(name)
+
+    run.__name__ = f"{name}_{view.__name__}"
+    return run
+
+
+def mount(name):
+    """Imports a service module (without loading its models) and serves its model endpoints here."""
+    module_name, paths, estimate_mb = SERVICES[name]
+    module = importlib.import_module(module_name)
+    module.BLOBS = BLOBS
+    module.HOLD_MODELS = lambda: RESIDENCY.hold(name)
+    estimate_mb = int(os.environ.get(f'VM_HOST_MODEL_MB_{name.upper()}', estimate_mb))
+    RESIDENCY.register(name, module, estimate_mb * MB)
+
+    for rule in module.app.url_map.iter_rules():
+        if rule.rule in paths:
+            view = module.app.view_functions[rule.endpoint]
+            app.add_url_rule(rule.rule, f"{name}.{rule.endpoint}", hosted_view(name, view),
+                             methods=sorted(rule.methods - {'HEAD', 'OPTIONS'}))
+
+    if name == 'lama' and module.CACHE_MEMORY_ITEMS > 0:
+        module.RESULT_CACHE = module.InpaintResultCache(module.CACHE_MEMORY_ITEMS, module.CACHE_DISK_ITEMS,
+                                                        module.CACHE_DIR)
+    print(f"[INFO] vm_host: mounted {name} ({', '.join(paths)})")
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify(RESIDENCY.snapshot())
+
+
+if __name__ == '__main__':
+    with HEALTH.loading():
+        for service in VM_HOST_SERVICES:
+            mount(service)
+    for service in VM_HOST_PRELOAD:
+        RESIDENCY.acquire(service)
+        RESIDENCY.release(service)
+    HEALTH.mark_ready()
+    app.run(host='0.0.0.0', port=VM_HOST_PORT, threaded=True)
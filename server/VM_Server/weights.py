@@ -0,0 +1,141 @@
+"""
+Fast weight loading for the VM services, plus a checkpoint -> safetensors converter.
+
+Usage:
+    python weights.py convert models/control_sd15_canny.pth
+    python weights.py convert big-lama/models/best.ckpt --only-prefix generator.
+    python weights.py convert pretrained/model_fp16.pth --out pretrained/model_fp16.safetensors
+
+Converted files sit next to the original with a .safetensors suffix, and
+resolve_weights() picks them up automatically. Safetensors files are memory-mapped
+and materialized directly on the target device. The state dict is then assigned
+into the model instead of being copied, so startup never holds a second full
+pickled copy of the weights in host memory.
+"""
+import argparse
+import inspect
+import itertools
+import os
+
+import torch
+
+try:
+    from safetensors.torch import load_file, save_file
+except ImportError:  # only needed for .safetensors checkpoints
+    load_file = save_file = None
+
+
+def safetensors_path(path):
+    return os.path.splitext(path)[0] + '.safetensors'
+
+
+def resolve_weights(path):
+    """Prefers a converted .safetensors sibling of path when one exists."""
+    if not path.endswith('.safetensors') and load_file is not None and os.path.exists(safetensors_path(path)):
+        return safetensors_path(path)
+    return path
+
+
+def _unwrap(checkpoint):
+    # Lightning checkpoints keep the weights under 'state_dict'
+    if isinstance(checkpoint, dict) and isinstance(checkpoint.get('state_dict'), dict):
+        return checkpoint['state_dict']
+    return checkpoint
+
+
+def load_state_dict_fast(path, device):
+    """
+    Loads a state dict onto device: safetensors via mmap straight to the device,
+    other checkpoints via torch.load (memory-mapped when loading to CPU).
+    """
+    device = torch.device(device)
+    if path.endswith('.safetensors'):
+        if load_file is None:
+            raise ImportError("safetensors is required to load .safetensors checkpoints")
+        return load_file(path, device=str(device))
+    mmap = device.type == 'cpu'
+    try:
+        checkpoint = torch.load(path, map_location=device, mmap=mmap, weights_only=False)
+    except TypeError:  # torch < 2.1 has no mmap / weights_only
+        checkpoint = torch.load(path, map_location=device)
+    except RuntimeError:
+        if not mmap:
+            raise
+        # Legacy (non-zip) checkpoints cannot be memory-mapped
+        checkpoint = torch.load(path, map_location=device, weights_only=False)
+    return _unwrap(checkpoint)
+
+
+def _supports_assign():
+    return 'assign' in inspect.signature(torch.nn.Module.load_state_dict).parameters
+
+
+def build_empty(build):
+    """
+    Runs build() with parameters and buffers created on the meta device, so the
+    model's weights are neither allocated nor randomly initialized before
+    load_into() assigns the loaded ones. Builds normally where torch cannot
+    assign a state dict (< 2.1).
+    """
+    if not _supports_assign():
+        return build()
+    with torch.device('meta'):
+        return build()
+
+
+def meta_tensors(model):
+    """Names of parameters and buffers still on the meta device (not supplied by the checkpoint)."""
+    return [name for name, tensor in itertools.chain(model.named_parameters(), model.named_buffers())
+            if tensor.is_meta]
+
+
+def load_into(model, state_dict, strict=True):
+    """Assigns the loaded tensors as the model's parameters (no copy) where torch supports it."""
+    try:
+        return model.load_state_dict(state_dict, strict=strict, assign=True)
+    except TypeError:  # torch < 2.1
+        return model.load_state_dict(state_dict, strict=strict)
+
+
+def convert(src, dst=None, only_prefixes=None, half=False):
+    """Writes the tensors of a pickled checkpoint to a safetensors file; returns its path."""
+    if save_file is None:
+        raise ImportError("safetensors is required for conversion")
+    dst = dst or safetensors_path(src)
+    state_dict = _unwrap(torch.load(src, map_location='cpu', weights_only=False))
+
+    tensors = {}
+    seen_storages = set()
+    for name, value in state_dict.items():
+        if not isinstance(value, torch.Tensor):
+            continue
+        if only_prefixes and not any(name.startswith(prefix) for prefix in only_prefixes):
+            continue
+        if half and value.is_floating_point():
+            value = value.half()
+        # safetensors rejects tensors that share storage; give duplicates their own copy
+        storage = value.untyped_storage().data_ptr()
+        if storage in seen_storages:
+            value = value.clone()
+        seen_storages.add(storage)
+        tensors[name] = value.contiguous()
+
+    save_file(tensors, dst, metadata={'source': os.path.basename(src)})
+    size_mb = os.path.getsize(dst) / (1024 * 1024)
+    print(f"[INFO] Wrote {len(tensors)} tensors ({size_mb:.1f} MB) to {dst}")
+    return dst
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    convert_parser = sub.add_parser('convert')
+    convert_parser.add_argument('src')
+    convert_parser.add_argument('--out', default=None)
+    convert_parser.add_argument('--only-prefix', action='append', default=None,
+                                help='keep only tensors under this prefix (repeatable), e.g. generator.')
+    convert_parser.add_argument('--half', action='store_true', help='store floating point tensors as fp16')
+
+    args = parser.parse_args()
+    convert(args.src, args.out, args.only_prefix, args.half)
@@ -1,5 +1,8 @@
 import os
+import json
 import time
+import hashlib
+import threading
 import uuid
 import base64
 import cv2
@@ -32,6 +35,10 @@ MODEL_NAME = "black-forest-labs/FLUX.1-schnell"
 INFERENCE_PROVIDER = "together"
 GCP_PROJECT = os.getenv("GOOGLE_CLOUD_PROJECT")
 VM_KEY = os.getenv("VM_IP_ADDRESS")
+# Precompute SAM automatic masks for every new image so clicks can hit the index
+SAM_AUTO_INDEX = os.getenv("SAM_AUTO_INDEX", "0") == "1"
+# Send images to the VM services once and refer to them by content hash afterwards
+VM_IMAGE_REFS = os.getenv("VM_IMAGE_REFS", "1") == "1"
 
 hf_client = InferenceClient(
     provider=INFERENCE_PROVIDER,
@@ -161,10 +168,12 @@ def get_description_from_gemini(prompt, image_bytes, mime_type="image/png", mode
         app.logger.error(f"Gemini text generation error: {e}", exc_info=True)
         raise
     
-SAMVMURL = f"http://{VM_KEY}:5000"
-VM_3D_SERVER_URL = f"http://{VM_KEY}:5001"
-VM_LAMA_SERVER_URL = f"http://{VM_KEY}:5002" 
-VM_CANNY_SERVER_URL = f"http://{VM_KEY}:5003"
+# VM_HOST_URL points every VM service at one combined host (VM_Server/vm_host.py)
+VM_HOST_URL = os.environ.get('VM_HOST_URL')
+SAMVMURL = VM_HOST_URL or f"http://{VM_KEY}:5000"
+VM_3D_SERVER_URL = VM_HOST_URL or f"http://{VM_KEY}:5001"
+VM_LAMA_SERVER_URL = VM_HOST_URL or f"http://{VM_KEY}:5002"
+VM_CANNY_SERVER_URL = VM_HOST_URL or f"http://{VM_KEY}:5003"
 
 def upload_to_vm(filepath, metadata=None):
     try:
@@ -181,6 +190,119 @@ def upload_to_vm(filepath, metadata=None):
     except Exception as e:
         print(f"Upload to VM failed: {str(e)}")
         return None
+# How long a /readyz answer is trusted before asking the VM service again
+VM_READY_TTL_S = float(os.getenv("VM_READY_TTL_S", "5"))
+VM_READY_CACHE = {}
+
+
+class VMServiceNotReady(Exception):
+    """A VM service is still loading/warming up, has failed, or cannot be reached."""
+
+    def __init__(self, base_url, state):
+        super().__init__(f"VM service at {base_url} is not ready ({state})")
+        self.state = state
+
+
+def vm_service_state(base_url):
+    """Returns the service's /readyz state ('ready', 'warming', ...), cached for VM_READY_TTL_S."""
+    cached = VM_READY_CACHE.get(base_url)
+    if cached and time.time() - cached[0] < VM_READY_TTL_S:
+        return cached[1]
+    try:
+        response = requests.get(f"{base_url}/readyz", timeout=2)
+        if response.status_code == 404:
+            # Service predates /readyz; treat it as ready
+            state = 'ready'
+        else:
+            state = response.json().get('state', 'unknown')
+    except requests.RequestException:
+        state = 'unreachable'
+    VM_READY_CACHE[base_url] = (time.time(), state)
+    return state
+
+
+def require_vm_ready(base_url):
+    state = vm_service_state(base_url)
+    if state != 'ready':
+        raise VMServiceNotReady(base_url, state)
+
+
+def vm_error_status(response):
+    """Status to report for a failed VM call: 429 when the VM shed it at admission, else 500."""
+    return 429 if response.status_code == 429 else 500
+
+
+# sha256 digests each VM service is known to hold, per base URL
+VM_KNOWN_BLOBS = {}
+VM_KNOWN_BLOBS_LOCK = threading.Lock()
+
+
+def ensure_vm_blob(base_url, image_bytes):
+    """Uploads image_bytes to the VM service's blob store unless it already has them; returns the image_ref."""
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    with VM_KNOWN_BLOBS_LOCK:
+        if digest in VM_KNOWN_BLOBS.get(base_url, ()):
+            return digest
+
+    check = requests.get(f"{base_url}/blobs/{digest}", timeout=10)
+    if check.status_code == 404:
+        upload = requests.put(
+            f"{base_url}/blobs/{digest}",
+            data=image_bytes,
+            headers={'Content-Type': 'application/octet-stream'},
+            timeout=60
+        )
+        upload.raise_for_status()
+    else:
+        check.raise_for_status()
+
+    with VM_KNOWN_BLOBS_LOCK:
+        VM_KNOWN_BLOBS.setdefault(base_url, set()).add(digest)
+    return digest
+
+
+def post_image_request(base_url, path, image_bytes, payload, inline_key,
+                       inline_prefix="data:image/png;base64,", **kwargs):
+    """
+    POSTs payload to a VM service with the image attached as "image_ref" (uploaded
+    once per content hash) or, with VM_IMAGE_REFS off, inline under inline_key.
+    If the service has evicted the blob it is uploaded again and the call retried once.
+    Raises VMServiceNotReady without sending anything if the service is not ready.
+    """
+    url = f"{base_url}{path}"
+    require_vm_ready(base_url)
+    if not VM_IMAGE_REFS:
+        payload[inline_key] = inline_prefix + base64.b64encode(image_bytes).decode('utf-8')
+        return requests.post(url, json=payload, **kwargs)
+
+    for attempt in range(2):
+        payload['image_ref'] = ensure_vm_blob(base_url, image_bytes)
+        response = requests.post(url, json=payload, **kwargs)
+        if response.status_code == 404 and attempt == 0 and 'missing_ref' in response.text:
+            with VM_KNOWN_BLOBS_LOCK:
+                VM_KNOWN_BLOBS.get(base_url, set()).discard(payload['image_ref'])
+            continue
+        return response
+
+
+def request_sam_index(image_path):
+    """
+    Asks the SAM VM to build its automatic mask index for a freshly generated image.
+    Runs in the background; failures only cost the fast path on later clicks.
+    """
+    if not SAM_AUTO_INDEX:
+        return
+
+    def _post():
+        try:
+            with open(image_path, 'rb') as f:
+                image_bytes = f.read()
+            post_image_request(SAMVMURL, "/index_image", image_bytes, {}, 'image_url', timeout=30)
+        except Exception as e:
+            app.logger.warning(f"SAM index request failed for {image_path}: {e}")
+
+    socketio.start_background_task(_post)
+
 def save_base64_image(b64_data, folder, base_filename):
     """
     Decodes a base64 string and saves it as a PNG image in the specified folder.
@@ -213,6 +335,37 @@ def save_base64_image(b64_data, folder, base_filename):
         app.logger.error(f"Failed to save base64 image to {folder}: {e}")
         return None
 
+def decode_mask_data(mask_data):
+    """
+    Decodes a SAM mask into a HxW uint8 array (0 or 255).
+    Accepts COCO-style RLE ({"size", "counts"}), a packed bitmask ({"size", "bits"})
+    or a legacy base64 PNG string / data URL.
+    """
+    if isinstance(mask_data, dict):
+        height, width = mask_data['size']
+        if 'counts' in mask_data:
+            counts = np.asarray(mask_data['counts'], dtype=np.int64)
+            values = np.zeros(len(counts), dtype=np.uint8)
+            values[1::2] = 255
+            return np.repeat(values, counts).reshape((height, width), order='F')
+        if 'bits' in mask_data:
+            packed = np.frombuffer(base64.b64decode(mask_data['bits']), np.uint8)
+            bits = np.unpackbits(packed, count=height * width)
+            return (bits * 255).reshape((height, width))
+        raise ValueError('Unknown mask encoding')
+
+    if 'base64,' in mask_data:
+        mask_data = mask_data.split(',', 1)[1]
+
+    np_arr = np.frombuffer(base64.b64decode(mask_data), np.uint8)
+    mask_image_cv = cv2.imdecode(np_arr, cv2.IMREAD_UNCHANGED)
+
+    if len(mask_image_cv.shape) > 2 and mask_image_cv.shape[2] == 4:
+        return mask_image_cv[:, :, 3]
+    elif len(mask_image_cv.shape) > 2:
+        return cv2.cvtColor(mask_image_cv, cv2.COLOR_BGR2GRAY)
+    return mask_image_cv
+
 def prepare_3d_input(image_url, mask_data):
     #Prepares the cropped and centered image for 3D generation.#
     # Extract filename from URL
@@ -227,12 +380,8 @@ def prepare_3d_input(image_url, mask_data):
     with open(image_path, 'rb') as f:
         original_image = Image.open(f).convert('RGBA')
     
-    # Decode mask (base64 string)
-    if ',' in mask_data:
-        mask_data = mask_data.split(',')[-1]
-        
-    mask_bytes = base64.b64decode(mask_data)
-    mask_image = Image.open(BytesIO(mask_bytes)).convert('L')
+    # Decode mask (RLE, packed bitmask or base64 PNG)
+    mask_image = Image.fromarray(decode_mask_data(mask_data))
     
     # Ensure mask matches image size
     if mask_image.size != original_image.size:
@@ -295,31 +444,15 @@ def transform_to_3d_alive():
         if not os.path.exists(image_path):
             return jsonify({'error': 'Image file not found for transformation'}), 404
 
-        # Read the original image file and convert to Base64 for the LaMa API call
+        # Read the original image file for the LaMa API call
         with open(image_path, 'rb') as f:
-            original_image_base64 = base64.b64encode(f.read()).decode('utf-8')
+            original_image_bytes = f.read()
 
         #  PROCESS AND DILATE THE MASK
         
         
-        if 'base64,' in mask_data:
-            mask_header, mask_b64 = mask_data.split(',', 1)
-        else:
-            mask_header = 'data:image/png;base64'
-            mask_b64 = mask_data
-
-        mask_bytes = base64.b64decode(mask_b64)
-       
-        np_arr = np.frombuffer(mask_bytes, np.uint8)
-        mask_image_cv = cv2.imdecode(np_arr, cv2.IMREAD_UNCHANGED)
-
-        if len(mask_image_cv.shape) > 2 and mask_image_cv.shape[2] == 4:
-            mask_gray = mask_image_cv[:, :, 3]
-        elif len(mask_image_cv.shape) > 2:
-        
-            mask_gray = cv2.cvtColor(mask_image_cv, cv2.COLOR_BGR2GRAY)
-        else:
-            mask_gray = mask_image_cv
+        mask_header = 'data:image/png;base64'
+        mask_gray = decode_mask_data(mask_data)
 
         _, binary_mask = cv2.threshold(mask_gray, 1, 255, cv2.THRESH_BINARY)
         # Define a 15x15 kernel (the structure used to enlarge the mask)
@@ -332,13 +465,11 @@ def transform_to_3d_alive():
       
         # 3. CALL LAMA INPAINTING SERVICE
         print(f"Starting Inpainting on {VM_LAMA_SERVER_URL}/inpaint")
-        lama_response = requests.post(
-            f"{VM_LAMA_SERVER_URL}/inpaint",
-            json={
-                # Send the original image and the newly dilated mask
-                "image": f"data:image/png;base64,{original_image_base64}",
-                "mask": refined_mask_data_url,
-            },
+        lama_response = post_image_request(
+            VM_LAMA_SERVER_URL, "/inpaint", original_image_bytes,
+            # Send the original image (by reference) and the newly dilated mask
+            {"mask": refined_mask_data_url},
+            'image',
             timeout=300 
         )
 
@@ -347,7 +478,7 @@ def transform_to_3d_alive():
             return jsonify({
                 'error': 'LaMa inpainting failed',
                 'details': lama_response.text
-            }), 500
+            }), vm_error_status(lama_response)
 
         # Extract the Base64 inpainted image from the LaMa response
         inpainted_image_data = lama_response.json().get('inpainted_image')
@@ -358,9 +489,11 @@ def transform_to_3d_alive():
         final_image_base64_data_url = prepare_3d_input(image_url, mask_data)
 
         print(f"Starting 3D generation on {VM_3D_SERVER_URL}/process")
-        infer_response = requests.post(
-            f"{VM_3D_SERVER_URL}/process",
-            json={"image": final_image_base64_data_url},
+        infer_response = post_image_request(
+            VM_3D_SERVER_URL, "/process",
+            base64.b64decode(final_image_base64_data_url.split(',', 1)[1]),
+            {},
+            'image',
             timeout=300 
         )
 
@@ -369,7 +502,7 @@ def transform_to_3d_alive():
             return jsonify({
                 'error': '3D generation failed',
                 'details': infer_response.text
-            }), 500
+            }), vm_error_status(infer_response)
 
         # Extract the 3D model data  PLY file
         ply_data = infer_response.json().get('ply_data')
@@ -457,6 +590,8 @@ def transform_to_3d_alive():
             'detailed_prompt': detailed_prompt
         })
 
+    except VMServiceNotReady as e:
+        return jsonify({'error': str(e), 'service_state': e.state}), 503
     except Exception as e:
         # Catch and log any unexpected server-side errors
         app.logger.error(f"Error in transform_to_3d_alive: {e}", exc_info=True)
@@ -481,6 +616,27 @@ def save_text_file(text_content, folder, base_filename):
         app.logger.error(f"Failed to save text file to {folder}: {e}")
         return None
 
+def relay_rerender_stream(response, stream_id):
+    """
+    Reads the NDJSON event stream from the Canny VM, forwarding 'preview' and
+    'sample' events to the client as 'rerender_progress'. Returns the payload of
+    the final 'done' event (or {'error': ...}) in the non-streaming response shape.
+    """
+    final_data = {'error': 'Canny VM stream ended without a result'}
+    for line in response.iter_lines():
+        if not line:
+            continue
+        event = json.loads(line)
+        kind = event.pop('event', None)
+        if kind in ('preview', 'sample'):
+            socketio.emit('rerender_progress', {'stream_id': stream_id, 'type': kind, **event})
+        elif kind == 'done':
+            final_data = event
+        elif kind == 'error':
+            final_data = {'error': event.get('error', 'Unknown error')}
+    return final_data
+
+
 # In your main image_generator.py (port 5000)
 
 @app.route('/rerender_with_canny', methods=['POST'])
@@ -510,17 +666,31 @@ def rerender_with_canny():
         if 'base64,' in image_base64:
             app.logger.info("Found data URL prefix, stripping it for VM...")
             image_base64_for_vm = image_base64.split(',', 1)[1]
+        # Prompt tweaks resend the same image; by reference it is only uploaded the first time
+        image_bytes_for_vm = base64.b64decode(image_base64_for_vm)
 
         vm_url = f"{VM_CANNY_SERVER_URL}/rerender_with_canny" 
         app.logger.info(f"Forwarding rerender request to {vm_url}...")
 
-        response = requests.post(
-            vm_url,
-            json={
-                "image_base64": image_base64_for_vm,
-                "prompt": prompt
-            },
-            timeout=300 
+        # Optional streaming: relay the VM's preview events to the client over Socket.IO
+        stream_id = data.get('stream_id')
+        vm_payload = {
+            "prompt": prompt
+        }
+        # Optional sampling controls; seed + reuse_latents is the prompt-tweak fast path,
+        # prompts renders several prompt variants in one batch
+        for key in ('preset', 'seed', 'reuse_latents', 'tweak_strength', 'prompts', 'samples_per_prompt'):
+            if data.get(key) is not None:
+                vm_payload[key] = data[key]
+        if stream_id:
+            vm_payload["stream"] = True
+            vm_payload["preview_every"] = data.get('preview_every', 5)
+
+        response = post_image_request(
+            VM_CANNY_SERVER_URL, "/rerender_with_canny", image_bytes_for_vm, vm_payload,
+            'image_base64', inline_prefix="",
+            timeout=300,
+            stream=bool(stream_id)
         )
 
         if response.status_code != 200:
@@ -528,12 +698,21 @@ def rerender_with_canny():
             return jsonify({
                 'error': 'Canny VM processing failed',
                 'details': response.text
-            }), 500
+            }), vm_error_status(response)
+
+        if stream_id:
+            vm_response_data = relay_rerender_stream(response, stream_id)
+            if 'error' in vm_response_data:
+                return jsonify({
+                    'error': 'Canny VM processing failed',
+                    'details': vm_response_data['error']
+                }), 500
+        else:
+            vm_response_data = response.json()
 
-        app.logger.info("Successfully got response from Canny VM.")
+        app.logger.info(f"Successfully got response from Canny VM. Timings (ms): {vm_response_data.get('timings_ms')}")
         
         # --- (This is the existing saving logic for outputs) ---
-        vm_response_data = response.json()
 
         # Goal 1: Save the Canny edge image
         try:
@@ -560,11 +739,24 @@ def rerender_with_canny():
 
         return jsonify(vm_response_data)
 
+    except VMServiceNotReady as e:
+        return jsonify({'error': str(e), 'service_state': e.state}), 503
     except Exception as e:
         app.logger.error(f"Error in /rerender_with_canny proxy: {e}", exc_info=True)
         return jsonify({'error': str(e)}), 500
 
     
+@app.route('/vm_status', methods=['GET'])
+def vm_status():
+    """Readiness of each VM service as last reported by its /readyz."""
+    return jsonify({
+        'sam': vm_service_state(SAMVMURL),
+        'lgm': vm_service_state(VM_3D_SERVER_URL),
+        'lama': vm_service_state(VM_LAMA_SERVER_URL),
+        'rerender': vm_service_state(VM_CANNY_SERVER_URL),
+    })
+
+
 #SAM Endpoint
 @app.route('/segment_with_sam', methods=['POST'])
 def segment_with_sam():
@@ -577,15 +769,18 @@ def segment_with_sam():
 
         with open(image_path, 'rb') as img_file:
             image_bytes = img_file.read()
-            image_base64 = base64.b64encode(image_bytes).decode('utf-8')
 
-        response = requests.post(
-            f"{SAMVMURL}/segment",
-            json={
-                'image_url': f"data:image/png;base64,{image_base64}",
+        # After the first click only the image hash travels to the VM
+        response = post_image_request(
+            SAMVMURL, "/segment", image_bytes,
+            {
                 'input_points': data['input_points'],
-                'input_labels': data['input_labels']
+                'input_labels': data['input_labels'],
+                'mask_format': data.get('mask_format', 'rle'),
+                'return_visualization': data.get('return_visualization', False),
+                'logits_handle': data.get('logits_handle')
             },
+            'image_url',
             timeout=300
         )
 
@@ -593,15 +788,55 @@ def segment_with_sam():
             return jsonify({
                 'error': 'SAM processing failed',
                 'details': response.text
-            }), 500
+            }), vm_error_status(response)
 
         return jsonify(response.json())
 
+    except VMServiceNotReady as e:
+        return jsonify({'error': str(e), 'service_state': e.state}), 503
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     
 
 
+@app.route('/segment_batch_with_sam', methods=['POST'])
+def segment_batch_with_sam():
+    try:
+        data = request.json
+        image_path = os.path.join('generated_images', os.path.basename(data['image_url']))
+
+        if not os.path.exists(image_path):
+            return jsonify({'error': 'Image file not found'}), 404
+
+        with open(image_path, 'rb') as img_file:
+            image_bytes = img_file.read()
+
+        response = post_image_request(
+            SAMVMURL, "/segment_batch", image_bytes,
+            {
+                'prompts': data['prompts'],
+                'multimask_output': data.get('multimask_output', False),
+                'mask_format': data.get('mask_format', 'rle')
+            },
+            'image_url',
+            timeout=300
+        )
+
+        if response.status_code != 200:
+            return jsonify({
+                'error': 'SAM batch processing failed',
+                'details': response.text
+            }), vm_error_status(response)
+
+        return jsonify(response.json())
+
+    except VMServiceNotReady as e:
+        return jsonify({'error': str(e), 'service_state': e.state}), 503
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+
 @app.route('/gemini', methods=['POST'])
 def gemini_iterate():
         data = request.json or {}
@@ -623,6 +858,7 @@ def gemini_iterate():
 
             with open(new_path, 'wb') as f:
                 f.write(result['image_bytes'])
+            request_sam_index(new_path)
 
 
             response_data = {
@@ -724,6 +960,7 @@ def generate_image():
         filename = f"{safe_prompt}__{timestamp}_{uuid.uuid4().hex[:4]}.png"
         image_path = f"generated_images/{filename}"
         image.save(image_path)
+        request_sam_index(image_path)
         
         socketio.emit('new_image', {
             'id': filename.split('.')[0],
@@ -778,6 +1015,7 @@ def generate_imagen():
 
         # Save image
         image.save(image_path)
+        request_sam_index(image_path)
 
         # Emit socket event if needed
         if 'socketio' in globals():
@@ -842,6 +1080,7 @@ def save_openai_image():
         filename = f"{safe_prompt}__{timestamp}_{uuid.uuid4().hex[:4]}.png"
         image_path = f"generated_images/{filename}"
         image.save(image_path)
+        request_sam_index(image_path)
         
         # Emit socket event
         socketio.emit('new_image', {
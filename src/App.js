@@ -1,7 +1,7 @@
 import React, { useState, useEffect, useRef } from 'react';
 import { CSSTransition } from 'react-transition-group';
 import { OpenAI } from 'openai';
-import { io } from "socket.io-client";
+import { socket } from "./lib/socket";
 
 // Components
 import ImageGenerator from './components/ImageGen_Input/ImageGen_Input';
@@ -51,7 +51,6 @@ function App() {
 
   useEffect(() => {
   let isMounted = true;//isMounted as a guard so it won’t set state if the component is already unmounted.
-  const newSocket = io('http://localhost:5000');//connects to the backend
 
   const loadImages = async () => {
     if (!isMounted) return;
@@ -67,7 +66,7 @@ function App() {
   
   loadImages();
   //This is real-time UI Updated without needing to refresh
- newSocket.on('new_image', (newImage) => {
+ socket.on('new_image', (newImage) => {
   console.log('Received new image', newImage);
   
   setImages(prev => {
@@ -91,8 +90,7 @@ function App() {
 });
   return () => {
     isMounted = false;
-    newSocket.off('new_image');
-    newSocket.disconnect();
+    socket.off('new_image');
   };
 }, []);
 
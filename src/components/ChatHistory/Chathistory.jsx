@@ -2,6 +2,7 @@ import React, { useState, useEffect, useRef } from 'react';
 import './ChatHistory.css';
 import TextMessage from "./TextMessage";
 import ImageMessage from "./ImageMessage";
+import { rleMaskToOverlayUrl } from "../../lib/utils";
 
 const ChatHistory = ({ messages,onRerenderComplete}) => {
   const chatEndRef = useRef(null);
@@ -62,7 +63,8 @@ const ChatHistory = ({ messages,onRerenderComplete}) => {
     const normalizedX = clickX / naturalWidth;
     const normalizedY = clickY / naturalHeight;
 
-    const newPoints = segmentationData.imageUrl === imageUrl
+    const isSameImage = segmentationData.imageUrl === imageUrl;
+    const newPoints = isSameImage
       ? [...segmentationData.points, { x: normalizedX, y: normalizedY }]
       : [{ x: normalizedX, y: normalizedY }];
 
@@ -88,7 +90,10 @@ const ChatHistory = ({ messages,onRerenderComplete}) => {
         body: JSON.stringify({
           image_url: `http://localhost:5000${imageUrl.startsWith('/') ? imageUrl : `/${imageUrl}`}`,
           input_points: newPoints.map(p => [p.x, p.y]),
-          input_labels: Array(newPoints.length).fill(1)
+          input_labels: Array(newPoints.length).fill(1),
+          mask_format: 'rle',
+          // Lets SAM refine the previous mask instead of starting over
+          logits_handle: isSameImage ? segmentationData.logitsHandle : null
         })
       });
 
@@ -106,16 +111,19 @@ const ChatHistory = ({ messages,onRerenderComplete}) => {
         (prev.score > current.score) ? prev : current
       );
 
-      if (!bestMask.mask || !bestMask.visualization) {
-        throw new Error('Missing mask or visualization in best mask');
+      if (!bestMask.mask) {
+        throw new Error('Missing mask in best mask');
       }
 
-      // Use visualization for overlay display
-      const visUrl = `data:image/png;base64,${bestMask.visualization}`;
+      // Draw the overlay locally unless the server sent a visualization
+      const visUrl = bestMask.visualization
+        ? `data:image/png;base64,${bestMask.visualization}`
+        : rleMaskToOverlayUrl(bestMask.mask);
       setSegmentationData(prev => ({
         ...prev,
         mask: visUrl,
         maskData: bestMask.mask,
+        logitsHandle: data.logits_handle,
 
         bbox: bestMask.bbox
       }));
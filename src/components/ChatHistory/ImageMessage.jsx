@@ -4,6 +4,7 @@ import SegmentationOverlay from "./SegmentationOverlay";
 import ThreeDViewer from "./3Dviewer"
 import "./ImageMessage.css"
 import html2canvas from "html2canvas";
+import { socket } from "../../lib/socket";
 
 const ImageMessage = ({
   msg,
@@ -32,6 +33,7 @@ const ImageMessage = ({
   const threeDContainerRef = useRef(null);
   const [isRerendering, setIsRerendering] = useState(false);
   const [rerenderError, setRerenderError] = useState(null);
+  const [rerenderPreview, setRerenderPreview] = useState(null); // { image, step, totalSteps } while sampling
 
   const resetViewRef = useRef(null);
 
@@ -117,6 +119,20 @@ const ImageMessage = ({
     setIsRerendering(true);
     setRerenderError(null);
     setRerenderOptions([]); 
+    setRerenderPreview(null);
+
+    // Progressive previews are pushed over the app's socket while the request is in
+    // flight; the stream id picks out this request's events
+    const streamId = `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+    const onProgress = (event) => {
+      if (event.stream_id !== streamId) return;
+      if (event.type === 'preview' && event.previews && event.previews.length > 0) {
+        setRerenderPreview({ image: event.previews[0], step: event.step, totalSteps: event.total_steps });
+      } else if (event.type === 'sample') {
+        setRerenderPreview(prev => ({ ...prev, image: event.image }));
+      }
+    };
+    socket.on('rerender_progress', onProgress);
 
     try {
       let imageBase64;
@@ -155,7 +171,8 @@ const ImageMessage = ({
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
           image_base64: imageBase64,
-          prompt: promptToSend
+          prompt: promptToSend,
+          stream_id: streamId
         }),
       });
 
@@ -176,6 +193,8 @@ const ImageMessage = ({
       setRerenderError(err.message || "Failed to rerender.");
       setRerenderOptions([]); 
     } finally {
+      socket.off('rerender_progress', onProgress);
+      setRerenderPreview(null);
       setIsRerendering(false); 
     }
   };
@@ -294,7 +313,14 @@ const ImageMessage = ({
 
         {isRerendering && rerenderOptions.length === 0 && (
           <div className="rerendering-overlay">
-            <div className="rerendering-text">Refining image...</div>
+            {rerenderPreview && rerenderPreview.image && (
+              <img src={rerenderPreview.image} alt="Rerender preview" className="rerender-preview-image" />
+            )}
+            <div className="rerendering-text">
+              {rerenderPreview && rerenderPreview.step
+                ? `Refining image... step ${rerenderPreview.step}/${rerenderPreview.totalSteps}`
+                : "Refining image..."}
+            </div>
           </div>
         )}
 
@@ -0,0 +1,5 @@
+import { io } from "socket.io-client";
+
+// The app's one Socket.IO connection to the gateway. Components add and remove
+// their own listeners on it rather than opening connections of their own.
+export const socket = io('http://localhost:5000');
@@ -4,3 +4,42 @@ import { twMerge } from "tailwind-merge";
 export function cn(...inputs) {
   return twMerge(clsx(inputs));
 }
+
+// Decodes a COCO-style RLE mask ({ size: [h, w], counts }) into a row-major
+// Uint8Array of 0/1 values.
+export function decodeRleMask({ size, counts }) {
+  const [height, width] = size;
+  const mask = new Uint8Array(height * width);
+  let pos = 0;
+  for (let i = 0; i < counts.length; i++) {
+    if (i % 2 === 1) {
+      for (let j = pos; j < pos + counts[i]; j++) {
+        // RLE runs are column-major
+        const x = Math.floor(j / height);
+        const y = j - x * height;
+        mask[y * width + x] = 1;
+      }
+    }
+    pos += counts[i];
+  }
+  return mask;
+}
+
+// Renders an RLE mask as a transparent PNG data URL with the masked pixels in green.
+export function rleMaskToOverlayUrl(rle) {
+  const [height, width] = rle.size;
+  const mask = decodeRleMask(rle);
+  const canvas = document.createElement("canvas");
+  canvas.width = width;
+  canvas.height = height;
+  const ctx = canvas.getContext("2d");
+  const imageData = ctx.createImageData(width, height);
+  for (let i = 0; i < mask.length; i++) {
+    if (mask[i]) {
+      imageData.data[i * 4 + 1] = 255;
+      imageData.data[i * 4 + 3] = 160;
+    }
+  }
+  ctx.putImageData(imageData, 0, 0);
+  return canvas.toDataURL("image/png");
+}